@@ -1,6 +1,23 @@
+from functools import partial
 import json
 import pandas as pd
 
+try:
+    from .transliterationCache import (
+        transliteration_cache,
+        start_transliteration_worker,
+        take_transliteration_stats,
+    )
+    from .sharding import transform_csv_sharded
+except ImportError:
+    # NOTE when this file is run directly, the app folder is on the path instead of the app package
+    from transliterationCache import (
+        transliteration_cache,
+        start_transliteration_worker,
+        take_transliteration_stats,
+    )
+    from sharding import transform_csv_sharded
+
 
 class Alphabet:
     yiddish = [
@@ -97,137 +114,171 @@ class Alphabet:
     ]
     cases_yiddish = ["וו", "דזש", "זש", "טש", "וי", "יי", "ײַ"]
     cases_roman = ["v", "dzh", "zh", "tsh", "oy", "ey", "ay"]
-
-
-def transliterate_zylbercweig(output_path):
-    zylbercweig = pd.read_csv(
-        "datasets/testset15-Zylbercweig-Laski/Zylbercweig.tsv", sep="\t"
-    )
-    id, lon, geo_id, geowkt, lat, title, geo_source, title_source, name_parts = (
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
+    # letters followed by a diacritic that changes how they are transliterated.
+    # The diacritic itself is not in the alphabet, so on its own it would just be dropped
+    diacritics_yiddish = ["אַ", "אָ", "בֿ", "בּ", "וּ", "כּ", "פּ", "פֿ", "שׂ", "תּ"]
+    diacritics_roman = ["a", "o", "v", "v", "u", "k", "p", "f", "s", "t"]
+
+
+def transform_csv_in_chunks(
+    input_path, output_path, transform, chunk_size=10000, sep=",", output_sep=None
+):
+    # read input_path chunk_size rows at a time, apply transform to each chunk (a pd.DataFrame) and append the result to output_path,
+    # so only a single chunk is ever held in memory. Every column is read as a string, so the columns transform doesn't touch
+    # are written back exactly as they were read. The index of the chunks continues across chunks, just like for a single pd.read_csv
+    if output_sep is None:
+        output_sep = sep
+    rows_written = 0
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file:
+        for chunk in pd.read_csv(input_path, sep=sep, dtype=str, chunksize=chunk_size):
+            # NOTE only the first chunk writes the header
+            transform(chunk).to_csv(output_file, sep=output_sep, header=rows_written == 0)
+            rows_written += len(chunk)
+            print(f"Wrote {rows_written} rows to {output_path}", end="\r")
+    print("")
+    return rows_written
+
+
+# the columns of Zylbercweig we keep when transliterating it
+zylbercweig_columns = [
+    "id",
+    "lon",
+    "geo_id",
+    "geowkt",
+    "lat",
+    "title",
+    "geo_source",
+    "title_source",
+    "name_parts",
+]
+
+
+def transliterate_zylbercweig_chunk(chunk):
+    # transliterate the title and name_parts columns of a chunk of Zylbercweig and pass the other columns through as they are
+    output = chunk[zylbercweig_columns].copy()
+    output["id"] = output["id"].str.replace("temp_", "", regex=False)
+    output["title"] = transliterate_yiddish_many(output["title"])
+    output["name_parts"] = output["name_parts"].map(
+        transliterate_name_parts, na_action="ignore"
     )
-    for _, row in zylbercweig.iterrows():
-        id.append(row["id"].replace("temp_", ""))
-        lon.append(row["lon"])
-        geo_id.append(row["geo_id"])
-        geowkt.append(row["geowkt"])
-        lat.append(row["lat"])
-        title.append(transliterate_yiddish(row["title"]))
-        geo_source.append(row["geo_source"])
-        title_source.append(row["title_source"])
-        name_parts.append(transliterate_name_parts(row["name_parts"]))
-    output = pd.DataFrame(
-        {
-            "id": id,
-            "lon": lon,
-            "geo_id": geo_id,
-            "geowkt": geowkt,
-            "lat": lat,
-            "title": title,
-            "geo_source": geo_source,
-            "title_source": title_source,
-            "name_parts": name_parts,
-        }
-    )
-    output.to_csv(output_path, sep="\t")
+    return output
+
+
+def transliterate_zylbercweig(
+    output_path,
+    input_path="datasets/testset15-Zylbercweig-Laski/Zylbercweig.tsv",
+    chunk_size=10000,
+    workers=1,
+    cache_path=None,
+):
+    # with more than one worker, the chunks are transliterated in a pool of worker processes. Use workers=None to use all cores.
+    # If cache_path is given, the transliterations are also kept in (and read from) the sqlite store at that path, see TransliterationCache
+    if cache_path is not None:
+        transliteration_cache.open(cache_path)
+    if workers == 1:
+        rows_written = transform_csv_in_chunks(
+            input_path, output_path, transliterate_zylbercweig_chunk, chunk_size, sep="\t"
+        )
+    else:
+        # NOTE the workers open the store themselves, so everything written to it so far has to be committed first
+        transliteration_cache.flush()
+        rows_written = transform_csv_sharded(
+            input_path,
+            output_path,
+            transliterate_zylbercweig_chunk,
+            workers=workers,
+            sep="\t",
+            chunk_size=chunk_size,
+            initializer=partial(start_transliteration_worker, cache_path),
+            chunk_stats=take_transliteration_stats,
+            add_stats=transliteration_cache.add_stats,
+        )
+    transliteration_cache.print_stats()
+    return rows_written
+
+
+class Transliterator:
+    # compiles pairs of source sequences and their replacements into a trie once, so strings can be transliterated in a single
+    # left-to-right pass that always replaces the longest sequence starting at the current character.
+    # Characters that don't start any known sequence are dropped.
+    # If a scheme is given, transliterations are memoized under that scheme in the shared transliteration_cache
+    def __init__(self, sources, targets, scheme=None):
+        self.scheme = scheme
+        self.trie = {}
+        for source, target in zip(sources, targets):
+            node = self.trie
+            for char in source:
+                node = node.setdefault(char, {})
+            # NOTE the None key marks that a sequence ends at this node and holds its replacement
+            node[None] = target
+
+    def transliterate(self, input_string):
+        if self.scheme is None:
+            return self.transliterate_uncached(input_string)
+        return transliteration_cache.get(
+            self.scheme, input_string, self.transliterate_uncached
+        )
+
+    def transliterate_uncached(self, input_string):
+        trie = self.trie
+        output = []
+        i = 0
+        length = len(input_string)
+        while i < length:
+            node = trie.get(input_string[i])
+            i += 1
+            if node is None:
+                continue
+            replacement = node.get(None)
+            end = i
+            # keep walking the trie for as long as the following characters continue a known sequence
+            j = i
+            while j < length:
+                node = node.get(input_string[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    replacement = node[None]
+                    end = j
+            if replacement is not None:
+                output.append(replacement)
+            i = end
+        return "".join(output)
+
+    def transliterate_many(self, strings):
+        # transliterate a list or a pd.Series of strings in one call.
+        # A pd.Series keeps its index and any missing values are left as they are
+        if isinstance(strings, pd.Series):
+            return strings.map(self.transliterate, na_action="ignore")
+        transliterate = self.transliterate
+        return [transliterate(string) for string in strings]
+
+
+# NOTE diacritics and special cases come after the alphabet so they take precedence if a sequence appears in more than one list
+yiddish_transliterator = Transliterator(
+    Alphabet.yiddish + Alphabet.diacritics_yiddish + Alphabet.cases_yiddish,
+    Alphabet.roman + Alphabet.diacritics_roman + Alphabet.cases_roman,
+    scheme="yiddish",
+)
 
 
 def transliterate_yiddish(input_string):
-    transliterated_string = ""
-    skip = 0
-    for i, _ in enumerate(input_string):
-        if skip > 0:
-            skip = skip - 1
-            continue
-        for j, _ in enumerate(Alphabet.yiddish):
-            if input_string[i] == Alphabet.yiddish[j]:
-                if i < len(input_string) - 1:
-                    # testing for diacritics
-                    if j == 0 and input_string[i + 1] == "ַ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[1]
-                        )
-                        continue
-                    elif j == 0 and input_string[i + 1] == "ָ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[2]
-                        )
-                        continue
-                    elif j == 3 and (
-                        input_string[i + 1] == "ֿ" or input_string[i + 1] == "ּ"
-                    ):
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[4]
-                        )
-                        continue
-                    elif j == 8 and input_string[i + 1] == "ּ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[9]
-                        )
-                        continue
-                    elif j == 14 and input_string[i + 1] == "ּ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[15]
-                        )
-                        continue
-                    elif j == 35 and input_string[i + 1] == "ּ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[24]
-                        )
-                        continue
-                    elif j == 35 and input_string[i + 1] == "ֿ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[25]
-                        )
-                        continue
-                    elif j == 31 and input_string[i + 1] == "ׂ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[32]
-                        )
-                        continue
-                    elif j == 33 and input_string[i + 1] == "ּ":
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[34]
-                        )
-                        continue
-
-                    # special cases
-                    for k, _ in enumerate(Alphabet.cases_yiddish):
-                        if (
-                            Alphabet.yiddish[j] == Alphabet.cases_yiddish[k][0]
-                            and input_string[i + 1] == Alphabet.cases_yiddish[k][1]
-                        ):
-                            if k != 1:
-                                transliterated_string = (
-                                    transliterated_string + Alphabet.cases_roman[k]
-                                )
-                                skip = 1
-                            elif (
-                                i < len(input_string) - 2
-                                and input_string[i + 2] == Alphabet.cases_yiddish[k][2]
-                            ):
-                                transliterated_string = (
-                                    transliterated_string + Alphabet.cases_roman[k]
-                                )
-                                skip = 2
-                    if skip == 0:
-                        transliterated_string = (
-                            transliterated_string + Alphabet.roman[j]
-                        )
-                else:
-                    transliterated_string = transliterated_string + Alphabet.roman[j]
-    return transliterated_string
+    return yiddish_transliterator.transliterate(input_string)
+
+
+def transliterate_yiddish_many(strings):
+    # transliterate a whole list or pd.Series of yiddish strings at once
+    return yiddish_transliterator.transliterate_many(strings)
 
 
 def transliterate_name_parts(input_string):
+    return transliteration_cache.get(
+        "yiddish_name_parts", input_string, transliterate_name_parts_uncached
+    )
+
+
+def transliterate_name_parts_uncached(input_string):
     commaseplist = input_string.split(", ")
     colonseplist = []
     for list in commaseplist:
@@ -255,94 +306,117 @@ def writefunction(text):
     out.to_csv("test", sep="\t")
 
 
-def write_transliterated_em(output_path):
-    # fmt: off
-    em = pd.read_csv("datasets/testset15-Zylbercweig-Laski/em_new.tsv", sep="\t")
-    yiddish = pd.read_csv("datasets/testset15-Zylbercweig-Laski/Zylbercweig.tsv", sep="\t")
-    laski = pd.read_csv("datasets/testset15-Zylbercweig-Laski/LASKI.tsv", sep="\t")
-    # fmt: on
-
-    # the indexes of the matches we should drop because we can't find their corresponding entries in Zylbercweig and/or LASKI
-    matches_to_drop = []
-
-    # add the new columns to the dataframe
-    em["index_roman"] = pd.Series()
-    em["index_LASKI"] = pd.Series()
-    em["name_parts_roman"] = pd.Series()
-    em["name_parts_LASKI"] = pd.Series()
-
-    for index, row in em.iterrows():
-        # for every row in the matches file, find the entries it's made of in Zylbercweig and LASKI and add their indexes to the match row
-
-        yiddish_mask = yiddish["title"] == row["Zylbercweig Name"]
-        laski_mask = laski["id"] == row["id"]
-
-        if laski_mask.sum() == 0 or yiddish_mask.sum() == 0:
+def index_by_key(column):
+    # given a column of a dataset, build a hash map from every value in the column to the index of the first row with that value,
+    # and count how many rows have each value. Joining matches on these is a single pass over the matches,
+    # instead of comparing every match with the entire column. Missing values are left out.
+    column = column.dropna()
+    first_indexes = pd.Series(column.index, index=column.values)
+    key_counts = first_indexes.index.value_counts()
+    first_indexes = first_indexes[~first_indexes.index.duplicated()]
+    return first_indexes, key_counts
+
+
+def write_transliterated_em(
+    output_path,
+    em_path="datasets/testset15-Zylbercweig-Laski/em_new.tsv",
+    yiddish_path="datasets/testset15-Zylbercweig-Laski/Zylbercweig.tsv",
+    laski_path="datasets/testset15-Zylbercweig-Laski/LASKI.tsv",
+):
+    em = pd.read_csv(em_path, sep="\t")
+    yiddish = pd.read_csv(yiddish_path, sep="\t")
+    laski = pd.read_csv(laski_path, sep="\t")
+
+    # for every row in the matches file, find the entries it's made of in Zylbercweig and LASKI by looking up their title and id
+    yiddish_indexes, yiddish_counts = index_by_key(yiddish["title"])
+    laski_indexes, laski_counts = index_by_key(laski["id"])
+    yiddish_index = em["Zylbercweig Name"].map(yiddish_indexes)
+    laski_index = em["id"].map(laski_indexes)
+    yiddish_count = em["Zylbercweig Name"].map(yiddish_counts).fillna(0).astype(int)
+    laski_count = em["id"].map(laski_counts).fillna(0).astype(int)
+
+    # we drop the matches we can't find their corresponding entries in Zylbercweig and/or LASKI for,
+    # and the matches where the title or id isn't enough to tell which entry the match is made of
+    missing = yiddish_index.isna() | laski_index.isna()
+    duplicated = ~missing & (yiddish_count + laski_count > 2)
+    for index in em.index[missing | duplicated]:
+        if missing[index]:
             print(
-                f"Dropping match with key {row["key"]}: Missing entry in LASKI or Zylbercweig."
+                f"Dropping match with key {em["key"][index]}: Missing entry in LASKI or Zylbercweig."
             )
-            matches_to_drop.append(index)
-            continue
-        if laski_mask.sum() + yiddish_mask.sum() > 2:
+        else:
             print(
-                f"Dropping match with key {row["key"]}: LASKI entries with same ID: {laski_mask.sum()}. Zylbercweig entries with same name: {yiddish_mask.sum()}"
+                f"Dropping match with key {em["key"][index]}: LASKI entries with same ID: {laski_count[index]}. Zylbercweig entries with same name: {yiddish_count[index]}"
             )
-            matches_to_drop.append(index)
-            continue
-
-        # NOTE: .idxmax() is used to make sure we only get a single element out, which is fine since there should be at most 1
-        yiddish_index = yiddish_mask.idxmax()
-        laski_index = laski_mask.idxmax()
-
-        # fmt: off
-        em["index_roman"].iat[index] = yiddish.index[yiddish_index]
-        em["index_LASKI"].iat[index] = laski.index[laski_index]
-        em["name_parts_roman"].iat[index] = transliterate_name_parts(yiddish["name_parts"][yiddish_index])
-        em["name_parts_LASKI"].iat[index] = laski["name_parts"][laski_index]
-        # fmt: on
-
-    # transliterate, drop the matches we couldn't find entries for, and write to the output_path
-    em = em.drop(index=matches_to_drop)
+    keep = ~(missing | duplicated)
+    em = em[keep].copy()
+
+    # add the indexes and name parts of the entries as new columns
+    em["index_roman"] = yiddish_index[keep].astype(int)
+    em["index_LASKI"] = laski_index[keep].astype(int)
+    em["name_parts_roman"] = (
+        yiddish["name_parts"][em["index_roman"]]
+        .map(transliterate_name_parts, na_action="ignore")
+        .values
+    )
+    em["name_parts_LASKI"] = laski["name_parts"][em["index_LASKI"]].values
     em.to_csv(output_path, sep="\t")
 
 
-def write_indexed_italy_em(output_path):
+def write_indexed_italy_em(
+    output_path,
+    em_path=r"datasets\testset13-YadVAshemItaly\em.tsv",
+    italy_path=r"datasets\testset13-YadVAshemItaly\yv_italy.tsv",
+):
     # this method will write the indexes of the records in matching pairs into the corresponding match and write the updated data to a file
-    em = pd.read_csv(r"datasets\testset13-YadVAshemItaly\em.tsv", sep="\t")
-    italy = pd.read_csv(r"datasets\testset13-YadVAshemItaly\yv_italy.tsv", sep="\t")
-    # the indexes from records in the respective datasets, stored in the order they should appear
-    indexes_1 = []
-    indexes_2 = []
-    for _, row in em.iterrows():
-        mask_1 = (italy["id"] == row["id_1"]).idxmax()
-        mask_2 = (italy["id"] == row["id_2"]).idxmax()
-        indexes_1.append(italy.index[mask_1])
-        indexes_2.append(italy.index[mask_2])
+    em = pd.read_csv(em_path, sep="\t")
+    italy = pd.read_csv(italy_path, sep="\t")
+    italy_indexes, italy_counts = index_by_key(italy["id"])
+    for id in italy_counts.index[italy_counts > 1]:
+        print(
+            f"Found {italy_counts[id]} records with id {id}. Using the first one."
+        )
 
-    indexes_1 = pd.Series(indexes_1)
-    indexes_2 = pd.Series(indexes_2)
+    # the indexes from records in the respective datasets, stored in the order they should appear
+    indexes_1 = em["id_1"].map(italy_indexes)
+    indexes_2 = em["id_2"].map(italy_indexes)
+    missing = indexes_1.isna() | indexes_2.isna()
+    for index in em.index[missing]:
+        print(
+            f"Dropping match ({em["id_1"][index]}, {em["id_2"][index]}): Missing record in the dataset."
+        )
+    em = em[~missing].copy()
 
-    em.insert(loc=0, column="index_2", value=indexes_2)
-    em.insert(loc=0, column="index_1", value=indexes_1)
+    em.insert(loc=0, column="index_2", value=indexes_2[~missing].astype(int))
+    em.insert(loc=0, column="index_1", value=indexes_1[~missing].astype(int))
 
     em.to_csv(output_path, sep="\t")
 
 
-def add_name_parts_from_title(input_filepath, output_filepath):
-    df = pd.read_csv(input_filepath, sep=",")
-    df["title"] = df["title"].str.split("@").str[0]
-    df["name_parts"] = pd.Series()
-    for i, row in df.iterrows():
-        # if pd.isna(row["phoneme"]) or row["phoneme"].strip() == "":
-        #    continue
-        df["name_parts"].iat[i] = json.dumps(
-            {
-                f"name_part_{index}": name_part
-                for index, name_part in enumerate(row["title"].split(" "))
-            },
-            ensure_ascii=False,
+def name_parts_from_title_chunk(chunk):
+    # strip the language tag from the titles of a chunk and split each title on spaces into name parts
+    chunk["title"] = chunk["title"].str.split("@").str[0]
+    chunk["name_parts"] = [
+        (
+            json.dumps(
+                {
+                    f"name_part_{index}": name_part
+                    for index, name_part in enumerate(title.split(" "))
+                },
+                ensure_ascii=False,
+            )
+            if isinstance(title, str)
+            else None
         )
-    df.to_csv(output_filepath, sep=",")
+        for title in chunk["title"]
+    ]
+    return chunk
+
+
+def add_name_parts_from_title(input_filepath, output_filepath, chunk_size=10000):
+    return transform_csv_in_chunks(
+        input_filepath, output_filepath, name_parts_from_title_chunk, chunk_size
+    )
 
 
 # FIXME this is outdated and should probably be removed
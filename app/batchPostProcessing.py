@@ -1,11 +1,9 @@
 import json
 
 import pandas as pd
-from textFiltering import (
-    calculate_recall_better,
-    calculate_precision,
-    find_missed_matches,
-)
+from textFiltering import find_missed_matches
+from blockEvaluation import match_evaluator
+from comparisonBlocks import load_blocks, save_blocks
 
 
 def load_response_booleans(output_filepath):
@@ -113,26 +111,35 @@ def create_blocks_from_output_pairs_with_confidence_score(
         return output_blocks
 
 
+def format_evaluation(evaluation, precise=False):
+    # the precision, recall, F1 and F-beta of an evaluation made by BlockEvaluator.evaluate, rounded to 4 decimals unless precise is True
+    lines = [
+        ("Precision", evaluation["precision"]),
+        ("Recall", evaluation["recall"]),
+        ("F1", evaluation["f1"]),
+        (f"F{evaluation['B']}", evaluation["fB"]),
+    ]
+    if precise:
+        return "\n".join(f"{name}: {value}" for name, value in lines)
+    return "\n".join(f"{name}: {value:.4f}" for name, value in lines)
+
+
 def test_with_name_list():
     print("Loading response...")
     output_booleans = load_response_booleans(r"app\batchfile3test_output.jsonl")
-    with open(r"app\blocks.json") as file:
-        print("Retrieving blocks...")
-        blocks = json.load(file)
-        blocks = {int(k): list(v) for k, v in blocks.items()}
-        print("Creating response blocks...")
-        output_blocks = conform_blocks_to_response(blocks, output_booleans)
-        matches = pd.read_csv(
-            r"datasets\testset15-Zylbercweig-Laski\transliterated_em.csv",
-            sep="\t",
-            header=0,
-        )
-        precision = calculate_precision(output_blocks, matches)
-        recall = calculate_recall_better(output_blocks, matches)
-        f1 = 0
-        if (precision + recall) != 0:
-            f1 = 2 * (precision * recall) / (precision + recall)
-        print(f"Precision: {precision}\nRecall: {recall}\nF1: {f1}")
+    print("Retrieving blocks...")
+    blocks = load_blocks(r"app\blocks.blocks").to_dict(list)
+    print("Creating response blocks...")
+    output_blocks = conform_blocks_to_response(blocks, output_booleans)
+    matches = pd.read_csv(
+        r"datasets\testset15-Zylbercweig-Laski\transliterated_em.csv",
+        sep="\t",
+        header=0,
+    )
+    evaluation = match_evaluator(matches).evaluate(output_blocks)
+    print(
+        f"Precision: {evaluation['precision']}\nRecall: {evaluation['recall']}\nF1: {evaluation['f1']}"
+    )
 
 
 def test_with_name_pairs(write_new_filtered_blocks_file=False):
@@ -145,22 +152,13 @@ def test_with_name_pairs(write_new_filtered_blocks_file=False):
         sep="\t",
         header=0,
     )
-    precision = calculate_precision(output_blocks, matches)
-    recall = calculate_recall_better(output_blocks, matches)
-    f1 = 0
-    fB = 0
-    if (precision + recall) != 0:
-        f1 = 2 * (precision * recall) / (precision + recall)
-        B = 5
-        # NOTE replace B with something else if you want recall to be considered more or less important
-        # fB = ((1 + B**2) * precision * recall) / (B**2 * precision) + recall
-        fB = (1 + B**2) / ((B**2 * recall**-1) + precision**-1)
-    print(f"Precision: {precision}\nRecall: {recall}\nF1: {f1}\nF{B}: {fB}")
+    # NOTE replace B with something else if you want recall to be considered more or less important
+    evaluation = match_evaluator(matches).evaluate(output_blocks, B=5)
+    print(format_evaluation(evaluation, precise=True))
     write_missed_matches(output_blocks, matches)
     if write_new_filtered_blocks_file:
-        print(r"Overwriting app\filtered_blocks.json...")
-        with open(r"app\filtered_blocks.json", "w") as file:
-            json.dump(output_blocks, file)
+        print(r"Overwriting app\filtered_blocks.blocks...")
+        save_blocks(output_blocks, r"app\filtered_blocks.blocks")
 
 
 def test_with_name_pairs_new(array):
@@ -178,17 +176,9 @@ def test_with_name_pairs_new(array):
         if not i in array:
             print(f"added {i} since no suitable queries were found")
             output_blocks.update({i: []})
-    precision = calculate_precision(output_blocks, matches)
-    recall = calculate_recall_better(output_blocks, matches)
-    f1 = 0
-    fB = 0
-    B = 5
     # NOTE replace B with something else if you want recall to be considered more or less important
-    if (precision + recall) != 0:
-        f1 = 2 * (precision * recall) / (precision + recall)
-        # fB = ((1 + B**2) * precision * recall) / (B**2 * precision) + recall
-        fB = (1 + B**2) / ((B**2 * recall**-1) + precision**-1)
-    return f"Precision: {precision:.4f}\nRecall: {recall:.4f}\nF1: {f1:.4f}\nF{B}: {fB:.4f}"
+    evaluation = match_evaluator(matches).evaluate(output_blocks, B=5)
+    return format_evaluation(evaluation)
 
 
 def create_blocks_from_output_pairs_new(array):
@@ -231,17 +221,9 @@ def test_with_name_pairs_new(array):
         if not i in array:
             print(f"added {i} since no suitable queries were found")
             output_blocks.update({i:[]})
-    precision = calculate_precision(output_blocks, matches)
-    recall = calculate_recall_better(output_blocks, matches)
-    f1 = 0
-    fB = 0
-    if (precision + recall) != 0:
-        f1 = 2 * (precision * recall) / (precision + recall)
-        B = 5
-        # NOTE replace B with something else if you want recall to be considered more or less important
-        # fB = ((1 + B**2) * precision * recall) / (B**2 * precision) + recall
-        fB = (1 + B**2) / ((B**2 * recall**-1) + precision**-1)
-    return f"Precision: {precision:.4f}\nRecall: {recall:.4f}\nF1: {f1:.4f}\nF{B}: {fB:.4f}"
+    # NOTE replace B with something else if you want recall to be considered more or less important
+    evaluation = match_evaluator(matches).evaluate(output_blocks, B=5)
+    return format_evaluation(evaluation)
 
 
 def create_blocks_from_output_pairs_new(array):
@@ -336,16 +318,9 @@ def update_blocks_with_list_names(
             sep="\t",
             header=0,
         )
-        precision = calculate_precision(new_blocks, matches)
-        recall = calculate_recall_better(new_blocks, matches)
-        f1 = 0
-        fB = 0
-        B = 5
         # NOTE replace B with something else if you want recall to be considered more or less important
-        if (precision + recall) != 0:
-            f1 = 2 * (precision * recall) / (precision + recall)
-            fB = (1 + B**2) / ((B**2 * recall**-1) + precision**-1)
-        print(f"Precision: {precision}\nRecall: {recall}\nF1: {f1}\nF{B}: {fB}")
+        evaluation = match_evaluator(matches).evaluate(new_blocks, B=5)
+        print(format_evaluation(evaluation, precise=True))
 
         # if each key maps to zero or one record, then we're ready for pairwise comparisons and should tell the user
         if len(
@@ -4,6 +4,7 @@ import json
 import pandas as pd
 from datetime import datetime
 from textFiltering import create_match_blocks
+from comparisonBlocks import iter_pairs, load_blocks
 
 # template
 # {"custom_id": "request-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "system", "content": "You are a helpful assistant."},{"role": "user", "content": "Hello world!"}],"max_tokens": 1000}}
@@ -137,7 +138,7 @@ def prepare_batch_file_filter_lists(
 
     with open(filepath, "w", encoding="utf-8") as file:
         # make a copy of the blocks to avoid modifying the original blocks later
-        new_blocks = blocks.copy()
+        new_blocks = dict(blocks)
         for record in blocks:
             # create sub-blocks to extract names from
             block = blocks[record]
@@ -210,50 +211,49 @@ def prepare_batch_file_individual_pairs(
         time.sleep(1)
 
     with open(filepath, "w", encoding="utf-8") as file:
-        for record in blocks:
-            for possible_match in blocks[record]:
-                try:
-                    print(
-                        f"Writing request for pair {record}#{possible_match}     ",
-                        end="\r",
-                    )
-                    request = {
-                        "custom_id": f"{record}#{possible_match}",
-                        "method": "POST",
-                        "url": "/v1/chat/completions",
-                        "body": {
-                            "model": model,
-                            "messages": [
-                                {
-                                    "role": "developer",
-                                    "content": f'You are a name classification expert, well versed in the form, structure and composition of names in Jewish History. You will be given the phonetic encodings of the parts of two names. The encodings may vary between the names even if they refer to the same person, but they should sound similar if they do. Your task is to determine if the names refer to the same person and respond with "True" if they do and "False" otherwise.',
-                                    # You are a name classification expert, well versed in the form, structure and composition of names in Jewish History.
-                                    # so the spelling may vary between the source and the target, but they should sound similar.
-                                },
-                                {
-                                    "role": "user",
-                                    "content": f"First name: {column_name_parts_to_string(blocks_df.iloc[possible_match], [x for x in blocks_df.columns if x.endswith("_phoneme")])}",
-                                    # blocks_df.iloc[possible_match]["title"]
-                                    # blocks_df.iloc[possible_match]["phoneme"]
-                                    # ; Name parts: {name_parts_to_string(json.loads(blocks_df.iloc[possible_match]["name_parts"]))}
-                                    # ; Name parts: {column_name_parts_to_string(blocks_df.iloc[possible_match], [x for x in blocks_df.columns if x.endswith("_phoneme")])}
-                                },
-                                {
-                                    "role": "user",
-                                    "content": f"Second name: {column_name_parts_to_string(df.iloc[record], [x for x in df.columns if x.endswith("_phoneme")])}",
-                                    # df.iloc[record]["phoneme"]
-                                    # df.iloc[record]["title"]
-                                    # ; Name parts: {name_parts_to_string(json.loads(df.iloc[record]["name_parts"]))}
-                                    # ; Name parts: {column_name_parts_to_string(df.iloc[record], [x for x in df.columns if x.endswith("_phoneme")])}
-                                },
-                            ],
-                            "max_tokens": max_tokens_per_request,
-                        },
-                    }
-                    request_string = json.dumps(request)
-                    file.write(request_string + "\n")
-                except json.JSONDecodeError:
-                    continue
+        for record, possible_match in iter_pairs(blocks):
+            try:
+                print(
+                    f"Writing request for pair {record}#{possible_match}     ",
+                    end="\r",
+                )
+                request = {
+                    "custom_id": f"{record}#{possible_match}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "messages": [
+                            {
+                                "role": "developer",
+                                "content": f'You are a name classification expert, well versed in the form, structure and composition of names in Jewish History. You will be given the phonetic encodings of the parts of two names. The encodings may vary between the names even if they refer to the same person, but they should sound similar if they do. Your task is to determine if the names refer to the same person and respond with "True" if they do and "False" otherwise.',
+                                # You are a name classification expert, well versed in the form, structure and composition of names in Jewish History.
+                                # so the spelling may vary between the source and the target, but they should sound similar.
+                            },
+                            {
+                                "role": "user",
+                                "content": f"First name: {column_name_parts_to_string(blocks_df.iloc[possible_match], [x for x in blocks_df.columns if x.endswith("_phoneme")])}",
+                                # blocks_df.iloc[possible_match]["title"]
+                                # blocks_df.iloc[possible_match]["phoneme"]
+                                # ; Name parts: {name_parts_to_string(json.loads(blocks_df.iloc[possible_match]["name_parts"]))}
+                                # ; Name parts: {column_name_parts_to_string(blocks_df.iloc[possible_match], [x for x in blocks_df.columns if x.endswith("_phoneme")])}
+                            },
+                            {
+                                "role": "user",
+                                "content": f"Second name: {column_name_parts_to_string(df.iloc[record], [x for x in df.columns if x.endswith("_phoneme")])}",
+                                # df.iloc[record]["phoneme"]
+                                # df.iloc[record]["title"]
+                                # ; Name parts: {name_parts_to_string(json.loads(df.iloc[record]["name_parts"]))}
+                                # ; Name parts: {column_name_parts_to_string(df.iloc[record], [x for x in df.columns if x.endswith("_phoneme")])}
+                            },
+                        ],
+                        "max_tokens": max_tokens_per_request,
+                    },
+                }
+                request_string = json.dumps(request)
+                file.write(request_string + "\n")
+            except json.JSONDecodeError:
+                continue
         update_history(f"New batch file written at {filepath}")
         print("\n")
         print("Writing complete.")
@@ -361,11 +361,9 @@ if __name__ == "__main__":
         header=0,
     )
     blocks = {}
-    with open(r"app\filtered_blocks.json") as file:
-        print("Retrieving blocks...")
-        blocks = json.load(file)
-        # NOTE outside of textFiltering, blocks are lists, not sets!
-        blocks = {int(k): list(v) for k, v in blocks.items()}
+    print("Retrieving blocks...")
+    # NOTE outside of textFiltering, blocks are lists, not sets!
+    blocks = load_blocks(r"app\filtered_blocks.blocks").to_dict(list)
 
     # FIXME for testing only!
     # blocks = create_match_blocks(
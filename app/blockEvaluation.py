@@ -0,0 +1,113 @@
+import numpy as np
+
+try:
+    from .comparisonBlocks import ComparisonBlocks, count_pairs, pair_keys, sorted_unique
+except ImportError:
+    # NOTE when imported from the app folder (like the other modules do), the app folder is on the path instead of the app package
+    from comparisonBlocks import ComparisonBlocks, count_pairs, pair_keys, sorted_unique
+
+
+class BlockEvaluator:
+    # evaluates comparison blocks (a dictionary or ComparisonBlocks, where record IDs from df2 map to record IDs from df1) against a dataset
+    # of confirmed matches between df1 and df2. The matches are turned into sorted pair keys (see pair_keys) once, so evaluating blocks
+    # is only a binary search of the matches in the pairs of the blocks, instead of a loop over every match for every metric.
+    # Get it with match_evaluator, which makes sure it's only made once for the same matches
+    def __init__(self, matches, keys_column="index_LASKI", values_column="index_roman"):
+        # FIXME hardcoded column names isn't the greatest
+        # NOTE recall is found matches / number of rows in matches, like calculate_recall_better has always done, even if a match is in there twice
+        self.total_matches = len(matches)
+        self.match_keys = sorted_unique(
+            pair_keys(matches[keys_column].to_numpy(), matches[values_column].to_numpy())
+        )
+        self.match_records = (self.match_keys >> 32).astype(np.int64)
+        self.match_candidates = (self.match_keys & 0xFFFFFFFF).astype(np.int64)
+        self.matches = matches
+
+    def found(self, blocks):
+        # for every (distinct) match, whether it's in the blocks. A record that has no block finds none of its matches
+        if not isinstance(blocks, ComparisonBlocks):
+            # only the blocks of records that have a match matter, so the rest of a (possibly huge) dictionary isn't converted
+            blocks = ComparisonBlocks.from_dict(
+                {
+                    record: blocks[record]
+                    for record in sorted_unique(self.match_records).tolist()
+                    if record in blocks
+                }
+            )
+        # NOTE the pair keys of ComparisonBlocks are already sorted and unique
+        block_keys = pair_keys(*blocks.pair_arrays())
+        positions = np.searchsorted(block_keys, self.match_keys)
+        found = np.zeros(len(self.match_keys), dtype=bool)
+        in_range = positions < len(block_keys)
+        found[in_range] = block_keys[positions[in_range]] == self.match_keys[in_range]
+        return found
+
+    def evaluate(self, blocks, df1=None, df2=None, B=5):
+        # recall, precision, F1 and F-beta (with beta = B) of the blocks, and the reduction ratio if the datasets df1 and df2 are given,
+        # as a dictionary that also has the counts they were calculated from
+        found_matches = int(self.found(blocks).sum())
+        possible_matches = count_pairs(blocks)
+        recall = found_matches / self.total_matches if self.total_matches else 0
+        precision = found_matches / possible_matches if possible_matches else 0
+        evaluation = {
+            "recall": recall,
+            "precision": precision,
+            "f1": f_measure(precision, recall, 1),
+            "fB": f_measure(precision, recall, B),
+            "B": B,
+            "found_matches": found_matches,
+            "total_matches": self.total_matches,
+            "missed_matches": len(self.match_keys) - found_matches,
+            "possible_matches": possible_matches,
+        }
+        if df1 is not None and df2 is not None:
+            brute_force_comparisons = len(df1) * len(df2)
+            evaluation.update(
+                {
+                    "reduction_ratio": 1 - (possible_matches / brute_force_comparisons),
+                    "brute_force_comparisons": brute_force_comparisons,
+                }
+            )
+        return evaluation
+
+    def missed_matches(self, blocks):
+        # blocks consisting of the matches that are not present in the blocks
+        missed = ~self.found(blocks)
+        return pairs_to_blocks(self.match_records[missed], self.match_candidates[missed])
+
+    def match_blocks(self):
+        # the smallest possible blocks that contain all matches
+        return pairs_to_blocks(self.match_records, self.match_candidates)
+
+
+def pairs_to_blocks(records, candidates):
+    # a dictionary that maps every record to the set of its candidates, for sorted pairs
+    records = records.tolist()
+    candidates = candidates.tolist()
+    blocks = {}
+    for record, candidate in zip(records, candidates):
+        blocks.setdefault(record, set()).add(candidate)
+    return blocks
+
+
+def f_measure(precision, recall, B=1):
+    # the weighted harmonic mean of precision and recall: B > 1 makes recall more important, B < 1 precision
+    if precision == 0 or recall == 0:
+        return 0
+    return (1 + B**2) * precision * recall / (B**2 * precision + recall)
+
+
+# the evaluators that were made last, so calculating several metrics for the same matches only converts them once
+match_evaluators = []
+MATCH_EVALUATORS_KEPT = 4
+
+
+def match_evaluator(matches):
+    # the BlockEvaluator of matches: one that was already made for the same dataframe, or a new one
+    for evaluator in match_evaluators:
+        if evaluator.matches is matches:
+            return evaluator
+    evaluator = BlockEvaluator(matches)
+    match_evaluators.insert(0, evaluator)
+    del match_evaluators[MATCH_EVALUATORS_KEPT:]
+    return evaluator
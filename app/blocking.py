@@ -1,69 +1,389 @@
+from array import array
 from datetime import datetime
 import json
+import numpy as np
 import pandas as pd
 from wikidataPostProcessing import getWikidataDf
-from textFiltering import (
-    calculate_recall_better,
-    calculate_reduction_ratio,
-    create_phonetic_name_parts,
-)
+from textFiltering import create_phonetic_name_parts
+from blockEvaluation import match_evaluator
 from ipapy import is_valid_ipa
 from ipapy import UNICODE_TO_IPA
 from ipapy.ipachar import IPAConsonant
 from itertools import combinations
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import pickle
+import zlib
+from namePartStore import name_part_store
+from comparisonBlocks import (
+    ComparisonBlocks,
+    ComparisonBlocksBuilder,
+    intersect_comparison_blocks,
+    pair_keys,
+    save_blocks,
+    sorted_unique,
+)
+
+
+class InvertedIndex:
+    # maps block labels to postings lists of the indexes of the records with that label.
+    # The postings lists are append-only arrays of 64-bit integers, so adding a record never copies a postings list,
+    # and finalize turns them into sorted NumPy arrays once all records have been added
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, record, labels):
+        # add a single record to the postings lists of all its labels
+        for label in labels:
+            postings = self.postings.get(label)
+            if postings is None:
+                postings = array("q")
+                self.postings[label] = postings
+            postings.append(record)
+
+    def add_many(self, records, labels):
+        # add many (record, label) pairs at once, given as two sequences of the same length.
+        # Each postings list is only extended once, no matter how many of the pairs have its label
+        records = np.asarray(records, dtype=np.int64)
+        codes, uniques = pd.factorize(pd.Series(labels, dtype=object), sort=False)
+        # NOTE pd.factorize gives missing labels the code -1, so they are dropped here
+        order = np.argsort(codes, kind="stable")
+        order = order[codes[order] >= 0]
+        boundaries = np.cumsum(np.bincount(codes[order], minlength=len(uniques)))
+        start = 0
+        for label, stop in zip(uniques, boundaries):
+            postings = self.postings.get(label)
+            if postings is None:
+                postings = array("q")
+                self.postings[label] = postings
+            postings.frombytes(records[order[start:stop]].tobytes())
+            start = stop
+
+    def finalize(self):
+        # return a dictionary that maps every label to a sorted NumPy array of the records with that label
+        return {
+            label: np.sort(np.frombuffer(postings, dtype=np.int64))
+            for label, postings in self.postings.items()
+        }
 
 
 def block_dataframe(df, callable):
     # given a dataframe and a callable that returns a list of block labels when given a pd.Series representing a row,
-    # create a dictionary that maps block labels to a list of indexes of the records in those blocks
-    blocks = {}
-    for index, row in df.iterrows():
-        print(f"Finding blocks for record {index} ", end="\r")
-        assert df.iloc[index].equals(row)
-        labels = callable(row)
-        for label in labels:
-            blocks.update({label: blocks.get(label, list()) + [index]})
-    print("")
-    return blocks
+    # create a dictionary that maps block labels to a sorted NumPy array of indexes of the records in those blocks.
+    # If the callable has a label_column attribute (see column_labeler), all rows are labeled at once instead of one at a time
+    # NOTE the indexes of the records must be their positions in df, since that's how the blocks are used later
+    assert df.index.equals(pd.RangeIndex(len(df)))
+    index = InvertedIndex()
+    label_column = getattr(callable, "label_column", None)
+    if label_column is not None:
+        print(f"Finding blocks for {len(df)} records")
+        labels = label_column(df).explode()
+        index.add_many(labels.index, labels.values)
+    else:
+        for record, row in df.iterrows():
+            if record % 1000 == 0:
+                print(f"Finding blocks for record {record} ", end="\r")
+            index.add(record, callable(row))
+        print("")
+    return index.finalize()
 
 
 def create_pairwise_comparison_blocks(
-    dict_1, dict_2, is_same_df=False, ignore_lables=["None"]
+    dict_1, dict_2, is_same_df=False, ignore_lables=["None"], as_csr=False
 ):
     # given dictionaries produced by block_dataframe, create blocks in the following format:
     # A record from dict_1 maps to a set of the records from dict_2 it shares at least one block label with.
     # If is_same_df is set to True, records will not map to themselves.
-    # ignore_lables is optional and contains a list of labels for which no pairwise comparisons should be created
-    comparison_blocks = {}
+    # ignore_lables is optional and contains a list of labels for which no pairwise comparisons should be created.
+    # If as_csr is True, the blocks are returned as ComparisonBlocks instead of a dictionary of sets
+
+    # records with the same labels get the same block, so first we find the labels of every record,
+    # and then we only create one block for each distinct set of labels
+    record_labels = {}
     for label in dict_1:
-        print(f'Creating comparison blocks from block "{label}"          ', end="\n")
-        if label in ignore_lables:
+        print(f'Finding records in block "{label}"          ', end="\r")
+        # NOTE even if the label should be ignored, we make sure the records there have a block to prevent errors later
+        has_comparisons = label not in ignore_lables and label in dict_2
+        for record in np.asarray(dict_1[label]).tolist():
+            labels = record_labels.setdefault(record, [])
+            if has_comparisons:
+                labels.append(label)
+    print("")
+
+    records = sorted(record_labels)
+    size_2 = max((int(np.max(block)) + 1 for block in dict_2.values() if len(block) > 0), default=0)
+    return comparison_blocks_by_group(
+        records,
+        [tuple(record_labels[record]) for record in records],
+        lambda label_set: union_of_blocks([dict_2[label] for label in label_set], size_2),
+        is_same_df,
+        as_csr,
+    )
+
+
+def comparison_blocks_by_group(records, groups, group_block, is_same_df=False, as_csr=False):
+    # create comparison blocks for records (sorted) where groups[i] is a hashable key for records[i] and group_block(key) returns
+    # the sorted array of records in the block of every record with that key, so each block is only created once per key.
+    # If is_same_df is set to True, records will not map to themselves
+    group_blocks = {}
+    indices = []
+    for record, group in zip(records, groups):
+        print(f"Creating comparison block for record {record}    ", end="\r")
+        block = group_blocks.get(group)
+        if block is None:
+            block = group_block(group)
+            group_blocks.update({group: block})
+        if is_same_df:
+            # NOTE if the dicts come from the same place, then we don't want to waste time matching records with themselves
+            position = np.searchsorted(block, record)
+            if position < len(block) and block[position] == record:
+                block = np.delete(block, position)
+        indices.append(block)
+    print("")
+
+    sizes = np.fromiter((len(block) for block in indices), dtype=np.int64, count=len(indices))
+    comparison_blocks = ComparisonBlocks(
+        list(records),
+        np.concatenate([[0], np.cumsum(sizes)]),
+        np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+    )
+    if as_csr:
+        return comparison_blocks
+    return comparison_blocks.to_dict()
+
+
+def union_of_blocks(blocks, size):
+    # given a list of blocks (arrays of records less than size), return a sorted array of the records that are in at least one of them
+    total = sum(len(block) for block in blocks)
+    if total == 0:
+        return np.empty(0, dtype=np.int32)
+    if total * 8 < size:
+        # for small blocks, sorting is cheaper than going through a mask of all the records
+        return sorted_unique(np.concatenate(blocks)).astype(np.int32)
+    mask = np.zeros(size, dtype=bool)
+    for block in blocks:
+        mask[block] = True
+    return np.flatnonzero(mask).astype(np.int32)
+
+
+def meta_blocking(
+    dicts_1,
+    dicts_2,
+    weighting="arcs",
+    top_k=None,
+    min_weight=None,
+    max_block_comparisons=None,
+    is_same_df=False,
+    ignore_lables=["None"],
+    as_csr=False,
+):
+    # an alternative to create_pairwise_comparison_blocks that weighs how strongly two records are connected by their blocks
+    # and only keeps the strongest connections of every record. dicts_1 and dicts_2 are dictionaries produced by block_dataframe,
+    # or lists of them (one for every labeler, in the same order in both lists) to combine several labelers.
+    # First, blocks with more than max_block_comparisons pairwise comparisons are thrown away (if it's given).
+    # Then every pair of records that share a block gets a weight:
+    #   "cbs": the number of blocks they share
+    #   "arcs": the sum of 1 / (the number of comparisons in the block) for the blocks they share, so small blocks count more
+    #   "jaccard": the number of blocks they share divided by the number of blocks either of them is in
+    # and for every record from dicts_1, only the pairs with at least min_weight are kept, and of those only the top_k pairs with the highest weights
+    # (if both are given, the threshold is applied first). If neither is given, the pairs with at least the average weight of the record's pairs are kept.
+    # The blocks are returned in the same format as create_pairwise_comparison_blocks
+    if isinstance(dicts_1, dict):
+        dicts_1, dicts_2 = [dicts_1], [dicts_2]
+    records = set()
+    blocks = []
+    for dict_1, dict_2 in zip(dicts_1, dicts_2):
+        for label in dict_1:
+            block_1 = np.asarray(dict_1[label], dtype=np.int64)
             # NOTE even if the label should be ignored, we make sure the records there have a block to prevent errors later
-            for record in dict_1[label]:
-                comparison_blocks.update({record: comparison_blocks.get(record, set())})
+            records.update(block_1.tolist())
+            if label in ignore_lables or label not in dict_2:
+                continue
+            block_2 = np.asarray(dict_2[label], dtype=np.int32)
+            comparisons = len(block_1) * len(block_2)
+            if max_block_comparisons is not None and comparisons > max_block_comparisons:
+                continue
+            blocks.append((block_1, block_2))
+    records = sorted(records)
+    print(f"Weighing the comparisons of {len(blocks)} blocks")
+
+    # the blocks of every record and the number of blocks of the records they're compared to
+    record_blocks = {record: [] for record in records}
+    for i, (block_1, _) in enumerate(blocks):
+        for record in block_1.tolist():
+            record_blocks[record].append(i)
+    size_2 = max((int(np.max(block_2)) + 1 for _, block_2 in blocks if len(block_2) > 0), default=0)
+    block_counts_2 = np.zeros(size_2, dtype=np.int64)
+    for _, block_2 in blocks:
+        block_counts_2[block_2] += 1
+
+    def weighted_comparisons(block_ids):
+        # the records that share at least one of the blocks with the given ids (sorted), and their weights
+        if len(block_ids) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+        candidates = np.concatenate([blocks[i][1] for i in block_ids])
+        if weighting == "arcs":
+            weights = np.concatenate(
+                [np.full(len(blocks[i][1]), 1 / (len(blocks[i][0]) * len(blocks[i][1]))) for i in block_ids]
+            )
         else:
-            for record in dict_1[label]:
-                comparison_blocks.update(
-                    {
-                        record: comparison_blocks.get(record, set()).union(
-                            set(dict_2.get(label, list()))
-                        )
-                    }
-                )
+            weights = np.ones(len(candidates))
+        order = np.argsort(candidates, kind="stable")
+        candidates = candidates[order]
+        starts = np.flatnonzero(np.concatenate([[True], candidates[1:] != candidates[:-1]]))
+        weights = np.add.reduceat(weights[order], starts)
+        candidates = candidates[starts]
+        if weighting == "jaccard":
+            weights = weights / (len(block_ids) + block_counts_2[candidates] - weights)
+        return candidates, weights
+
+    # records with the same blocks have the same weighted comparisons, so they're only weighed once
+    group_comparisons = {}
+    indices = []
+    for record in records:
+        print(f"Pruning comparisons of record {record}    ", end="\r")
+        group = tuple(record_blocks[record])
+        comparisons = group_comparisons.get(group)
+        if comparisons is None:
+            comparisons = weighted_comparisons(group)
+            group_comparisons.update({group: comparisons})
+        candidates, weights = comparisons
+        if is_same_df:
+            # NOTE records are not compared with themselves
+            others = candidates != record
+            candidates, weights = candidates[others], weights[others]
+        if min_weight is not None:
+            strong = weights >= min_weight
+            candidates, weights = candidates[strong], weights[strong]
+        if top_k is not None:
+            if len(candidates) > top_k:
+                strongest = np.sort(np.argpartition(-weights, top_k - 1)[:top_k])
+                candidates = candidates[strongest]
+        elif min_weight is None and len(candidates) > 0:
+            candidates = candidates[weights >= weights.mean()]
+        indices.append(candidates)
     print("")
-    if is_same_df:
-        # NOTE if the dicts come from the same place, then we don't want to waste time matching records with themselves
-        for record in comparison_blocks:
-            print(f"Cleaning comparison block {record}    ", end="\r")
-            comparison_blocks[record].discard(record)
-        print("")
-    return comparison_blocks
+
+    sizes = np.fromiter((len(block) for block in indices), dtype=np.int64, count=len(indices))
+    comparison_blocks = ComparisonBlocks(
+        records,
+        np.concatenate([[0], np.cumsum(sizes)]),
+        np.concatenate(indices) if indices else np.empty(0, dtype=np.int32),
+    )
+    if as_csr:
+        return comparison_blocks
+    return comparison_blocks.to_dict()
+
+
+def sorted_neighbourhood_blocks(
+    df1, df2, keys, window=10, is_same_df=False, as_csr=False
+):
+    # an alternative to block_dataframe and create_pairwise_comparison_blocks that doesn't need block labels:
+    # the records of both dataframes are sorted together by a key, and every record from df1 is compared to the records from df2
+    # that are less than window positions away from it. keys is a list of passes, each with its own key, and the pairs of all passes are combined.
+    # A key is a column name (e.g. "phoneme" or "name_part_surname_phoneme"), a list of column names to sort by one after another,
+    # or a function that takes a dataframe and returns a pd.Series of sortable values with the same index.
+    # Records with a missing key are left out of that pass. The blocks are returned in the same format as create_pairwise_comparison_blocks
+    builder = ComparisonBlocksBuilder()
+    # NOTE every record from df1 gets a block, even if it doesn't have any neighbours
+    builder.add_records(np.arange(len(df1)))
+    for key in keys:
+        print(f"Sorted neighbourhood pass with key {getattr(key, "__name__", key)}")
+        if is_same_df:
+            values = sorted_neighbourhood_key(df1, key)
+            sources = np.zeros(len(df1), dtype=np.int8)
+            records = np.arange(len(df1))
+        else:
+            values = pd.concat(
+                [sorted_neighbourhood_key(df1, key), sorted_neighbourhood_key(df2, key)],
+                ignore_index=True,
+            )
+            sources = np.repeat(np.array([0, 1], dtype=np.int8), [len(df1), len(df2)])
+            records = np.concatenate([np.arange(len(df1)), np.arange(len(df2))])
+        present = values.notna().to_numpy()
+        codes, _ = pd.factorize(values[present], sort=True)
+        # ties are broken by dataset and then by record, so the order doesn't depend on the order of the rows
+        order = np.lexsort((records[present], sources[present], codes))
+        sources = sources[present][order]
+        records = records[present][order]
+
+        for distance in range(1, window):
+            if distance >= len(records):
+                break
+            before, after = records[:-distance], records[distance:]
+            if is_same_df:
+                builder.add_pairs(before, after)
+                builder.add_pairs(after, before)
+            else:
+                forward = (sources[:-distance] == 0) & (sources[distance:] == 1)
+                builder.add_pairs(before[forward], after[forward])
+                backward = (sources[:-distance] == 1) & (sources[distance:] == 0)
+                builder.add_pairs(after[backward], before[backward])
+
+    comparison_blocks = builder.build(discard_self_pairs=is_same_df)
+    if as_csr:
+        return comparison_blocks
+    return comparison_blocks.to_dict()
+
+
+def sorted_neighbourhood_key(df, key):
+    if callable(key):
+        return key(df).reset_index(drop=True)
+    if isinstance(key, str):
+        return df[key].reset_index(drop=True)
+    # sort by the first column, then the second and so on. The separator sorts before any character in a name
+    # NOTE it can't be "\x00", since pandas hashes strings only up to the first "\x00", so pd.factorize would give different keys the same code
+    columns = df[list(key)].astype(str).where(df[list(key)].notna(), "")
+    return columns.agg("\x01".join, axis=1).reset_index(drop=True)
+
+
+# the number of distinct values the labelers that work on one row at a time remember the parsed form of
+PARSED_VALUES_KEPT = 2**16
+
+
+@lru_cache(maxsize=PARSED_VALUES_KEPT)
+def parse_name_parts(name_parts):
+    # parse the json of a name_parts value, or return None if it isn't valid json.
+    # Only used when labeling one row at a time: labelers that label a whole dataframe read the name parts from its NamePartStore instead.
+    # NOTE the dictionary is shared, so don't change it
+    try:
+        return json.loads(name_parts)
+    except (json.JSONDecodeError, TypeError):
+        # NOTE missing values aren't strings, so json.loads raises a TypeError for them
+        return None
 
 
 # ANCHOR the functions defined below are all callables for use by block_dataframe.
 # They should all return iterables and their input should always be a pd.Series.
+# Callables decorated with column_labeler can also label an entire pd.DataFrame at once.
 
 
+def column_labeler(label_column):
+    # decorator that lets block_dataframe label all rows of a dataframe at once with label_column,
+    # which must take a pd.DataFrame and return a pd.Series with an iterable of labels for each row (with the same index as the dataframe)
+    def decorator(callable):
+        callable.label_column = label_column
+        return callable
+
+    return decorator
+
+
+def label_unique_values(df, column, callable):
+    # label only the unique values of a column and map the labels back to the rows,
+    # for callables that only use a single column whose values are often repeated
+    codes, uniques = pd.factorize(df[column], use_na_sentinel=False)
+    _, first_positions = np.unique(codes, return_index=True)
+    # NOTE only the column is given to the callable, since getting a row of a wide dataframe is slow
+    rows = df[[column]]
+    unique_labels = [callable(rows.iloc[position]) for position in first_positions]
+    return pd.Series([unique_labels[code] for code in codes], index=df.index)
+
+
+@column_labeler(
+    lambda df: pd.Series(
+        np.where(df["title"].str.len() % 2 == 1, "odd", "even"), index=df.index
+    ).map(lambda label: [label])
+)
 def example_callable(row):
     # return odd or even depending on the length of the title
     title = row["title"]
@@ -73,27 +393,55 @@ def example_callable(row):
         return ["even"]
 
 
+@column_labeler(
+    lambda df: pd.Series([["singleton_block"]] * len(df), index=df.index)
+)
 def no_distinguishing(row):
     # return the same label no matter what. The same as not blocking at all
     return ["singleton_block"]
 
 
+def name_part_types(df):
+    # the labels of name_part_presence for every row of df, read from the NamePartStore of df instead of decoding the json again
+    store = name_part_store(df)
+    offsets = store.offsets.tolist()
+    labels = []
+    for position in store.positions.get_indexer(df.index).tolist():
+        start, stop = offsets[position], offsets[position + 1]
+        if store.valid[position] and stop > start:
+            labels.append([store.types[part_type] for part_type in store.part_types[start:stop].tolist()])
+        else:
+            labels.append(["None"])
+    return pd.Series(labels, index=df.index)
+
+
+@column_labeler(name_part_types)
 def name_part_presence(row):
     # return the types of name parts the name has, or "None" if it has none
-    try:
-        name_parts = json.loads(row["name_parts"]).keys()
-        if len(name_parts) > 0:
-            return name_parts
-        else:
-            return ["None"]
-    except json.JSONDecodeError:
+    name_parts = parse_name_parts(row["name_parts"])
+    if not isinstance(name_parts, dict):
+        return ["None"]
+    # NOTE parts that aren't strings aren't name parts, like in the NamePartStore
+    part_types = [part_type for part_type, part in name_parts.items() if isinstance(part, str)]
+    if len(part_types) > 0:
+        return part_types
+    else:
         return ["None"]
 
 
+@column_labeler(
+    lambda df: label_unique_values(df, "phoneme", phonetic_consonant_presence)
+)
 def phonetic_consonant_presence(row):
     # return the IPA characters the row's phonetic encoding contains.
     # Requires ipapy to be installed! Install it with "pip install ipapy".
-    phoneme = str(row["phoneme"])
+    return list(phoneme_consonants(str(row["phoneme"])))
+
+
+@lru_cache(maxsize=PARSED_VALUES_KEPT)
+def phoneme_consonants(phoneme):
+    # the IPA consonants of a phonetic encoding (or "None" if there are none) as a tuple.
+    # Recently used phonemes aren't parsed again, no matter how many rows or labelers use them
     labels = set()
     if not is_valid_ipa(phoneme):
         # FIXME find out how to handle * in phonetic encodings so we don't have to throw it out
@@ -119,9 +467,16 @@ def phonetic_consonant_presence(row):
         labels = labels.union({ipa})
     if len(labels) < 1:
         labels = ["None"]
-    return list(labels)
+    return tuple(labels)
+
+
+def name_length_column(df, slack=1):
+    lengths = df["title"].str.len().to_numpy(dtype=np.int64)
+    offsets = np.arange(-slack, slack + 1)
+    return pd.Series(list((lengths[:, None] + offsets).tolist()), index=df.index)
 
 
+@column_labeler(name_length_column)
 def name_length(row, slack=1):
     title = row["title"]
     length = len(title)
@@ -133,21 +488,59 @@ def name_length(row, slack=1):
     return labels
 
 
+def name_part_lengths(df):
+    # the lengths of the name parts of every row of df as a tuple (or None if its name parts couldn't be decoded),
+    # read from the NamePartStore of df instead of decoding the json again
+    store = name_part_store(df)
+    string_lengths = np.fromiter((len(string) for string in store.strings), dtype=np.int64, count=len(store.strings))
+    part_lengths = string_lengths[store.part_strings].tolist()
+    offsets = store.offsets.tolist()
+    valid = store.valid.tolist()
+    return [
+        tuple(part_lengths[offsets[position] : offsets[position + 1]]) if valid[position] else None
+        for position in store.positions.get_indexer(df.index).tolist()
+    ]
+
+
+def potential_name_length_column(df, slack=3):
+    # records whose name parts have the same lengths get the same labels, so they're only made once
+    unique_labels = {}
+    labels = []
+    for part_lengths in name_part_lengths(df):
+        record_labels = unique_labels.get(part_lengths)
+        if record_labels is None:
+            record_labels = ["None"] if part_lengths is None else potential_name_lengths(part_lengths, slack)
+            unique_labels.update({part_lengths: record_labels})
+        labels.append(record_labels)
+    return pd.Series(labels, index=df.index)
+
+
+@column_labeler(potential_name_length_column)
 def potential_name_length(row, slack=3):
-    try:
-        name_parts = json.loads(row["name_parts"])
-        part_lengths = [len(x) for x in name_parts.values()]
-        possible_lengths = []
-        for i in range(1, len(name_parts) + 1):
-            adjusted_slack = slack * i
-            for combination in combinations(part_lengths, i):
-                for j in range(-adjusted_slack, adjusted_slack + 1):
-                    possible_lengths.append(sum(combination) + j)
-        return possible_lengths
-    except json.JSONDecodeError:
+    name_parts = parse_name_parts(row["name_parts"])
+    if not isinstance(name_parts, dict):
         return ["None"]
+    return potential_name_lengths([len(x) for x in name_parts.values() if isinstance(x, str)], slack)
+
+
+def potential_name_lengths(part_lengths, slack=3):
+    # every total length of a combination of name parts, give or take slack per name part
+    possible_lengths = []
+    for i in range(1, len(part_lengths) + 1):
+        adjusted_slack = slack * i
+        for combination in combinations(part_lengths, i):
+            for j in range(-adjusted_slack, adjusted_slack + 1):
+                possible_lengths.append(sum(combination) + j)
+    return possible_lengths
     
 
+def age_blocking_column(df, slack=0):
+    ages = df["age"].to_numpy(dtype=np.int64)
+    offsets = np.arange(-slack, slack + 1)
+    return pd.Series(list((ages[:, None] + offsets).tolist()), index=df.index)
+
+
+@column_labeler(age_blocking_column)
 def age_blocking(row, slack=0):
     age = row["age"]
     labels = []
@@ -156,6 +549,439 @@ def age_blocking(row, slack=0):
     return labels
 
 
+def minhash_lsh(columns=["phoneme"], ngram_size=2, bands=32, rows=2, seed=0):
+    # create a callable that labels records by locality-sensitive hashing: the character n-grams of the given columns
+    # (e.g. "phoneme", "title" or "name_parts") get a MinHash signature of bands * rows values, and every band of rows values becomes a label.
+    # Two records share a label with a probability of about 1 - (1 - s**rows)**bands, where s is the Jaccard similarity of their n-grams,
+    # so more bands find more matches and more rows make smaller blocks. Records without any n-grams get the label "None"
+    return MinHashLabeler(columns, ngram_size, bands, rows, seed)
+
+
+class MinHashLabeler:
+    # the callable made by minhash_lsh. It's a class instead of a function so it can be sent to worker processes
+    def __init__(self, columns, ngram_size, bands, rows, seed):
+        self.columns = list(columns)
+        self.ngram_size = ngram_size
+        self.bands = bands
+        self.rows = rows
+        generator = np.random.default_rng(seed)
+        # every MinHash value uses its own hash function ((a * x + b) mod 2**64) >> 32, with a odd
+        self.a = generator.integers(0, 2**63, size=bands * rows, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = generator.integers(0, 2**63, size=bands * rows, dtype=np.uint64)
+
+    def labels(self, values):
+        return self.labels_of_texts([minhash_texts(column, value) for column, value in zip(self.columns, values)])
+
+    def labels_of_texts(self, column_texts):
+        # the labels of a record with the given list of texts for every column
+        ngrams = set()
+        for i, texts in enumerate(column_texts):
+            for text in texts:
+                text = f" {text} "
+                for j in range(max(1, len(text) - self.ngram_size + 1)):
+                    # NOTE n-grams of different columns are kept apart by the column number
+                    ngrams.add(zlib.crc32(f"{i}{text[j : j + self.ngram_size]}".encode()))
+        if len(ngrams) == 0:
+            return ["None"]
+        hashes = np.fromiter(ngrams, dtype=np.uint64, count=len(ngrams))
+        signature = ((hashes[:, None] * self.a + self.b) >> np.uint64(32)).min(axis=0)
+        return [
+            f"{band}:{zlib.crc32(signature[band * self.rows : (band + 1) * self.rows].tobytes())}"
+            for band in range(self.bands)
+        ]
+
+    def label_column(self, df):
+        # label only the unique combinations of values of the columns
+        codes, uniques = pd.MultiIndex.from_frame(df[self.columns]).factorize()
+        _, first_positions = np.unique(codes, return_index=True)
+        # NOTE the name parts are read from the NamePartStore of df instead of decoding the json again
+        store = name_part_store(df) if "name_parts" in self.columns else None
+        unique_labels = []
+        for values, position in zip(uniques, first_positions.tolist()):
+            column_texts = []
+            for column, value in zip(self.columns, values):
+                if column == "name_parts":
+                    column_texts.append(store.parts(df.index[position]) or [])
+                else:
+                    column_texts.append(minhash_texts(column, value))
+            unique_labels.append(self.labels_of_texts(column_texts))
+        return pd.Series([unique_labels[code] for code in codes], index=df.index)
+
+    def __call__(self, row):
+        return self.labels([row[column] for column in self.columns])
+
+
+def minhash_texts(column, value):
+    # the texts of a value that n-grams are made from: a single string, or the name parts of a name_parts column
+    if not isinstance(value, str):
+        return []
+    if column == "name_parts":
+        name_parts = parse_name_parts(value)
+        if not isinstance(name_parts, dict):
+            return []
+        return [part for part in name_parts.values() if isinstance(part, str)]
+    return [value]
+
+
+# ANCHOR interval joins.
+# Blockers like name_length and potential_name_length give every record a range of numbers as labels, so two records share a label
+# exactly when one of their ranges overlaps. Instead of creating every label, interval_join_blocks finds the overlapping ranges directly.
+# The functions below that end with _intervals turn a dataframe into ranges: three arrays of the same length (records, lows, highs),
+# where the record records[i] has the labels lows[i], lows[i] + 1, ..., highs[i]. A record can have any number of ranges.
+
+
+def interval_join_blocks(df1, df2, intervals, is_same_df=False, as_csr=False):
+    # create comparison blocks where a record from df1 is compared to every record from df2 that has an overlapping range,
+    # in the same format as create_pairwise_comparison_blocks. intervals is one of the _intervals functions below
+    # (use functools.partial to change its slack)
+    intervals_1 = intervals(df1)
+    records_2, lows_2, highs_2 = intervals_1 if is_same_df else intervals(df2)
+    # sort the ranges of df2 by where they start, so the ranges that start before the end of a range are a prefix
+    order = np.argsort(lows_2, kind="stable")
+    records_2, lows_2, highs_2 = records_2[order], lows_2[order], highs_2[order]
+    size_2 = len(df1) if is_same_df else len(df2)
+
+    overlapping = {}
+
+    def overlapping_records(low, high):
+        # the records from df2 with a range that overlaps low, low + 1, ..., high
+        records = overlapping.get((low, high))
+        if records is None:
+            end = np.searchsorted(lows_2, high, side="right")
+            records = records_2[:end][highs_2[:end] >= low]
+            overlapping.update({(low, high): records})
+        return records
+
+    # records with the same ranges get the same block, so we only join each distinct set of ranges once
+    record_intervals = [[] for _ in range(len(df1))]
+    for record, low, high in zip(*(array.tolist() for array in intervals_1)):
+        record_intervals[record].append((low, high))
+    return comparison_blocks_by_group(
+        range(len(df1)),
+        [tuple(intervals) for intervals in record_intervals],
+        lambda intervals: union_of_blocks(
+            [overlapping_records(low, high) for low, high in intervals], size_2
+        ),
+        is_same_df,
+        as_csr,
+    )
+
+
+def merge_intervals(intervals):
+    # merge a list of (low, high) ranges of integers into the fewest ranges with the same integers
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return merged
+
+
+def name_length_intervals(df, slack=1):
+    # the same labels as name_length: the length of the title give or take slack
+    lengths = df["title"].str.len()
+    present = lengths.notna().to_numpy()
+    lengths = lengths[present].to_numpy(dtype=np.int64)
+    return np.flatnonzero(present), lengths - slack, lengths + slack
+
+
+def potential_name_length_intervals(df, slack=3):
+    # the same labels as potential_name_length: for every combination of name parts, their total length give or take slack per part.
+    # Names without (valid) name parts have no ranges, like the "None" label of potential_name_length
+    # NOTE names whose parts have the same lengths have the same ranges, so they get the same code
+    unique_codes = {}
+    codes = np.array(
+        [unique_codes.setdefault(part_lengths, len(unique_codes)) for part_lengths in name_part_lengths(df)],
+        dtype=np.int64,
+    )
+    unique_intervals = []
+    for part_lengths in unique_codes:
+        if part_lengths is None:
+            unique_intervals.append([])
+            continue
+        intervals = []
+        for i in range(1, len(part_lengths) + 1):
+            for combination in combinations(part_lengths, i):
+                intervals.append((sum(combination) - slack * i, sum(combination) + slack * i))
+        unique_intervals.append(merge_intervals(intervals))
+    counts = np.array([len(intervals) for intervals in unique_intervals], dtype=np.int64)
+    records = np.repeat(np.arange(len(codes)), counts[codes])
+    bounds = np.array(
+        [interval for code in codes.tolist() for interval in unique_intervals[code]],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    return records, bounds[:, 0], bounds[:, 1]
+
+
+# ANCHOR consonant bitsets.
+# phonetic_consonant_presence makes two records candidates as soon as they share a single consonant.
+# consonant_overlap_blocks instead stores the consonants of every record as a row of bits and compares the rows of both datasets
+# a tile at a time, so records can be required to share more consonants (or a part of all their consonants) without creating any labels.
+
+
+def consonant_bitsets(df, consonants=None):
+    # return a (len(df), words) array of 64-bit integers where bit j of a row is set if the record's phoneme contains consonants[j],
+    # and the list of consonants. Pass the consonants of another dataframe to give both the same bits. Consonants not in that list are ignored
+    labels = label_unique_values(df, "phoneme", phonetic_consonant_presence)
+    if consonants is None:
+        consonants = sorted(
+            {str(label) for record_labels in labels for label in record_labels if label != "None"}
+        )
+    bits = {consonant: j for j, consonant in enumerate(consonants)}
+    bitsets = np.zeros((len(df), max(1, (len(consonants) + 63) // 64)), dtype=np.uint64)
+    for record, record_labels in enumerate(labels):
+        for label in record_labels:
+            j = bits.get(str(label))
+            if j is not None:
+                bitsets[record, j // 64] |= np.uint64(1 << (j % 64))
+    return bitsets, consonants
+
+
+def consonant_counts(df):
+    # the number of distinct consonants of every record's phoneme
+    labels = label_unique_values(df, "phoneme", phonetic_consonant_presence)
+    return np.array(
+        [len({str(label) for label in record_labels if label != "None"}) for record_labels in labels], dtype=np.int64
+    )
+
+
+def popcount(words):
+    # the number of set bits in every element of an array of 64-bit integers
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    # NOTE np.bitwise_count was added in NumPy 2.0, so older versions count the bits of every byte with a lookup table
+    table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    return table[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def consonant_overlap_blocks(
+    df1,
+    df2,
+    min_shared=1,
+    min_jaccard=0.0,
+    is_same_df=False,
+    as_csr=False,
+    tile_size=1024,
+):
+    # create comparison blocks where a record from df1 is compared to the records from df2 whose phonemes have at least min_shared consonants
+    # in common, and whose consonants have a Jaccard similarity (shared consonants / all consonants of both) of at least min_jaccard.
+    # With min_shared=1 and min_jaccard=0 the blocks are the same as with phonetic_consonant_presence.
+    # The blocks are returned in the same format as create_pairwise_comparison_blocks
+    bitsets_1, consonants = consonant_bitsets(df1)
+    counts_1 = popcount(bitsets_1).sum(axis=1, dtype=np.int64)
+    if is_same_df:
+        bitsets_2, counts_2 = bitsets_1, counts_1
+    else:
+        # NOTE consonants only df2 has can't be shared, so only the consonants of df1 get a bit,
+        # but they're still part of all the consonants of a record of df2
+        bitsets_2, _ = consonant_bitsets(df2, consonants)
+        counts_2 = consonant_counts(df2)
+
+    builder = ComparisonBlocksBuilder()
+    builder.add_records(np.arange(len(df1)))
+    for start_1 in range(0, len(df1), tile_size):
+        print(f"Comparing consonants of record {start_1}/{len(df1)}", end="\r")
+        tile_1 = bitsets_1[start_1 : start_1 + tile_size]
+        for start_2 in range(0, len(bitsets_2), tile_size):
+            tile_2 = bitsets_2[start_2 : start_2 + tile_size]
+            shared = popcount(tile_1[:, None, :] & tile_2[None, :, :]).sum(
+                axis=2, dtype=np.int64
+            )
+            candidates = shared >= max(min_shared, 1)
+            if min_jaccard > 0:
+                union = (
+                    counts_1[start_1 : start_1 + tile_size, None]
+                    + counts_2[None, start_2 : start_2 + tile_size]
+                    - shared
+                )
+                candidates &= shared >= min_jaccard * union
+            records, others = np.nonzero(candidates)
+            builder.add_pairs(records + start_1, others + start_2)
+    print("")
+    comparison_blocks = builder.build(discard_self_pairs=is_same_df)
+    if as_csr:
+        return comparison_blocks
+    return comparison_blocks.to_dict()
+
+# ANCHOR blocking with several labelers.
+
+
+def block_dataframes(
+    df1,
+    df2,
+    labelers,
+    combine="union",
+    is_same_df=False,
+    workers=None,
+    shard_size=10000,
+    as_csr=False,
+):
+    # block both dataframes with every labeler in labelers and combine the comparison blocks of the labelers in one go.
+    # The rows of both dataframes are split into shards of shard_size rows that are labeled by a pool of worker processes
+    # (workers defaults to the number of cores, and workers=1 labels everything in this process), and every worker labels its shard with all labelers,
+    # so values that several labelers use (like name_parts) are only decoded once per shard (see name_part_store).
+    # combine decides how the labelers are combined:
+    #   "union": records are compared if they share a label of any labeler
+    #   "intersection": records are compared if they share a label of every labeler
+    #   or a function that is given the lists of dictionaries made for both dataframes (like meta_blocking)
+    # The blocks are returned in the same format as create_pairwise_comparison_blocks
+    frames = [df1] if is_same_df else [df1, df2]
+    for df in frames:
+        # NOTE the indexes of the records must be their positions in df, like in block_dataframe
+        assert df.index.equals(pd.RangeIndex(len(df)))
+    shards = [
+        (frame, start, min(start + shard_size, len(df)))
+        for frame, df in enumerate(frames)
+        for start in range(0, len(df), shard_size)
+    ]
+    indexes = [[InvertedIndex() for _ in labelers] for _ in frames]
+
+    def add_labels(frame, shard_labels):
+        for index, (records, labels) in zip(indexes[frame], shard_labels):
+            index.add_many(records, labels)
+
+    if workers == 1:
+        for i, (frame, start, stop) in enumerate(shards):
+            print(f"Labeling shard {i + 1}/{len(shards)}", end="\r")
+            add_labels(frame, label_rows(frames[frame].iloc[start:stop], labelers))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (frame, executor.submit(label_rows, frames[frame].iloc[start:stop], labelers))
+                for frame, start, stop in shards
+            ]
+            for i, (frame, future) in enumerate(futures):
+                add_labels(frame, future.result())
+                print(f"Labeled shard {i + 1}/{len(shards)}", end="\r")
+    print("")
+
+    dicts_1 = [index.finalize() for index in indexes[0]]
+    dicts_2 = dicts_1 if is_same_df else [index.finalize() for index in indexes[1]]
+    if callable(combine):
+        return combine(dicts_1, dicts_2)
+    if combine == "union":
+        # NOTE the labels of different labelers are kept apart by the number of the labeler
+        return create_pairwise_comparison_blocks(
+            {(i, label): block for i, dict_1 in enumerate(dicts_1) for label, block in dict_1.items()},
+            {(i, label): block for i, dict_2 in enumerate(dicts_2) for label, block in dict_2.items()},
+            is_same_df,
+            ignore_lables=[(i, "None") for i in range(len(labelers))],
+            as_csr=as_csr,
+        )
+    if combine == "intersection":
+        comparison_blocks = intersect_comparison_blocks(
+            [
+                create_pairwise_comparison_blocks(dict_1, dict_2, is_same_df, as_csr=True)
+                for dict_1, dict_2 in zip(dicts_1, dicts_2)
+            ]
+        )
+        if as_csr:
+            return comparison_blocks
+        return comparison_blocks.to_dict()
+    raise ValueError(f'combine must be "union", "intersection" or a function, not {combine}')
+
+
+def label_rows(df, labelers):
+    # label the rows of a dataframe (or a shard of one) with every labeler, and return two arrays for every labeler:
+    # the records and their labels, with a record repeated for every label it has
+    results = []
+    for labeler in labelers:
+        label_column = getattr(labeler, "label_column", None)
+        if label_column is not None:
+            labels = label_column(df)
+        else:
+            labels = pd.Series([labeler(row) for _, row in df.iterrows()], index=df.index)
+        labels = labels.explode()
+        # NOTE labels must be equal to the same labels made in other processes, which isn't true for objects like the consonants of ipapy,
+        # so everything but strings and numbers is turned into a string
+        labels = labels.map(portable_label, na_action="ignore")
+        results.append((labels.index.to_numpy(), labels.to_numpy(dtype=object)))
+    return results
+
+
+def portable_label(label):
+    if isinstance(label, (str, int, float, np.integer, np.floating)):
+        return label
+    return str(label)
+
+
+class IncrementalBlocks:
+    # comparison blocks that new records can be added to without blocking everything again.
+    # The label postings of both datasets are kept, so only the labels of the new records have to be found,
+    # and only the pairs with the new records are added. Records share a block if they share a label of any of the labelers, like block_dataframes.
+    # The pairs added since the last call to clear_new_blocks are kept as well, so filtering and batching can be run on just those.
+    # Save it with save and open it again with IncrementalBlocks.load
+    def __init__(self, labelers, is_same_df=False, ignore_lables=["None"]):
+        self.labelers = labelers
+        self.is_same_df = is_same_df
+        self.ignore_lables = ignore_lables
+        # an InvertedIndex for every labeler for every dataset (only one dataset if is_same_df is True)
+        self.indexes = [[InvertedIndex() for _ in labelers] for _ in range(1 if is_same_df else 2)]
+        self.sizes = [0 for _ in self.indexes]
+        self.keys = np.empty(0, dtype=np.int64)
+        self.new_keys = np.empty(0, dtype=np.int64)
+
+    def add_records(self, df, dataset=1):
+        # add the rows of df to dataset 1 or 2 (it doesn't matter which if is_same_df is True).
+        # They get the next record numbers of that dataset, in the order of the rows. Returns the new pairs as ComparisonBlocks
+        side = 0 if self.is_same_df else dataset - 1
+        start = self.sizes[side]
+        df = df.set_axis(pd.RangeIndex(start, start + len(df)))
+        print(f"Labeling {len(df)} new records of dataset {side + 1}")
+        builder = ComparisonBlocksBuilder()
+        for i, (records, labels) in enumerate(label_rows(df, self.labelers)):
+            new_labels = InvertedIndex()
+            new_labels.add_many(records, labels)
+            own = self.indexes[side][i]
+            other = self.indexes[1 - side][i] if not self.is_same_df else own
+            for label, label_records in new_labels.postings.items():
+                if label in self.ignore_lables:
+                    continue
+                own.add_many(label_records, [label] * len(label_records))
+                label_records = np.frombuffer(label_records, dtype=np.int64)
+                candidates = other.postings.get(label)
+                if candidates is None:
+                    continue
+                # NOTE if is_same_df is True, the candidates include the new records themselves, since they were just added
+                candidates = np.frombuffer(candidates, dtype=np.int64)
+                new_records = np.repeat(label_records, len(candidates))
+                new_candidates = np.tile(candidates, len(label_records))
+                if side == 0:
+                    builder.add_pairs(new_records, new_candidates)
+                if side == 1 or self.is_same_df:
+                    builder.add_pairs(new_candidates, new_records)
+        self.sizes[side] += len(df)
+
+        # every new pair has a new record, so none of them were already there
+        new_keys = builder.build(discard_self_pairs=self.is_same_df)
+        new_keys = pair_keys(*new_keys.pair_arrays())
+        self.keys = sorted_unique(np.concatenate([self.keys, new_keys]))
+        self.new_keys = sorted_unique(np.concatenate([self.new_keys, new_keys]))
+        print(f"Added {len(new_keys)} new pairs")
+        return ComparisonBlocks.from_pair_keys(new_keys)
+
+    def blocks(self):
+        # all comparison blocks as ComparisonBlocks. Every record of dataset 1 has a block
+        return ComparisonBlocks.from_pair_keys(self.keys, np.arange(self.sizes[0]))
+
+    def new_blocks(self):
+        # the pairs added since the last call to clear_new_blocks as ComparisonBlocks
+        return ComparisonBlocks.from_pair_keys(self.new_keys)
+
+    def clear_new_blocks(self):
+        self.new_keys = np.empty(0, dtype=np.int64)
+
+    def save(self, path):
+        # NOTE the labelers are pickled too, so they must be defined at the top of a module (or be MinHashLabelers)
+        with open(path, "wb") as file:
+            pickle.dump(self, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
 
 if __name__ == "__main__":
     df1 = pd.read_csv(
@@ -171,22 +997,15 @@ if __name__ == "__main__":
     
     df2 = getWikidataDf()
 
-    labeler = no_distinguishing
+    labelers = [no_distinguishing]
 
     start_time = datetime.now()
-    print("Blocking first dataset...")
-    dict_1 = block_dataframe(df1, labeler)
-    print("Blocking second dataset...")
-    dict_2 = block_dataframe(df2, labeler)
+    print("Blocking datasets...")
+    blocks = block_dataframes(df1, df2, labelers, is_same_df=True, as_csr=True)
     end_time = datetime.now()
 
-    print("Preparing pairwise comparisons...")
-    blocks = create_pairwise_comparison_blocks(dict_1, dict_2, is_same_df=True)
-
     print("Writing blocks to file...")
-    blocks = {k: list(v) for k, v in blocks.items()}
-    with open(r"app\blocks.json", "w", encoding="utf-8") as file:
-        json.dump(blocks, file, ensure_ascii=False, indent=4)
+    save_blocks(blocks, r"app\blocks.blocks")
 
     print("Evaluating blocks...\n")
     matches = pd.read_csv(
@@ -195,9 +1014,12 @@ if __name__ == "__main__":
         header=0,
     )
     print(f"Time taken: {(end_time-start_time).total_seconds()} seconds.")
-    recall = calculate_recall_better(blocks, matches)
-    print(f"Recall: {recall}\n")
-    reduction_ration = calculate_reduction_ratio(blocks, df1, df2)
-    print(f"Reduction ratio: {reduction_ration}\n")
+    evaluation = match_evaluator(matches).evaluate(blocks, df1, df2)
+    print(f"Found {evaluation['found_matches']}/{evaluation['total_matches']} matches.")
+    print(f"Recall: {evaluation['recall']}\n")
+    print(
+        f"Reduced {evaluation['brute_force_comparisons']} comparisons to {evaluation['possible_matches']}"
+    )
+    print(f"Reduction ratio: {evaluation['reduction_ratio']}\n")
 
     print("All done and ready for filtering!")
@@ -0,0 +1,373 @@
+from collections.abc import Mapping
+import json
+import os
+import struct
+import numpy as np
+
+
+class ComparisonBlocks(Mapping):
+    # pairwise comparison blocks stored as a CSR sparse adjacency instead of a dictionary of sets:
+    # records is a sorted array of the records that have a block, and the block of records[i] is indices[indptr[i]:indptr[i + 1]] (sorted as well).
+    # It can be used like the dictionaries made by create_pairwise_comparison_blocks: blocks[record] gives the block of a record as a list,
+    # and iterating over it gives the records that have a block. Use block(record) to get the block as a NumPy array without copying it
+    def __init__(self, records, indptr, indices):
+        self.records = np.asarray(records, dtype=np.int32)
+        self.indptr = np.asarray(indptr, dtype=smallest_index_type(len(indices)))
+        self.indices = np.asarray(indices, dtype=np.int32)
+
+    @classmethod
+    def from_pairs(cls, records, candidates, all_records=None):
+        # given two arrays where candidates[i] is a possible match for records[i], create the comparison blocks with those pairs.
+        # Duplicate pairs are removed. Use all_records to give records a (possibly empty) block even if they're not in any pairs
+        keys = sorted_unique(pair_keys(records, candidates))
+        return cls.from_pair_keys(keys, all_records)
+
+    @classmethod
+    def from_pair_keys(cls, keys, all_records=None):
+        # the same as from_pairs, except the pairs are given as sorted, unique keys made by pair_keys
+        rows = (keys >> 32).astype(np.int32)
+        indices = (keys & 0xFFFFFFFF).astype(np.int32)
+        records = sorted_unique(rows)
+        if all_records is not None:
+            records = sorted_unique(
+                np.concatenate([records, np.asarray(all_records, dtype=np.int32)])
+            )
+        indptr = np.append(np.searchsorted(rows, records), len(rows))
+        return cls(records, indptr, indices)
+
+    @classmethod
+    def from_dict(cls, blocks):
+        # convert a dictionary that maps records to an iterable of the records in their block
+        records = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+        sizes = np.fromiter(
+            (len(block) for block in blocks.values()), dtype=np.int64, count=len(blocks)
+        )
+        candidates = np.fromiter(
+            (candidate for block in blocks.values() for candidate in block),
+            dtype=np.int64,
+            count=int(sizes.sum()),
+        )
+        return cls.from_pairs(np.repeat(records, sizes), candidates, records)
+
+    def to_dict(self, container=set):
+        # convert to a dictionary that maps records to a container (set or list) of the records in their block
+        indices = self.indices.tolist()
+        indptr = self.indptr.tolist()
+        return {
+            record: container(indices[indptr[i] : indptr[i + 1]])
+            for i, record in enumerate(self.records.tolist())
+        }
+
+    def position(self, record):
+        # the position of a record in self.records. Raises a KeyError if the record has no block
+        position = int(np.searchsorted(self.records, record))
+        if position == len(self.records) or self.records[position] != record:
+            raise KeyError(record)
+        return position
+
+    def block(self, record):
+        position = self.position(record)
+        return self.indices[self.indptr[position] : self.indptr[position + 1]]
+
+    def __getitem__(self, record):
+        return self.block(record).tolist()
+
+    def contains_pair(self, record, candidate):
+        # whether candidate is in the block of record, using a binary search of the (sorted) block
+        if record not in self:
+            return False
+        block = self.block(record)
+        position = int(np.searchsorted(block, candidate))
+        return position < len(block) and block[position] == candidate
+
+    def __contains__(self, record):
+        try:
+            self.position(record)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(self.records.tolist())
+
+    def __len__(self):
+        return len(self.records)
+
+    def block_sizes(self):
+        return np.diff(self.indptr)
+
+    def pair_count(self):
+        return len(self.indices)
+
+    def pair_arrays(self):
+        # return all pairs as two arrays, where indices[i] is in the block of records[i]
+        return np.repeat(self.records, self.block_sizes()), self.indices
+
+    def pairs(self):
+        # lazily generate every (record, candidate) pair, one block at a time
+        indptr = self.indptr.tolist()
+        for i, record in enumerate(self.records.tolist()):
+            for candidate in self.indices[indptr[i] : indptr[i + 1]].tolist():
+                yield record, candidate
+
+
+class ComparisonBlocksBuilder:
+    # collects (record, candidate) pairs in batches and turns them into ComparisonBlocks.
+    # Duplicate pairs are removed every time more than compact_size pairs are waiting, so memory stays close to the number of unique pairs
+    def __init__(self, compact_size=2**24):
+        self.compact_size = compact_size
+        self.keys = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+        self.records = []
+
+    def add_pairs(self, records, candidates):
+        keys = pair_keys(records, candidates)
+        self.pending.append(keys)
+        self.pending_size += len(keys)
+        if self.pending_size > self.compact_size:
+            self.compact()
+
+    def add_records(self, records):
+        # make sure these records get a block, even if it's empty
+        self.records.append(np.asarray(records, dtype=np.int64))
+
+    def compact(self):
+        self.keys = sorted_unique(np.concatenate([self.keys] + self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def build(self, discard_self_pairs=False):
+        # if discard_self_pairs is True, records are not put in their own block
+        self.compact()
+        keys = self.keys
+        if discard_self_pairs:
+            keys = keys[(keys >> 32) != (keys & 0xFFFFFFFF)]
+        all_records = np.concatenate(self.records) if self.records else None
+        return ComparisonBlocks.from_pair_keys(keys, all_records)
+
+
+def pair_keys(records, candidates):
+    # pack pairs of records into single 64-bit integers that sort by record first and candidate second
+    records = np.asarray(records, dtype=np.int64)
+    candidates = np.asarray(candidates, dtype=np.int64)
+    return (records << 32) | candidates
+
+
+def sorted_unique(array):
+    # the same as np.unique, but always done by sorting, since np.unique can be many times slower on large arrays of integers
+    array = np.sort(array)
+    if len(array) == 0:
+        return array
+    return array[np.concatenate([[True], array[1:] != array[:-1]])]
+
+
+def smallest_index_type(size):
+    return np.int32 if size < 2**31 else np.int64
+
+
+def iter_pairs(blocks):
+    # lazily generate every (record, candidate) pair of some comparison blocks, either a dictionary or ComparisonBlocks
+    if isinstance(blocks, ComparisonBlocks):
+        yield from blocks.pairs()
+    else:
+        for record in blocks:
+            for candidate in blocks[record]:
+                yield record, candidate
+
+
+def count_pairs(blocks):
+    # the total number of pairwise comparisons in some comparison blocks, either a dictionary or ComparisonBlocks
+    if isinstance(blocks, ComparisonBlocks):
+        return blocks.pair_count()
+    return sum(len(block) for block in blocks.values())
+
+
+def pair_in_blocks(blocks, record, candidate):
+    # whether candidate is in the block of record in some comparison blocks, either a dictionary or ComparisonBlocks
+    if isinstance(blocks, ComparisonBlocks):
+        return blocks.contains_pair(record, candidate)
+    return candidate in blocks[record]
+
+
+def intersect_comparison_blocks(blocks_list):
+    # the pairs that are in every one of a list of ComparisonBlocks. The records of the first ComparisonBlocks all get a block
+    keys = pair_keys(*blocks_list[0].pair_arrays())
+    for blocks in blocks_list[1:]:
+        # NOTE the pair keys of ComparisonBlocks are already sorted and unique
+        keys = np.intersect1d(keys, pair_keys(*blocks.pair_arrays()), assume_unique=True)
+    return ComparisonBlocks.from_pair_keys(keys, blocks_list[0].records)
+
+
+def as_comparison_blocks(blocks):
+    # convert comparison blocks to ComparisonBlocks if they aren't already
+    if isinstance(blocks, ComparisonBlocks):
+        return blocks
+    return ComparisonBlocks.from_dict(blocks)
+
+
+class RankedBlocks:
+    # the candidates of every record ranked from best to worst with their scores, as made by the filter functions with ranked=True.
+    # The candidates of records[i] are candidates[indptr[i]:indptr[i + 1]] with the scores scores[indptr[i]:indptr[i + 1]].
+    # Filtering once with ranked=True gives the filtered blocks of every block size (or score cutoff), since the blocks
+    # the filter function makes with some block_size are always the block_size best candidates
+    def __init__(self, records, indptr, candidates, scores):
+        self.records = np.asarray(records, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.candidates = np.asarray(candidates, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float64)
+
+    @classmethod
+    def from_lists(cls, records, candidates, scores):
+        # records is a list of records, and candidates and scores lists with the ranked candidates and their scores for every record
+        sizes = [len(ranked) for ranked in candidates]
+        return cls(
+            records,
+            np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]),
+            np.concatenate([np.empty(0, dtype=np.int64)] + [np.asarray(ranked, dtype=np.int64) for ranked in candidates]),
+            np.concatenate([np.empty(0)] + [np.asarray(ranked, dtype=np.float64) for ranked in scores]),
+        )
+
+    @classmethod
+    def concatenate(cls, ranked_blocks):
+        # join RankedBlocks of different records, like the shards of parallel_filter, in order
+        offsets = np.cumsum([0] + [len(ranked.candidates) for ranked in ranked_blocks])
+        return cls(
+            np.concatenate([np.empty(0, dtype=np.int64)] + [ranked.records for ranked in ranked_blocks]),
+            np.concatenate([[0]] + [ranked.indptr[1:] + offset for ranked, offset in zip(ranked_blocks, offsets)]),
+            np.concatenate([np.empty(0, dtype=np.int64)] + [ranked.candidates for ranked in ranked_blocks]),
+            np.concatenate([np.empty(0)] + [ranked.scores for ranked in ranked_blocks]),
+        )
+
+    def __len__(self):
+        return len(self.records)
+
+    def ranked(self, position):
+        # the ranked candidates and their scores of records[position]
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return self.candidates[start:stop], self.scores[start:stop]
+
+    def blocks(self, block_size=None, min_score=None):
+        # the filtered blocks with the block_size best candidates of every record (all of them if block_size is None),
+        # leaving out the candidates with a score below min_score. The blocks are sets, like the ones the filter functions return
+        starts = self.indptr[:-1]
+        stops = self.indptr[1:]
+        if min_score is not None:
+            # NOTE the scores of a record are sorted from best to worst, so the candidates that reach the cutoff come first
+            reached = np.concatenate([[0], np.cumsum(self.scores >= min_score)])
+            stops = starts + (reached[stops] - reached[starts])
+        if block_size is not None:
+            stops = np.minimum(stops, starts + block_size)
+        candidates = self.candidates.tolist()
+        return {
+            record: set(candidates[start:stop])
+            for record, start, stop in zip(self.records.tolist(), starts.tolist(), stops.tolist())
+        }
+
+    def save(self, path):
+        np.savez(path, records=self.records, indptr=self.indptr, candidates=self.candidates, scores=self.scores)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays["records"], arrays["indptr"], arrays["candidates"], arrays["scores"])
+
+
+# ANCHOR block files.
+# Comparison blocks are stored in a small binary format that can be memory-mapped, so opening a block file is instant no matter its size
+# and only the blocks that are actually looked up are read from disk. A block file is a 64 byte header followed by the three CSR arrays:
+# the magic bytes, the format version, the number of records, the number of pairs and the size in bytes of each indptr entry,
+# then records (int32), indptr (int32 or int64) and indices (int32), each starting at a multiple of 8 bytes.
+BLOCK_FILE_MAGIC = b"P6BLOCKS"
+BLOCK_FILE_VERSION = 1
+BLOCK_FILE_HEADER = struct.Struct("<8sIIqqq")
+BLOCK_FILE_HEADER_SIZE = 64
+BLOCK_FILE_EXTENSION = ".blocks"
+
+
+def save_blocks(blocks, path):
+    # write comparison blocks (a dictionary or ComparisonBlocks) to path.
+    # Paths ending with .json are written in the old json format, everything else in the binary format
+    if path.endswith(".json"):
+        blocks = {
+            int(record): [int(candidate) for candidate in blocks[record]]
+            for record in blocks
+        }
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(blocks, file, ensure_ascii=False, indent=4)
+        return
+    blocks = as_comparison_blocks(blocks)
+    arrays = [blocks.records, blocks.indptr, blocks.indices]
+    with open(path, "wb") as file:
+        file.write(
+            BLOCK_FILE_HEADER.pack(
+                BLOCK_FILE_MAGIC,
+                BLOCK_FILE_VERSION,
+                0,
+                len(blocks.records),
+                len(blocks.indices),
+                blocks.indptr.itemsize,
+            ).ljust(BLOCK_FILE_HEADER_SIZE, b"\0")
+        )
+        for array in arrays:
+            file.write(array.tobytes())
+            # pad every array to a multiple of 8 bytes so the next one is aligned
+            file.write(b"\0" * (-array.nbytes % 8))
+
+
+def load_blocks(path, mmap=True):
+    # open comparison blocks written by save_blocks as ComparisonBlocks. Json files are parsed like before.
+    # If the binary block file at path doesn't exist, but a json file with the same name does, the json file is converted first.
+    # With mmap=True the arrays are memory-mapped instead of being read into memory
+    if path.endswith(".json"):
+        return load_json_blocks(path)
+    if not os.path.exists(path):
+        json_path = os.path.splitext(path)[0] + ".json"
+        if os.path.exists(json_path):
+            print(f"Converting {json_path} to {path}")
+            convert_json_blocks(json_path, path)
+    with open(path, "rb") as file:
+        header = file.read(BLOCK_FILE_HEADER_SIZE)
+    magic, version, _, record_count, pair_count, indptr_itemsize = (
+        BLOCK_FILE_HEADER.unpack_from(header)
+    )
+    if magic != BLOCK_FILE_MAGIC:
+        raise ValueError(f"{path} is not a block file")
+    if version != BLOCK_FILE_VERSION:
+        raise ValueError(f"{path} has unsupported block file version {version}")
+    offset = BLOCK_FILE_HEADER_SIZE
+    arrays = []
+    for dtype, length in [
+        (np.int32, record_count),
+        (np.int32 if indptr_itemsize == 4 else np.int64, record_count + 1),
+        (np.int32, pair_count),
+    ]:
+        arrays.append(read_array(path, dtype, offset, length, mmap))
+        nbytes = np.dtype(dtype).itemsize * length
+        offset += nbytes + (-nbytes % 8)
+    return ComparisonBlocks(*arrays)
+
+
+def read_array(path, dtype, offset, length, mmap=True):
+    if length == 0:
+        # NOTE empty arrays can't be memory-mapped
+        return np.empty(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(length,))
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return np.fromfile(file, dtype=dtype, count=length)
+
+
+def load_json_blocks(path):
+    with open(path, encoding="utf-8") as file:
+        blocks = json.load(file)
+    return ComparisonBlocks.from_dict({int(k): v for k, v in blocks.items()})
+
+
+def convert_json_blocks(json_path, path=None):
+    # convert a json file of comparison blocks to a binary block file (by default with the same name and the .blocks extension)
+    if path is None:
+        path = os.path.splitext(json_path)[0] + BLOCK_FILE_EXTENSION
+    save_blocks(load_json_blocks(json_path), path)
+    return path
@@ -3,6 +3,7 @@ import os
 import math
 import sys
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import time
 import random
 import requests
@@ -14,7 +15,11 @@ import json
 import unittest
 from translit_me.transliterator import transliterate as tr
 from translit_me.lang_tables import *
+from translit_me import lang_tables
 from transphone import read_tokenizer
+from transliterationCache import transliteration_cache, start_transliteration_worker, take_transliteration_stats
+from namePartStore import name_part_store
+from sharding import transform_csv_sharded
 
 
 def send_data_to_service(
@@ -171,36 +176,95 @@ def write_g2p(data, name):
     except Exception as e:
         print("Error while saving CSV:", e)
 
-def translit(data, name, lang):
-    titles = list(data["title"])
-    tr_titles = []
-    for title in titles:
-        results = tr([title], lang)
-        tr_titles.append(results[0])
-    data["title"] = pd.Series(tr_titles)
-
-    name_parts_dicts = list(data["name_parts"])
-    tr_name_parts_dicts = []
-    for name_parts in name_parts_dicts:
-        try:
-            tr_name_parts = {}
-            name_parts = json.loads(name_parts)
-            if not name_parts:  # Skip if empty dictionary
-                continue
-            for name_part in name_parts:
-                value = name_parts[name_part].strip()
-                if not value:  # Skip empty values
-                    continue
-                results = tr([value], lang)
-                tr_name_parts[name_part] = results[0]
-            tr_name_parts_dicts.append(json.dumps(tr_name_parts,ensure_ascii=False))
-        except json.JSONDecodeError:
-            pass
-    data["name_parts"] = pd.Series(tr_name_parts_dicts)
+def translit_scheme(lang):
+    # find the name of a translit_me language table, so its transliterations can be cached under a scheme that stays the same between runs
+    for table_name, table in vars(lang_tables).items():
+        if table is lang:
+            return f"translit_me:{table_name}"
+    return None
+
+
+def translit_value(value, lang, scheme):
+    # transliterate a single title or name part, using the shared transliteration cache if we know the scheme
+    if scheme is None:
+        return tr([value], lang)[0]
+    return transliteration_cache.get(scheme, value, lambda value: tr([value], lang)[0])
+
+
+def translit_name_parts(name_parts, lang, scheme):
+    # transliterate every name part in a json string of name parts.
+    # Returns None if there are no name parts or they can't be decoded
+    try:
+        name_parts = json.loads(name_parts)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return translit_decoded_name_parts(name_parts, lang, scheme)
+
+
+def translit_decoded_name_parts(name_parts, lang, scheme):
+    # the same as translit_name_parts, for name parts that are already decoded (None if they couldn't be)
+    if not name_parts:  # Skip if empty dictionary
+        return None
+    tr_name_parts = {}
+    for name_part in name_parts:
+        value = name_parts[name_part].strip()
+        if not value:  # Skip empty values
+            continue
+        tr_name_parts[name_part] = translit_value(value, lang, scheme)
+    return json.dumps(tr_name_parts, ensure_ascii=False)
+
+
+def translit_chunk(data, lang, scheme=None):
+    # transliterate the titles and name parts of (a chunk of) a dataset
+    data["title"] = [translit_value(title, lang, scheme) for title in data["title"]]
+    # NOTE rows without usable name parts get an empty value, so every row keeps its own name parts.
+    # The name parts are read from the NamePartStore of data, so they're only decoded once
+    store = name_part_store(data)
+    data["name_parts"] = [
+        translit_decoded_name_parts(store.record(index), lang, scheme)
+        for index in data.index
+    ]
+    return data
+
+
+def translit(data, name, lang, scheme=None, cache_path=None):
+    # if cache_path is given, the transliterations are also kept in (and read from) the sqlite store at that path, see TransliterationCache
+    if cache_path is not None:
+        transliteration_cache.open(cache_path)
+    if scheme is None:
+        scheme = translit_scheme(lang)
+    if scheme is None:
+        print("Unknown language table. Transliterations will not be cached.")
+    data = translit_chunk(data, lang, scheme)
 
     output_file_path = f"datasets/translit-wikiData/{name}_transliteration.csv"
     data.to_csv(output_file_path, index=False)
     print(data)
+    transliteration_cache.print_stats()
+
+
+def translit_sharded(input_path, name, lang, scheme=None, workers=None, cache_path=None):
+    # the same as translit, except the dataset at input_path is read in chunks which are transliterated in a pool of worker processes.
+    # workers defaults to the number of cores
+    if cache_path is not None:
+        transliteration_cache.open(cache_path)
+    # NOTE the workers open the store themselves, so everything written to it so far has to be committed first
+    transliteration_cache.flush()
+    if scheme is None:
+        scheme = translit_scheme(lang)
+    output_file_path = f"datasets/translit-wikiData/{name}_transliteration.csv"
+    transform_csv_sharded(
+        input_path,
+        output_file_path,
+        partial(translit_chunk, lang=lang, scheme=scheme),
+        workers=workers,
+        index=False,
+        initializer=partial(start_transliteration_worker, cache_path),
+        chunk_stats=take_transliteration_stats,
+        add_stats=transliteration_cache.add_stats,
+    )
+    print(f"Data saved to {output_file_path}")
+    transliteration_cache.print_stats()
 
 
 if __name__ == "__main__":
@@ -5,6 +5,7 @@ import pandas as pd
 import g2p
 import glob
 import os
+from namePartStore import NamePartStore
 
 string_feature_set = set()
 full_feature_list = []
@@ -28,6 +29,16 @@ def preProcess(column):
     return column if column else None
 
 
+def parse_name_parts(name_parts):
+    # the name parts of a row are a dictionary with doubled quotes, so undouble them and evaluate it. Returns None if it can't be evaluated
+    try:
+        return eval(
+            name_parts.replace('""""', '""#""').replace('""', '"').replace('"#"', '""')
+        )
+    except SyntaxError:
+        return None
+
+
 # Read and preprocess data from CSV file, ignoring lat and lon columns
 def readData(filenames):
     data_d = {}
@@ -50,27 +61,26 @@ def readData(filenames):
 
     # Rest of the code remains the same...
     print("Finding distinct name parts")
-    bad_rows = []
+    # NOTE the name parts are evaluated only once (every distinct value only once) into a NamePartStore, and read from it afterwards
+    store = NamePartStore.from_series(
+        pd.Series([row.get("name_parts") for row in rows], dtype=object),
+        parse=parse_name_parts,
+    )
+    string_feature_set.update(store.types)
     for row in rows:
         for feature in row:
             if feature not in full_feature_list:
                 full_feature_list.append(feature)
-        try:
-            for feature in eval(
-                row["name_parts"]
-                .replace('""""', '""#""')
-                .replace('""', '"')
-                .replace('"#"', '""')
-            ):
-                string_feature_set.add(feature)
-        except SyntaxError:
-            bad_rows.append(row)
     print(f"Name parts found: {string_feature_set}")
 
     # Remove bad rows
-    for row in bad_rows:
-        print(f"Row {row['id']} has badly formatted name parts. Discarding it.")
-        rows.remove(row)
+    for position, row in enumerate(rows):
+        if not store.valid[position]:
+            print(f"Row {row['id']} has badly formatted name parts. Discarding it.")
+    rows_name_parts = [
+        store.record(position) for position in range(len(rows)) if store.valid[position]
+    ]
+    rows = [row for position, row in enumerate(rows) if store.valid[position]]
 
     # Assign new IDs and clean rows
     next_id = 0
@@ -79,7 +89,7 @@ def readData(filenames):
         next_id = next_id + 1
 
     print("Cleaning rows")
-    for row in rows:
+    for row, name_parts in zip(rows, rows_name_parts):
         clean_row = {
             k: preProcess(v)
             for k, v in row.items()
@@ -101,12 +111,6 @@ def readData(filenames):
         clean_row["title"] = preProcess(row.get("title", ""))
 
         if row.get("name_parts") is not None:
-            name_parts = eval(
-                row["name_parts"]
-                .replace('""""', '""#""')
-                .replace('""', '"')
-                .replace('"#"', '""')
-            )
             for feature in string_feature_set:
                 clean_row[feature] = name_parts.get(feature)
 
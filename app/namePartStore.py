@@ -0,0 +1,192 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+class NamePartStore:
+    # the name parts of every record of a dataset, decoded once and kept in arrays instead of as json strings:
+    # strings are the distinct name parts and types the distinct types of name parts (like "first" or "last"), each stored only once,
+    # and the name parts of the record with index[i] are part_strings[offsets[i]:offsets[i + 1]] (positions in strings)
+    # with the types part_types[offsets[i]:offsets[i + 1]] (positions in types), in the order of the json.
+    # valid[i] is False if the name parts of the record couldn't be decoded (bad json, a missing value or not a json object).
+    # Get it with name_part_store or load_name_part_store, which make sure it's only built once for every dataset
+    def __init__(self, index, valid, offsets, part_strings, part_types, strings, types):
+        self.index = np.asarray(index, dtype=np.int64)
+        self.valid = np.asarray(valid, dtype=bool)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.part_strings = np.asarray(part_strings, dtype=np.int32)
+        self.part_types = np.asarray(part_types, dtype=np.int32)
+        self.strings = [str(string) for string in strings]
+        self.types = [str(part_type) for part_type in types]
+        self.positions = pd.Index(self.index)
+        # the name_parts column the store was made from, see covers
+        self.name_parts = None
+
+    @classmethod
+    def from_series(cls, name_parts, parse=json.loads):
+        # build the store of a column of name parts. Every distinct value is only decoded once, with parse (json.loads by default),
+        # which should return a dictionary that maps types of name parts to name parts, or raise a ValueError (like json.JSONDecodeError) or a TypeError
+        codes, uniques = pd.factorize(name_parts, use_na_sentinel=False)
+        strings = {}
+        types = {}
+        unique_valid = np.zeros(len(uniques), dtype=bool)
+        unique_parts = []
+        for i, value in enumerate(uniques):
+            try:
+                parts = parse(value)
+            except (ValueError, TypeError):
+                parts = None
+            if not isinstance(parts, dict):
+                unique_parts.append([])
+                continue
+            unique_valid[i] = True
+            # NOTE parts that aren't strings (like null in the json) aren't name parts, so they're left out instead of becoming "None"
+            unique_parts.append(
+                [
+                    (strings.setdefault(part, len(strings)), types.setdefault(str(part_type), len(types)))
+                    for part_type, part in parts.items()
+                    if isinstance(part, str)
+                ]
+            )
+        counts = np.array([len(parts) for parts in unique_parts], dtype=np.int64)
+        flat = [pair for parts in unique_parts for pair in parts]
+        unique_offsets = np.concatenate([[0], np.cumsum(counts)])
+        flat = np.array(flat, dtype=np.int32).reshape(-1, 2)
+        # every record gets the name parts of its value
+        record_counts = counts[codes]
+        offsets = np.concatenate([[0], np.cumsum(record_counts)])
+        parts = np.repeat(unique_offsets[codes] - offsets[:-1], record_counts) + np.arange(offsets[-1])
+        store = cls(
+            np.asarray(name_parts.index, dtype=np.int64),
+            unique_valid[codes],
+            offsets,
+            flat[parts, 0],
+            flat[parts, 1],
+            list(strings),
+            list(types),
+        )
+        store.name_parts = name_parts
+        return store
+
+    def __len__(self):
+        return len(self.index)
+
+    def position(self, index):
+        # the position of the record with index in the store
+        return self.positions.get_loc(index)
+
+    def part_count(self, index):
+        position = self.position(index)
+        return int(self.offsets[position + 1] - self.offsets[position])
+
+    def part_ids(self, index):
+        # the positions in strings of the name parts of the record with index, or None if its name parts couldn't be decoded
+        position = self.position(index)
+        if not self.valid[position]:
+            return None
+        return self.part_strings[self.offsets[position] : self.offsets[position + 1]]
+
+    def parts(self, index):
+        # the name parts of the record with index as a list, or None if they couldn't be decoded
+        part_ids = self.part_ids(index)
+        if part_ids is None:
+            return None
+        return [self.strings[part] for part in part_ids.tolist()]
+
+    def record(self, index):
+        # the name parts of the record with index as a dictionary like the decoded json, or None if they couldn't be decoded
+        position = self.position(index)
+        if not self.valid[position]:
+            return None
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        return {
+            self.types[part_type]: self.strings[part]
+            for part_type, part in zip(self.part_types[start:stop].tolist(), self.part_strings[start:stop].tolist())
+        }
+
+    def covers(self, df):
+        # whether every record of df was in the dataset the store was made for, with the same name parts
+        if self.name_parts is None:
+            return False
+        if df["name_parts"] is self.name_parts:
+            return True
+        return bool(df.index.isin(self.positions).all()) and self.name_parts.reindex(df.index).equals(df["name_parts"])
+
+    def save(self, path, fingerprint=()):
+        # write the store to path (a .npz file). fingerprint is saved with it, see load_name_part_store
+        np.savez(
+            path,
+            index=self.index,
+            valid=self.valid,
+            offsets=self.offsets,
+            part_strings=self.part_strings,
+            part_types=self.part_types,
+            strings=np.array(self.strings, dtype=str),
+            types=np.array(self.types, dtype=str),
+            fingerprint=np.array(fingerprint, dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        # read a store written by save. Returns the store and the fingerprint it was saved with
+        with np.load(path) as arrays:
+            store = cls(
+                arrays["index"],
+                arrays["valid"],
+                arrays["offsets"],
+                arrays["part_strings"],
+                arrays["part_types"],
+                arrays["strings"].tolist(),
+                arrays["types"].tolist(),
+            )
+            return store, tuple(arrays["fingerprint"].tolist())
+
+
+# the stores that were built or loaded last, so every stage that needs the name parts of the same dataset gets the same store
+name_part_stores = []
+NAME_PART_STORES_KEPT = 4
+NAME_PART_STORE_EXTENSION = ".nameparts.npz"
+
+
+def remember_name_part_store(store):
+    name_part_stores.insert(0, store)
+    del name_part_stores[NAME_PART_STORES_KEPT:]
+    return store
+
+
+def name_part_store(df):
+    # the NamePartStore of the name parts of df: one that was already built or loaded for df (or a dataframe that df is a part of), or a new one
+    for store in name_part_stores:
+        if store.covers(df):
+            return store
+    return remember_name_part_store(NamePartStore.from_series(df["name_parts"]))
+
+
+def name_part_store_path(csv_path):
+    # the store of a dataset is kept next to its csv file, e.g. datasets/LASKI.csv has datasets/LASKI.nameparts.npz
+    return os.path.splitext(csv_path)[0] + NAME_PART_STORE_EXTENSION
+
+
+def csv_fingerprint(csv_path):
+    # the size and modification time of a csv file, so a store made from an older version of the file isn't used
+    stat = os.stat(csv_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def load_name_part_store(csv_path, df):
+    # the NamePartStore of df, which was read from csv_path. The store saved next to the csv file is loaded if it was made from the same version
+    # of the file, otherwise the store is built and saved there. Either way it's remembered, so name_part_store(df) returns it later
+    path = name_part_store_path(csv_path)
+    fingerprint = csv_fingerprint(csv_path)
+    store = None
+    if os.path.exists(path):
+        store, saved_fingerprint = NamePartStore.load(path)
+        if saved_fingerprint != fingerprint or not store.positions.equals(df.index):
+            store = None
+    if store is None:
+        print(f"Decoding the name parts of {csv_path}")
+        store = NamePartStore.from_series(df["name_parts"])
+        store.save(path, fingerprint)
+    store.name_parts = df["name_parts"]
+    return remember_name_part_store(store)
@@ -6,6 +6,7 @@ from textFiltering import (
     filter_with_normalized_scores_revised,
 )
 from batchPostProcessing import test_with_name_pairs_new
+from comparisonBlocks import load_blocks, save_blocks
 
 
 def post_process(query_path, filter_function, block_size, output_path):
@@ -15,27 +16,24 @@ def post_process(query_path, filter_function, block_size, output_path):
         r"datasets\testset15-Zylbercweig-Laski\transliterated_em.csv",
     )
 
-    with open(r"app\blocks.json") as file:
-        # load the blocks created in the blocking phase and make the lists into sets again
-        blocks = json.load(file)
-        blocks = {int(k): set(v) for k, v in blocks.items()}
-        filtered_blocks = filter_function(blocks, df2, df1, block_size)
-        with open(query_path) as file:
-            output = ""
-            for line in file:
-                record_pair = json.loads(line)["custom_id"].split("#")
-                record = int(record_pair[0])
-                possible_match = int(record_pair[1])
-                if possible_match in filtered_blocks[record]:
-                    output += line
-        with open(output_path, "w") as file:
-            file.write(output)
+    # load the blocks created in the blocking phase
+    blocks = load_blocks(r"app\blocks.blocks")
+    filtered_blocks = filter_function(blocks, df2, df1, block_size)
+    with open(query_path) as file:
+        output = ""
+        for line in file:
+            record_pair = json.loads(line)["custom_id"].split("#")
+            record = int(record_pair[0])
+            possible_match = int(record_pair[1])
+            if possible_match in filtered_blocks[record]:
+                output += line
+    with open(output_path, "w") as file:
+        file.write(output)
 
 
 def post_process_phonetic(query_path, block_size):
-    with open(f"app/phonetic_blocks/{block_size}.json") as file:
-        filtered_blocks = json.load(file)
-        filtered_blocks = {int(k): set(v) for k, v in filtered_blocks.items()}
+    # NOTE the json files in app/phonetic_blocks are converted to .blocks files the first time they're used
+    filtered_blocks = load_blocks(f"app/phonetic_blocks/{block_size}.blocks").to_dict()
     with open(query_path) as file:
         # output = ""
         output = []
@@ -57,22 +55,12 @@ def create_block_files(filter_function):
         r"datasets\phonetic\Zylbercweig_phonetic.csv",
         r"datasets\testset15-Zylbercweig-Laski\transliterated_em.csv",
     )
-    with open(r"app\blocks.json") as file:
-        blocks = json.load(file)
-        blocks = {int(k): set(v) for k, v in blocks.items()}
-        for i in range(1, 21):
-            if not i == 20:
-                continue
-            filtered_blocks = filter_function(blocks, df2, df1, i * 10)
-            path = f"app/phonetic_blocks/{i*10}.json"
-            with open(path, "w", encoding="utf-8") as file:
-                filtered_blocks_new = {}
-                for k, v in filtered_blocks.items():
-                    array = []
-                    for item in v:
-                        array.append(item)
-                    filtered_blocks_new.update({k: array})
-                json.dump(filtered_blocks_new, file, indent=4)
+    blocks = load_blocks(r"app\blocks.blocks")
+    # filter once, keeping every record's ranked candidates, and take the blocks of every block size from them
+    ranked_blocks = filter_function(blocks, df2, df1, ranked=True)
+    ranked_blocks.save("app/phonetic_blocks/ranked.npz")
+    for i in range(1, 21):
+        save_blocks(ranked_blocks.blocks(i * 10), f"app/phonetic_blocks/{i*10}.blocks")
 
 
 def create_query_files(query_path, range_object=range(10, 200 + 1, 10)):
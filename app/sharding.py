@@ -0,0 +1,72 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pandas as pd
+
+
+def transform_csv_chunk(transform, chunk, output_sep=",", index=True, header=False, chunk_stats=None):
+    # apply transform to a chunk of a csv file in a worker process and return the result as csv text, and the result of chunk_stats if given
+    text = transform(chunk).to_csv(sep=output_sep, index=index, header=header)
+    return text, None if chunk_stats is None else chunk_stats()
+
+
+def transform_csv_sharded(
+    input_path,
+    output_path,
+    transform,
+    workers=None,
+    sep=",",
+    output_sep=None,
+    index=True,
+    chunk_size=10000,
+    initializer=None,
+    chunk_stats=None,
+    add_stats=None,
+):
+    # read input_path chunk_size rows at a time, apply transform (which must be picklable, e.g. a function defined at the top of a module)
+    # to the chunks in a pool of worker processes, and write the results to output_path in their original order.
+    # The file is only parsed once, here, and the chunks are sent to the workers, so the work of every worker is only transforming its chunks.
+    # At most two chunks per worker are waiting at a time, so memory stays bounded no matter the size of the file.
+    # Every column is read as a string and the index of the chunks continues across chunks, like in transform_csv_in_chunks.
+    # workers defaults to the number of cores. initializer is run once in every worker process before it transforms any chunks.
+    # chunk_stats is run in the worker after every chunk and add_stats in this process with what it returned, e.g. to count the cache hits of the workers
+    if output_sep is None:
+        output_sep = sep
+    if workers is None:
+        workers = os.cpu_count()
+    print(f"Transforming {input_path} with {workers} workers")
+
+    rows_written = 0
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file, ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer
+    ) as executor:
+        pending = deque()
+        chunks_read = 0
+
+        def write_next():
+            nonlocal rows_written
+            future, rows = pending.popleft()
+            text, stats = future.result()
+            output_file.write(text)
+            if add_stats is not None:
+                add_stats(stats)
+            rows_written += rows
+            print(f"Transformed {rows_written} rows", end="\r")
+
+        for chunk in pd.read_csv(input_path, sep=sep, dtype=str, chunksize=chunk_size):
+            if len(pending) >= workers * 2:
+                write_next()
+            # NOTE only the first chunk writes the header
+            pending.append(
+                (
+                    executor.submit(
+                        transform_csv_chunk, transform, chunk, output_sep, index, chunks_read == 0, chunk_stats
+                    ),
+                    len(chunk),
+                )
+            )
+            chunks_read += 1
+        while pending:
+            write_next()
+    print("")
+    return rows_written
@@ -0,0 +1,496 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+try:
+    from .comparisonBlocks import sorted_unique
+except ImportError:
+    # NOTE when imported from the app folder (like the other modules do), the app folder is on the path instead of the app package
+    from comparisonBlocks import sorted_unique
+
+# String similarities for many pairs of strings at once, computed with NumPy instead of one Python call per pair.
+# The results are the same as those of strsimpy (JaroWinkler().similarity, Levenshtein().distance and NormalizedLevenshtein().distance).
+# Every function takes two lists of strings of the same length and compares the strings at the same positions,
+# use one_to_many to compare a string with a list of strings and similarity_matrix to compare every string of a list with every string of another list.
+# Strings are encoded as rows of an array of code points, padded with a different negative number for each side so padding never matches.
+
+
+def encode_strings(strings, pad=-1):
+    # return an array with a row of code points for every string (padded with pad) and an array of the lengths of the strings
+    strings = np.asarray(list(strings), dtype=str)
+    if len(strings) == 0 or strings.dtype.itemsize == 0:
+        # NOTE there are no strings or all of them are empty, so there are no code points to view
+        return np.full((len(strings), 1), pad, dtype=np.int32), np.zeros(len(strings), dtype=np.int64)
+    lengths = np.char.str_len(strings).astype(np.int64)
+    codes = strings.view(np.uint32).reshape(len(strings), -1).astype(np.int32)
+    codes[np.arange(codes.shape[1]) >= lengths[:, None]] = pad
+    return codes, lengths
+
+
+def jaro_winkler(strings_0, strings_1, threshold=0.7):
+    codes_0, lengths_0 = encode_strings(strings_0, pad=-1)
+    codes_1, lengths_1 = encode_strings(strings_1, pad=-2)
+    return jaro_winkler_codes(codes_0, lengths_0, codes_1, lengths_1, threshold)
+
+
+def levenshtein(strings_0, strings_1):
+    codes_0, lengths_0 = encode_strings(strings_0, pad=-1)
+    codes_1, lengths_1 = encode_strings(strings_1, pad=-2)
+    return levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1)
+
+
+def normalized_levenshtein(strings_0, strings_1):
+    codes_0, lengths_0 = encode_strings(strings_0, pad=-1)
+    codes_1, lengths_1 = encode_strings(strings_1, pad=-2)
+    return normalized_levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1)
+
+
+def jaro_winkler_codes(codes_0, lengths_0, codes_1, lengths_1, threshold=0.7):
+    # the Jaro-Winkler similarity of encoded strings, following strsimpy's JaroWinkler step by step (including how it counts the common prefix)
+    pairs = len(lengths_0)
+    width = max(codes_0.shape[1], codes_1.shape[1])
+    codes_0 = pad_codes(codes_0, width, -1)
+    codes_1 = pad_codes(codes_1, width, -2)
+    # the longer string of every pair is max_codes (the second one if they're just as long)
+    swap = lengths_0 > lengths_1
+    max_codes = np.where(swap[:, None], codes_0, codes_1)
+    min_codes = np.where(swap[:, None], codes_1, codes_0)
+    max_lengths = np.maximum(lengths_0, lengths_1)
+    min_lengths = np.minimum(lengths_0, lengths_1)
+    ran = np.maximum(max_lengths / 2 - 1, 0).astype(np.int64)
+
+    # every character of the shorter string is matched with the first unmatched equal character of the longer string within ran of it
+    positions = np.arange(width)
+    rows = np.arange(pairs)
+    min_matched = np.zeros((pairs, width), dtype=bool)
+    max_matched = np.zeros((pairs, width), dtype=bool)
+    # NOTE characters past the end of every shorter string can't be matched
+    for mi in range(int(min_lengths.max(initial=0))):
+        window = (positions >= (mi - ran)[:, None]) & (positions < np.minimum(mi + ran + 1, max_lengths)[:, None])
+        candidates = window & ~max_matched & (max_codes == min_codes[:, mi, None])
+        xi = candidates.argmax(axis=1)
+        found = candidates[rows, xi] & (mi < min_lengths)
+        max_matched[rows[found], xi[found]] = True
+        min_matched[found, mi] = True
+    matches = min_matched.sum(axis=1)
+
+    # transpositions are the matched characters that differ when both strings' matched characters are put next to each other in order
+    differ = matched_codes(min_codes, min_matched) != matched_codes(max_codes, max_matched)
+    transpositions = (differ & (positions < matches[:, None])).sum(axis=1) // 2
+
+    # the prefix is the number of equal characters at the start of both strings, up to the length of the shorter one
+    different = (codes_0 != codes_1) | (positions >= min_lengths[:, None])
+    prefix = np.where(different.any(axis=1), different.argmax(axis=1), width)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        j = (matches / lengths_0 + matches / lengths_1 + (matches - transpositions) / matches) / 3
+        jw = np.where(
+            j > threshold,
+            j + np.minimum(0.1, 1.0 / max_lengths) * prefix * (1 - j),
+            j,
+        )
+    jw = np.where(matches == 0, 0.0, jw)
+    equal = (lengths_0 == lengths_1) & ((codes_0 == codes_1) | (positions >= lengths_0[:, None])).all(axis=1)
+    return np.where(equal, 1.0, jw)
+
+
+def matched_codes(codes, matched):
+    # move the matched characters of every string to the start of its row, keeping their order
+    rows, columns = np.nonzero(matched)
+    ranks = (np.cumsum(matched, axis=1) - 1)[rows, columns]
+    moved = np.zeros_like(codes)
+    moved[rows, ranks] = codes[rows, columns]
+    return moved
+
+
+def levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1):
+    # the Levenshtein distance of encoded strings, with the usual dynamic program done for every pair at once, one row at a time
+    pairs = len(lengths_0)
+    rows = np.arange(pairs)
+    previous = np.tile(np.arange(codes_1.shape[1] + 1, dtype=np.int64), (pairs, 1))
+    # NOTE pairs where the first string is empty are already done
+    distances = lengths_1.copy()
+    for i in range(codes_0.shape[1]):
+        current = np.empty_like(previous)
+        current[:, 0] = i + 1
+        cost = (codes_0[:, i, None] != codes_1).astype(np.int64)
+        substitutions = np.minimum(previous[:, :-1] + cost, previous[:, 1:] + 1)
+        for j in range(codes_1.shape[1]):
+            current[:, j + 1] = np.minimum(current[:, j] + 1, substitutions[:, j])
+        previous = current
+        done = lengths_0 == i + 1
+        distances[done] = previous[rows[done], lengths_1[done]]
+    return distances.astype(np.float64)
+
+
+def normalized_levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1):
+    # the Levenshtein distance divided by the length of the longer string (0 if both are empty)
+    distances = levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1)
+    longest = np.maximum(lengths_0, lengths_1)
+    return np.where(longest == 0, 0.0, distances / np.maximum(longest, 1))
+
+
+def pad_codes(codes, width, pad):
+    if codes.shape[1] >= width:
+        return codes
+    return np.pad(codes, ((0, 0), (0, width - codes.shape[1])), constant_values=pad)
+
+
+def one_to_many(similarity, string, strings):
+    # compare a string with every string of a list, e.g. one_to_many(jaro_winkler, "Emil", ["Emilie", "Emil"])
+    return similarity([string] * len(strings), strings)
+
+
+def similarity_matrix(codes_similarity, strings_0, strings_1, chunk_size=2**14):
+    # compare every string of strings_0 with every string of strings_1 and return a matrix with a row for every string of strings_0.
+    # codes_similarity is one of the functions that take encoded strings, e.g. jaro_winkler_codes.
+    # The strings are encoded once and compared in tiles of about chunk_size pairs to limit memory use.
+    # Both lists are sorted by length first, so the strings of a tile are about as long as each other and the tile only needs to be as wide as its longest strings
+    codes_0, lengths_0 = encode_strings(strings_0, pad=-1)
+    codes_1, lengths_1 = encode_strings(strings_1, pad=-2)
+    matrix = np.empty((len(lengths_0), len(lengths_1)))
+    if matrix.size == 0:
+        return matrix
+    order_0 = np.argsort(lengths_0, kind="stable")
+    order_1 = np.argsort(lengths_1, kind="stable")
+    columns_per_tile = min(len(order_1), 256)
+    rows_per_tile = max(1, chunk_size // columns_per_tile)
+    for start_0 in range(0, len(order_0), rows_per_tile):
+        print(f"Comparing strings {start_0}/{len(order_0)}", end="\r")
+        rows = order_0[start_0 : start_0 + rows_per_tile]
+        width_0 = max(1, int(lengths_0[rows].max()))
+        for start_1 in range(0, len(order_1), columns_per_tile):
+            columns = order_1[start_1 : start_1 + columns_per_tile]
+            width_1 = max(1, int(lengths_1[columns].max()))
+            tile_rows = np.repeat(rows, len(columns))
+            tile_columns = np.tile(columns, len(rows))
+            matrix[np.ix_(rows, columns)] = codes_similarity(
+                codes_0[tile_rows, :width_0],
+                lengths_0[tile_rows],
+                codes_1[tile_columns, :width_1],
+                lengths_1[tile_columns],
+            ).reshape(len(rows), len(columns))
+    print("")
+    return matrix
+
+
+def jaro_winkler_matrix(strings_0, strings_1):
+    return similarity_matrix(jaro_winkler_codes, strings_0, strings_1)
+
+
+def pairwise_matrix(similarity, strings_0, strings_1):
+    # the same matrix as similarity_matrix, but calling a function like strsimpy's JaroWinkler().similarity once for every pair of strings
+    return np.array(
+        [[similarity(string_0, string_1) for string_1 in strings_1] for string_0 in strings_0],
+        dtype=np.float64,
+    ).reshape(len(strings_0), len(strings_1))
+
+
+# ANCHOR similarity joins.
+# When only the pairs of strings that are at least threshold similar are needed, most pairs don't have to be compared at all.
+# Two strings can only be similar if they have enough characters in common: every character matched by Jaro-Winkler (and every character
+# of the common prefix) is a character both strings have, and an edit distance is at least the length of the longer string minus the
+# number of characters they have in common. So for every two lengths there's a fewest number of common characters (the minimum overlap)
+# that could still reach threshold, and pairs with too few are skipped without being compared:
+# first by length alone, then with prefix filtering (if two strings share at least c characters, then the first len - c + 1 characters
+# of each, ordered from the rarest character to the most common, share at least one), and finally by counting their common characters.
+# Only the pairs left are compared exactly.
+
+
+def jaro_winkler_minimum_overlap(lengths_0, lengths_1, threshold):
+    # the fewest common characters strings of these lengths need for their Jaro-Winkler similarity to possibly be at least threshold,
+    # or the length of the shorter string + 1 if it's impossible.
+    # With c common characters, the Jaro similarity is at most j = (c / len_0 + c / len_1 + 1) / 3 and the prefix is at most c long,
+    # so the Jaro-Winkler similarity is at most j + min(0.1, 1 / len_max) * c * (1 - j)
+    shortest = np.minimum(lengths_0, lengths_1)
+    longest = np.maximum(lengths_0, lengths_1)
+    overlap = np.where(longest == 0, 0, shortest + 1)
+    for c in range(int(shortest.max(initial=0)), 0, -1):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            j = (c / lengths_0 + c / lengths_1 + 1) / 3
+            bound = j + np.minimum(0.1, 1.0 / longest) * c * (1 - j)
+        # NOTE the bound is loosened a little, so rounding can't make it skip a pair that reaches threshold
+        overlap = np.where((c <= shortest) & (bound >= threshold - 1e-9), c, overlap)
+    return overlap
+
+
+def normalized_levenshtein_minimum_overlap(lengths_0, lengths_1, threshold):
+    # the fewest common characters strings of these lengths need for 1 - their normalized Levenshtein distance to possibly be at least threshold:
+    # the distance is at least len_max - c, and it can be at most (1 - threshold) * len_max
+    shortest = np.minimum(lengths_0, lengths_1)
+    longest = np.maximum(lengths_0, lengths_1)
+    overlap = longest - np.floor((1 - threshold) * longest + 1e-9).astype(np.int64)
+    return np.where(overlap > shortest, shortest + 1, np.maximum(overlap, 0))
+
+
+def normalized_levenshtein_similarity_codes(codes_0, lengths_0, codes_1, lengths_1):
+    return 1 - normalized_levenshtein_codes(codes_0, lengths_0, codes_1, lengths_1)
+
+
+def character_tokens(codes, lengths):
+    # every character of every string as a token that is different for every occurrence of a character in a string, e.g. "anna" has
+    # the tokens (a, 0), (n, 0), (n, 1) and (a, 1), so the number of tokens two strings share is the number of characters they have in common.
+    # Returns the strings and tokens as two flat arrays, sorted by string and then token
+    strings, positions = np.nonzero(np.arange(codes.shape[1]) < lengths[:, None])
+    characters = codes[strings, positions].astype(np.int64)
+    order = np.lexsort((positions, characters, strings))
+    strings = strings[order]
+    characters = characters[order]
+    new_group = np.concatenate([[True], (strings[1:] != strings[:-1]) | (characters[1:] != characters[:-1])])
+    group_starts = np.flatnonzero(new_group)
+    occurrences = np.arange(len(strings)) - np.repeat(group_starts, np.diff(np.append(group_starts, len(strings))))
+    return strings, (characters << 16) | occurrences
+
+
+def character_counts(codes, lengths, alphabet):
+    # how many times every character of alphabet (a sorted array) is in every string. Characters that aren't in alphabet aren't counted
+    strings, positions = np.nonzero(np.arange(codes.shape[1]) < lengths[:, None])
+    characters = codes[strings, positions]
+    columns = np.minimum(np.searchsorted(alphabet, characters), max(len(alphabet) - 1, 0))
+    known = alphabet[columns] == characters if len(alphabet) > 0 else np.zeros(len(characters), dtype=bool)
+    counts = np.zeros((len(lengths), len(alphabet)), dtype=np.uint8 if codes.shape[1] < 256 else np.int64)
+    np.add.at(counts, (strings[known], columns[known]), 1)
+    return counts
+
+
+def similarity_join(codes_similarity, minimum_overlap, strings_0, strings_1, threshold, chunk_size=2**20):
+    # find every pair of a string of strings_0 and a string of strings_1 whose similarity is at least threshold, without comparing
+    # the pairs that can't be (see above). codes_similarity is a function like jaro_winkler_codes and minimum_overlap the matching bound,
+    # like jaro_winkler_minimum_overlap. Returns the rows (positions in strings_0), columns (positions in strings_1) and similarities of the pairs
+    codes_0, lengths_0 = encode_strings(strings_0, pad=-1)
+    codes_1, lengths_1 = encode_strings(strings_1, pad=-2)
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    if len(lengths_0) == 0 or len(lengths_1) == 0:
+        return empty
+    # the minimum overlap of every two lengths. For the prefixes, every string uses the smallest minimum overlap with any length of the other list
+    overlaps = minimum_overlap(
+        np.arange(lengths_0.max() + 1)[:, None], np.arange(lengths_1.max() + 1)[None, :], threshold
+    )
+    present_0 = np.bincount(lengths_0) > 0
+    present_1 = np.bincount(lengths_1) > 0
+    prefix_overlap_0 = np.where(present_1[None, :], overlaps, np.iinfo(np.int64).max).min(axis=1)
+    prefix_overlap_1 = np.where(present_0[:, None], overlaps, np.iinfo(np.int64).max).min(axis=0)
+
+    # order the tokens from the rarest to the most common and keep the prefix of every string
+    strings_0_tokens, tokens_0 = character_tokens(codes_0, lengths_0)
+    strings_1_tokens, tokens_1 = character_tokens(codes_1, lengths_1)
+    tokens, frequencies = np.unique(np.concatenate([tokens_0, tokens_1]), return_counts=True)
+    ranks = np.empty(len(tokens), dtype=np.int64)
+    ranks[np.argsort(frequencies, kind="stable")] = np.arange(len(tokens))
+    prefix_0, prefix_strings_0 = token_prefixes(strings_0_tokens, ranks[np.searchsorted(tokens, tokens_0)], lengths_0, prefix_overlap_0)
+    prefix_1, prefix_strings_1 = token_prefixes(strings_1_tokens, ranks[np.searchsorted(tokens, tokens_1)], lengths_1, prefix_overlap_1)
+    order = np.argsort(prefix_1, kind="stable")
+    prefix_1 = prefix_1[order]
+    alphabet = np.unique(np.concatenate([codes_0[codes_0 >= 0], codes_1[codes_1 >= 0]]))
+    counts_0 = character_counts(codes_0, lengths_0, alphabet)
+    counts_1 = character_counts(codes_1, lengths_1, alphabet)
+    prefix_strings_1 = prefix_strings_1[order]
+
+    # every prefix token of strings_0 is looked up in the prefix tokens of strings_1, in chunks of strings of strings_0 with about chunk_size candidate pairs
+    starts = np.searchsorted(prefix_1, prefix_0, side="left")
+    sizes = np.searchsorted(prefix_1, prefix_0, side="right") - starts
+    string_sizes = np.bincount(prefix_strings_0, weights=sizes, minlength=len(lengths_0))
+    chunk_ends = np.searchsorted(
+        np.cumsum(string_sizes), np.arange(chunk_size, string_sizes.sum() + chunk_size, chunk_size), side="right"
+    )
+    results = [empty]
+    chunk_start = 0
+    for chunk_end in np.unique(np.append(np.maximum(chunk_ends, 1), len(lengths_0))):
+        print(f"Joining strings {chunk_start}/{len(lengths_0)}", end="\r")
+        entries = (prefix_strings_0 >= chunk_start) & (prefix_strings_0 < chunk_end)
+        chunk_start = chunk_end
+        entry_sizes = sizes[entries]
+        offsets = np.cumsum(entry_sizes) - entry_sizes
+        candidates = prefix_strings_1[np.repeat(starts[entries] - offsets, entry_sizes) + np.arange(int(entry_sizes.sum()))]
+        keys = sorted_unique((np.repeat(prefix_strings_0[entries], entry_sizes) << 32) | candidates)
+        rows = keys >> 32
+        columns = keys & 0xFFFFFFFF
+        # skip the pairs with too few common characters, then compare the rest
+        needed = overlaps[lengths_0[rows], lengths_1[columns]]
+        possible = needed <= np.minimum(lengths_0[rows], lengths_1[columns])
+        rows, columns, needed = rows[possible], columns[possible], needed[possible]
+        possible = np.minimum(counts_0[rows], counts_1[columns]).sum(axis=1) >= needed
+        rows, columns = rows[possible], columns[possible]
+        similarities = pair_similarities(codes_similarity, codes_0, lengths_0, codes_1, lengths_1, rows, columns)
+        found = similarities >= threshold
+        results.append((rows[found], columns[found], similarities[found]))
+    # NOTE empty strings have no tokens, so they're found separately
+    if overlaps[0, 0] == 0:
+        rows, columns = np.meshgrid(np.flatnonzero(lengths_0 == 0), np.flatnonzero(lengths_1 == 0), indexing="ij")
+        rows, columns = rows.ravel(), columns.ravel()
+        similarities = pair_similarities(codes_similarity, codes_0, lengths_0, codes_1, lengths_1, rows, columns)
+        found = similarities >= threshold
+        results.append((rows[found], columns[found], similarities[found]))
+    print("")
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def token_prefixes(strings, ranks, lengths, prefix_overlap):
+    # the first len - minimum overlap + 1 tokens of every string, ordered by rank, as arrays of ranks and strings
+    order = np.lexsort((ranks, strings))
+    strings = strings[order]
+    ranks = ranks[order]
+    starts = np.searchsorted(strings, np.arange(len(lengths)))
+    positions = np.arange(len(strings)) - starts[strings]
+    keep = positions < lengths[strings] - prefix_overlap[lengths[strings]] + 1
+    return ranks[keep], strings[keep]
+
+
+def pair_similarities(codes_similarity, codes_0, lengths_0, codes_1, lengths_1, rows, columns, chunk_size=2**14):
+    # the similarities of some pairs of encoded strings. The pairs are compared from the shortest to the longest in chunks,
+    # so every chunk is only as wide as its longest strings
+    similarities = np.empty(len(rows))
+    order = np.argsort(np.maximum(lengths_0[rows], lengths_1[columns]), kind="stable")
+    for start in range(0, len(order), chunk_size):
+        chunk = order[start : start + chunk_size]
+        chunk_rows, chunk_columns = rows[chunk], columns[chunk]
+        width_0 = max(1, int(lengths_0[chunk_rows].max()))
+        width_1 = max(1, int(lengths_1[chunk_columns].max()))
+        similarities[chunk] = codes_similarity(
+            codes_0[chunk_rows, :width_0], lengths_0[chunk_rows], codes_1[chunk_columns, :width_1], lengths_1[chunk_columns]
+        )
+    return similarities
+
+
+def jaro_winkler_join(strings_0, strings_1, threshold):
+    return similarity_join(jaro_winkler_codes, jaro_winkler_minimum_overlap, strings_0, strings_1, threshold)
+
+
+def normalized_levenshtein_join(strings_0, strings_1, threshold):
+    # the pairs whose similarity 1 - normalized Levenshtein distance is at least threshold
+    return similarity_join(
+        normalized_levenshtein_similarity_codes, normalized_levenshtein_minimum_overlap, strings_0, strings_1, threshold
+    )
+
+
+# ANCHOR similarity index.
+# A SimilarityIndex is an inverted index from the character tokens (see character_tokens) of a list of keys to the keys that have them.
+# It's made once and then searched for the keys that are at least threshold similar to any strings, with any threshold, using the same bounds
+# as the similarity joins: the postings of every token are sorted by the length of the keys, so only the keys with lengths that can reach threshold
+# are read, and only for the rarest len - minimum overlap + 1 tokens of a string (a key that has enough characters in common with the string
+# has at least one of them). The keys found are then filtered by counting their common characters and only the rest are compared exactly.
+# So a search reads a small part of the index instead of comparing a string with every key
+
+
+class SimilarityIndex:
+    def __init__(self, keys, codes_similarity=jaro_winkler_codes, minimum_overlap=jaro_winkler_minimum_overlap):
+        # codes_similarity and minimum_overlap work like in similarity_join
+        self.keys = list(keys)
+        self.codes_similarity = codes_similarity
+        self.minimum_overlap = minimum_overlap
+        self.codes, self.lengths = encode_strings(self.keys, pad=-2)
+        self.length_counts = np.bincount(self.lengths, minlength=1)
+        key_strings, key_tokens = character_tokens(self.codes, self.lengths)
+        self.tokens, self.frequencies = np.unique(key_tokens, return_counts=True)
+        # a posting is a token and the length of a key with it, as token position * (longest length + 1) + length, sorted, with the key in posting_keys
+        postings = np.searchsorted(self.tokens, key_tokens) * len(self.length_counts) + self.lengths[key_strings]
+        order = np.lexsort((key_strings, postings))
+        self.postings = postings[order]
+        self.posting_keys = key_strings[order]
+        # the keys sorted by length, for the lengths that need no common characters at all
+        self.keys_by_length = np.argsort(self.lengths, kind="stable")
+        self.alphabet = np.unique(self.codes[self.codes >= 0])
+        self.counts = character_counts(self.codes, self.lengths, self.alphabet)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, strings, threshold, chunk_size=2**20):
+        # the pairs of a string (rows, positions in strings) and a key (columns) that could be at least threshold similar, sorted by row and column
+        codes, lengths = encode_strings(strings, pad=-1)
+        empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        if len(lengths) == 0 or len(self.keys) == 0:
+            return empty
+        overlaps = self.minimum_overlap(
+            np.arange(lengths.max() + 1)[:, None], np.arange(len(self.length_counts))[None, :], threshold
+        )
+        key_lengths = np.arange(len(self.length_counts))
+        feasible = (overlaps <= np.minimum(np.arange(lengths.max() + 1)[:, None], key_lengths[None, :])) & (
+            self.length_counts[None, :] > 0
+        )
+        # the key lengths every string length can reach with at least one common character, and the fewest common characters of those
+        shared = feasible & (overlaps > 0)
+        lowest = np.where(shared.any(axis=1), np.argmax(shared, axis=1), 1)
+        highest = np.where(shared.any(axis=1), len(key_lengths) - 1 - np.argmax(shared[:, ::-1], axis=1), 0)
+        prefix_overlap = np.where(shared, overlaps, np.iinfo(np.int64).max).min(axis=1)
+
+        # the rarest tokens of every string (tokens that no key has are the rarest, and have no postings)
+        token_strings, tokens = character_tokens(codes, lengths)
+        positions = np.minimum(np.searchsorted(self.tokens, tokens), max(len(self.tokens) - 1, 0))
+        known = self.tokens[positions] == tokens if len(self.tokens) > 0 else np.zeros(len(tokens), dtype=bool)
+        frequencies = np.where(known, self.frequencies[positions] if len(self.tokens) > 0 else 0, 0)
+        # NOTE the ranks are the frequencies with the position of the token in self.tokens + 1 (0 if no key has it) as the last digits
+        ranks = frequencies * (len(self.tokens) + 1) + np.where(known, positions + 1, 0)
+        prefix_ranks, prefix_strings = token_prefixes(token_strings, ranks, lengths, prefix_overlap)
+        prefix_positions = prefix_ranks % (len(self.tokens) + 1) - 1
+        probed = prefix_positions >= 0
+        prefix_positions, prefix_strings = prefix_positions[probed], prefix_strings[probed]
+        string_lengths = lengths[prefix_strings]
+        starts = np.searchsorted(self.postings, prefix_positions * len(key_lengths) + lowest[string_lengths], side="left")
+        # NOTE a string length that can't reach any key length with a common character has an empty range (lowest > highest)
+        sizes = np.maximum(
+            np.searchsorted(self.postings, prefix_positions * len(key_lengths) + highest[string_lengths], side="right") - starts, 0
+        )
+
+        counts = character_counts(codes, lengths, self.alphabet)
+        string_sizes = np.bincount(prefix_strings, weights=sizes, minlength=len(lengths))
+        chunk_ends = np.searchsorted(
+            np.cumsum(string_sizes), np.arange(chunk_size, string_sizes.sum() + chunk_size, chunk_size), side="right"
+        )
+        results = [empty]
+        chunk_start = 0
+        for chunk_end in np.unique(np.append(np.maximum(chunk_ends, 1), len(lengths))):
+            entries = (prefix_strings >= chunk_start) & (prefix_strings < chunk_end)
+            chunk_start = chunk_end
+            entry_sizes = sizes[entries]
+            offsets = np.cumsum(entry_sizes) - entry_sizes
+            columns = self.posting_keys[np.repeat(starts[entries] - offsets, entry_sizes) + np.arange(int(entry_sizes.sum()))]
+            keys = sorted_unique((np.repeat(prefix_strings[entries], entry_sizes) << 32) | columns)
+            rows = keys >> 32
+            columns = keys & 0xFFFFFFFF
+            # skip the pairs with lengths that can't reach threshold or too few common characters
+            possible = feasible[lengths[rows], self.lengths[columns]]
+            rows, columns = rows[possible], columns[possible]
+            possible = np.minimum(counts[rows], self.counts[columns]).sum(axis=1) >= overlaps[lengths[rows], self.lengths[columns]]
+            results.append((rows[possible], columns[possible]))
+        # NOTE the keys of the lengths that need no common characters (like empty keys) can't be found with tokens, so they're all candidates
+        sorted_lengths = self.lengths[self.keys_by_length]
+        for length in np.unique(lengths).tolist():
+            for key_length in np.flatnonzero(feasible[length] & (overlaps[length] == 0)).tolist():
+                length_keys = self.keys_by_length[
+                    np.searchsorted(sorted_lengths, key_length) : np.searchsorted(sorted_lengths, key_length, side="right")
+                ]
+                rows = np.flatnonzero(lengths == length)
+                results.append((np.repeat(rows, len(length_keys)), np.tile(length_keys, len(rows))))
+        keys = sorted_unique(np.concatenate([(rows << 32) | columns for rows, columns in results]))
+        return keys >> 32, keys & 0xFFFFFFFF
+
+    def search(self, strings, threshold, similarity=None):
+        # the pairs of a string (rows, positions in strings) and a key (columns) that are at least threshold similar, and their similarities,
+        # like the result of a similarity join of strings and the keys. The candidates are compared with codes_similarity,
+        # or with a function like strsimpy's JaroWinkler().similarity one pair at a time if similarity is given
+        strings = list(strings)
+        rows, columns = self.candidates(strings, threshold)
+        if similarity is not None:
+            similarities = np.array(
+                [similarity(strings[row], self.keys[column]) for row, column in zip(rows.tolist(), columns.tolist())],
+                dtype=np.float64,
+            )
+        else:
+            codes, lengths = encode_strings(strings, pad=-1)
+            similarities = pair_similarities(self.codes_similarity, codes, lengths, self.codes, self.lengths, rows, columns)
+        found = similarities >= threshold
+        return rows[found], columns[found], similarities[found]
+
+    def threshold_matrix(self, strings, threshold, similarity=None):
+        # the same as threshold_matrix(join, strings, keys, threshold), see search
+        strings = list(strings)
+        rows, columns, similarities = self.search(strings, threshold, similarity)
+        return csr_matrix((similarities, (rows, columns)), shape=(len(strings), len(self.keys)))
+
+
+def threshold_matrix(join, strings_0, strings_1, threshold):
+    # the same matrix as similarity_matrix, except that the similarities below threshold are left out, which is all the filters that only compare
+    # similarities to a threshold need. join is a function like jaro_winkler_join. Only the pairs that reach threshold are stored,
+    # as a scipy.sparse.csr_matrix: the keys (columns) of row i are indices[indptr[i]:indptr[i + 1]] and their similarities data[indptr[i]:indptr[i + 1]]
+    rows, columns, similarities = join(strings_0, strings_1, threshold)
+    return csr_matrix((similarities, (rows, columns)), shape=(len(strings_0), len(strings_1)))
@@ -1,16 +1,28 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import cache
+import inspect
+from itertools import permutations
 import json
+import multiprocessing
 import pandas as pd
 import winsound
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import issparse
 from strsimpy.jaro_winkler import JaroWinkler
+from comparisonBlocks import count_pairs, load_blocks, save_blocks, sorted_unique, RankedBlocks
+from blockEvaluation import match_evaluator
+from namePartStore import load_name_part_store, name_part_store
+from similarity import SimilarityIndex, jaro_winkler_matrix, pairwise_matrix
 
 
 def load_data(filepath1, filepath2, matches_path):
     df1 = pd.read_csv(filepath1, sep=",", header=0)
+    load_name_part_store(filepath1, df1)
 
     df2 = pd.read_csv(filepath2, sep=",", header=0)
+    load_name_part_store(filepath2, df2)
 
     matches = pd.read_csv(matches_path, sep="\t", header=0)
 
@@ -23,13 +35,13 @@ def create_parts_dictionary(df, allowed_records=None):
     # so if we do name_parts_indexes["Emil"] we get the set of indexes of all records that have "Emil" as a name part
     # Most sets will probably have just a single entry, but some names are much more common than others!
     # Use allowed_records to specify indexes to include in the dictionary. If it is None, all relevant indexes are included.
-    for index, row in df.iterrows():
-        name_parts = []
+    # The name parts are read from the NamePartStore of df, so they're only decoded once
+    store = name_part_store(df)
+    for index in df.index:
         if allowed_records is not None and index not in allowed_records:
             break
-        try:
-            name_parts = json.loads(row["name_parts"]).values()
-        except (json.JSONDecodeError, TypeError):
+        name_parts = store.parts(index)
+        if name_parts is None:
             # print(f"Error decoding name parts. Skipping record {index}")
             continue
         for name_part in name_parts:
@@ -52,319 +64,561 @@ def create_parts_count_dictionary(name_parts_indexes):
     return parts_count
 
 
-def filter_with_set_union(blocks, df, blocks_df, similarity_threshold=0.65):
+jaro_winkler = JaroWinkler()
+
+
+class NamePartScores:
+    # the similarities between the name parts of the records in df and the name parts of the records in blocks_df, used by the filter functions.
+    # Instead of comparing every name part of every record to every key of name_parts_indexes (and so comparing the same name parts over and over),
+    # every distinct name part of df is compared to every key once, which gives a matrix with a row for every distinct name part of df
+    # and a column for every key. The scores of records are then found by looking up the rows of their name parts.
+    # Get it with name_part_scores, which reuses it for every filter function and block size used with the same dataframes (or a part of df).
+    # With vectorized=True the matrix is computed with the NumPy Jaro-Winkler of similarity.py, otherwise with strsimpy one pair at a time
+    # (both give the same scores). If only similarities of at least similarity_threshold are needed, give similarity_threshold
+    # to only compare every name part with the keys that the SimilarityIndex of the keys finds for it. The matrix is then a scipy.sparse.csr_matrix
+    # of only the similarities that reach the threshold (the others are 0), which matching_records and threshold_points read directly
+    def __init__(self, df, blocks_df, vectorized=True, similarity_threshold=None):
+        self.name_parts_indexes = create_parts_dictionary(blocks_df)
+        self.parts_count = create_parts_count_dictionary(self.name_parts_indexes)
+        self.keys = list(self.name_parts_indexes)
+        self.size = int(max(blocks_df.index, default=-1)) + 1
+        self.df_name_parts = df["name_parts"].copy()
+
+        # the (key, record) pairs of name_parts_indexes in the order the filter functions used to go through them,
+        # which decides the order of records with the same score. The records of a key are contiguous, starting at key_starts[key]
+        key_columns = []
+        key_records = []
+        for column, key in enumerate(self.keys):
+            for record in self.name_parts_indexes[key]:
+                key_columns.append(column)
+                key_records.append(record)
+        self.key_columns = np.array(key_columns, dtype=np.int64)
+        self.key_records = np.array(key_records, dtype=np.int64)
+        self.key_sizes = np.bincount(self.key_columns, minlength=len(self.keys))
+        # the columns of the name parts of every record, in the order of the keys, and where each of them is in key_records
+        order = np.argsort(self.key_records, kind="stable")
+        self.record_columns = self.key_columns[order]
+        self.record_key_positions = order
+        self.record_starts = np.searchsorted(self.key_records[order], np.arange(self.size + 1))
+        self.record_parts = np.diff(self.record_starts)
+
+        # the order records are first found in when going through name_parts_indexes, followed by the records without name parts
+        _, first = np.unique(self.key_records, return_index=True)
+        with_parts = self.key_records[np.sort(first)]
+        self.index_order = np.asarray(blocks_df.index, dtype=np.int64)
+        without_parts = self.index_order[~np.isin(self.index_order, with_parts)]
+        found_order = np.concatenate([with_parts, without_parts])
+        self.found_position = np.zeros(self.size, dtype=np.int64)
+        self.found_position[found_order] = np.arange(len(found_order))
+        self.index_position = np.zeros(self.size, dtype=np.int64)
+        self.index_position[self.index_order] = np.arange(len(self.index_order))
+        self.in_index = np.zeros(self.size, dtype=bool)
+        self.in_index[self.index_order] = True
+
+        # the rows of the name parts of every record in df, or None if its name parts can't be decoded.
+        # The rows are the distinct name parts of df, taken from its NamePartStore
+        store = name_part_store(df)
+        part_ids = {index: store.part_ids(index) for index in df.index}
+        used = sorted_unique(
+            np.concatenate([np.empty(0, dtype=np.int32)] + [ids for ids in part_ids.values() if ids is not None])
+        )
+        vocabulary = [store.strings[part] for part in used.tolist()]
+        self.rows = {
+            index: None if ids is None else np.searchsorted(used, ids).astype(np.int64)
+            for index, ids in part_ids.items()
+        }
+        print(f"Comparing {len(vocabulary)} distinct name parts to {len(self.keys)} keys")
+        if similarity_threshold is not None:
+            self.matrix = key_similarity_index(self.keys).threshold_matrix(
+                vocabulary, similarity_threshold, None if vectorized else jaro_winkler.similarity
+            )
+        elif vectorized:
+            self.matrix = jaro_winkler_matrix(vocabulary, self.keys)
+        else:
+            self.matrix = pairwise_matrix(jaro_winkler.similarity, vocabulary, self.keys)
+
+    def covers(self, df):
+        # whether every record of df was in the df these scores were made for, with the same name parts
+        return bool(df.index.isin(self.df_name_parts.index).all()) and self.df_name_parts.reindex(df.index).equals(df["name_parts"])
+
+    def similarities(self, index):
+        # the similarities of the name parts of a record in df (rows) to every key (columns)
+        if issparse(self.matrix):
+            return self.matrix[self.rows[index]].toarray()
+        return self.matrix[self.rows[index]]
+
+    def candidates(self, block):
+        # the records of a block that are in blocks_df, as an array
+        block = np.fromiter(block, dtype=np.int64, count=len(block))
+        block = block[(block >= 0) & (block < self.size)]
+        return block[self.in_index[block]]
+
+    def candidate_entries(self, candidates):
+        # the keys (columns) of the name parts of some records of blocks_df, where the columns of every candidate start
+        # and where those name parts are in key_records
+        starts = self.record_starts[candidates]
+        sizes = self.record_parts[candidates]
+        offsets = np.cumsum(sizes) - sizes
+        entries = np.repeat(starts - offsets, sizes) + np.arange(int(sizes.sum()))
+        return self.record_columns[entries], offsets, self.record_key_positions[entries]
+
+    def candidate_similarities(self, index, candidates):
+        # the similarities of the name parts of a record in df (rows) to the name parts of some records of blocks_df (columns),
+        # only looking up the columns of those records, so the cost depends on the size of the block instead of the size of blocks_df.
+        # Also returns where the columns of every candidate start and where those name parts are in key_records
+        columns, offsets, key_positions = self.candidate_entries(candidates)
+        if issparse(self.matrix):
+            similarities = self.matrix[self.rows[index]][:, columns].toarray()
+        else:
+            similarities = self.matrix[np.ix_(self.rows[index], columns)]
+        return similarities, offsets, key_positions
+
+    def key_hits(self, index, columns, similarity_threshold):
+        # for every key in columns, the number of name parts of a record in df that are at least similarity_threshold similar to it,
+        # and the first of those name parts (its position in the record's rows, -1 if there isn't one)
+        rows = self.rows[index]
+        if not issparse(self.matrix):
+            hits = self.matrix[np.ix_(rows, columns)] >= similarity_threshold
+            counts = hits.sum(axis=0)
+            return counts, np.where(counts > 0, hits.argmax(axis=0), -1)
+        # only the keys that reach the threshold are stored, so the keys of the record's rows are looked up instead of every column:
+        # the (key, row) pairs are sorted, so the pairs of a key are contiguous and the first one has its first row
+        starts = self.matrix.indptr[rows]
+        sizes = self.matrix.indptr[rows + 1] - starts
+        offsets = np.cumsum(sizes) - sizes
+        entries = np.repeat(starts - offsets, sizes) + np.arange(int(sizes.sum()))
+        found = self.matrix.data[entries] >= similarity_threshold
+        keys = self.matrix.indices[entries][found].astype(np.int64)
+        parts = np.repeat(np.arange(len(rows)), sizes)[found]
+        order = np.lexsort((parts, keys))
+        keys, parts = keys[order], parts[order]
+        lows = np.searchsorted(keys, columns, side="left")
+        counts = np.searchsorted(keys, columns, side="right") - lows
+        first = np.full(len(columns), -1, dtype=np.int64)
+        first[counts > 0] = parts[lows[counts > 0]]
+        return counts, first
+
+    def matching_records(self, index, candidates, similarity_threshold):
+        # the candidates with a name part at least similarity_threshold similar to a name part of a record in df
+        candidates = candidates[self.record_parts[candidates] > 0]
+        if len(candidates) == 0 or len(self.rows[index]) == 0:
+            return set()
+        columns, offsets, _ = self.candidate_entries(candidates)
+        counts, _ = self.key_hits(index, columns, similarity_threshold)
+        return set(candidates[np.logical_or.reduceat(counts > 0, offsets)].tolist())
+
+    def best_part_scores(self, index, candidates):
+        # the highest similarity of any name part of a record in df to any name part of every candidate (0 for candidates without name parts)
+        scores = np.zeros(len(candidates))
+        with_parts = self.record_parts[candidates] > 0
+        similarities, offsets, _ = self.candidate_similarities(index, candidates[with_parts])
+        if len(similarities) > 0 and len(offsets) > 0:
+            scores[with_parts] = np.maximum.reduceat(similarities.max(axis=0), offsets)
+        return scores
+
+    def threshold_points(self, index, candidates, similarity_threshold):
+        # the number of (name part of a record in df, name part of a candidate) pairs that are at least similarity_threshold similar
+        # for every candidate (which must have name parts), and the first of those pairs in the order filter_with_threshold_scores used to go through them,
+        # as part * len(key_records) + the position of the name part of the candidate in key_records (inf if there isn't one)
+        points = np.zeros(len(candidates))
+        first_point = np.full(len(candidates), np.inf)
+        if len(candidates) == 0 or len(self.rows[index]) == 0:
+            return points, first_point
+        columns, offsets, key_positions = self.candidate_entries(candidates)
+        counts, first = self.key_hits(index, columns, similarity_threshold)
+        points = np.add.reduceat(counts, offsets).astype(np.float64)
+        pair_positions = np.where(counts > 0, first * len(self.key_records) + key_positions, np.inf)
+        first_point = np.minimum.reduceat(pair_positions, offsets)
+        return points, first_point
+
+    def assignment_scores(self, similarities, candidates):
+        # for every candidate (which must have name parts), the highest sum of similarities of disjoint pairs of name parts of a record in df
+        # (the rows of similarities) and the candidate, divided by the number of pairs. See filter_with_normalized_scores_revised.
+        # The candidates with the same number of name parts have matrices of the same shape, so they're solved together with assignment_maxima
+        scores = np.zeros(len(candidates))
+        parts = self.record_parts[candidates]
+        for count in np.unique(parts).tolist():
+            batch = np.flatnonzero(parts == count)
+            columns = self.record_columns[self.record_starts[candidates[batch]][:, None] + np.arange(count)]
+            matrices = similarities[:, columns].transpose(1, 0, 2)
+            scores[batch] = assignment_maxima(matrices) / min(matrices.shape[1:])
+        return scores
+
+    def tie_positions(self, index, candidates):
+        # the order of candidates with the same score: the order the filter functions used to find them in, so the blocks are exactly the same as before
+        return (self.found_position if len(self.rows[index]) > 0 else self.index_position)[candidates]
+
+    def best_records(self, index, candidates, scores, block_size):
+        # the block_size candidates with the best scores
+        return set(candidates[top_k(scores, self.tie_positions(index, candidates), block_size)].tolist())
+
+
+@cache
+def injective_maps(n, m):
+    # every way to map n things to n different things out of m, as an array with a row for every map
+    return np.array(list(permutations(range(m), n)), dtype=np.int64).reshape(-1, n)
+
+
+def assignment_maxima(matrices, max_maps=720):
+    # the highest sum of entries of every matrix of a stack of matrices of the same shape, with at most one entry in every row and column
+    # and as many entries as the matrix has rows or columns (whichever is fewer), like linear_sum_assignment with maximize=True.
+    # Small matrices (like almost all matrices of name parts) are solved together by trying every assignment, and the rest with linear_sum_assignment.
+    # The entries are always added in the order of their rows like linear_sum_assignment's results, so the sums are exactly the same
+    # (except when several assignments have about the highest sum, since their sums can differ in the last bits, so those matrices are also
+    # solved with linear_sum_assignment to get the one it chooses)
+    count, rows, columns = matrices.shape
+    if count == 0 or rows == 0 or columns == 0:
+        return np.zeros(count)
+    if rows <= columns and len(injective_maps(min(rows, columns), max(rows, columns))) <= max_maps:
+        # every row gets a different column
+        maps = injective_maps(rows, columns)
+        values = matrices[:, np.arange(rows), maps]
+    elif rows > columns and len(injective_maps(columns, rows)) <= max_maps:
+        # every column gets a different row, and the rows without one add 0
+        maps = injective_maps(columns, rows)
+        values = np.zeros((count, len(maps), rows))
+        values[:, np.arange(len(maps))[:, None], maps] = matrices[:, maps, np.arange(columns)]
+    else:
+        return linear_sum_assignment_maxima(matrices)
+    sums = values[:, :, 0]
+    for row in range(1, values.shape[2]):
+        sums = sums + values[:, :, row]
+    maxima = sums.max(axis=1)
+    tied = np.flatnonzero((sums >= maxima[:, None] - 1e-12).sum(axis=1) > 1)
+    maxima[tied] = linear_sum_assignment_maxima(matrices[tied])
+    return maxima
+
+
+def linear_sum_assignment_maxima(matrices):
+    maxima = np.empty(len(matrices))
+    for i, matrix in enumerate(matrices):
+        row_indexes, col_indexes = linear_sum_assignment(matrix, maximize=True)
+        maxima[i] = matrix[row_indexes, col_indexes].sum()
+    return maxima
+
+
+def add_ranked(ranked_blocks, index, candidates, scores, positions):
+    # add the candidates of a record ranked from the best score to the worst (the lowest positions first when scores are the same)
+    # to the lists of records, candidates and scores that become RankedBlocks
+    order = np.lexsort((positions, -scores))
+    ranked_blocks[0].append(index)
+    ranked_blocks[1].append(candidates[order])
+    ranked_blocks[2].append(scores[order])
+
+
+def add_skipped(ranked_blocks, index):
+    # records that are skipped (because of bad name parts) get no candidates, so RankedBlocks always have every record of df,
+    # whichever filter function made them
+    add_ranked(ranked_blocks, index, np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+
+
+def top_k(scores, positions, k):
+    # the indexes of the k highest scores, where the lowest positions win ties (positions must be unique).
+    # Only the scores at the cut are sorted, using a partial selection (np.partition) instead of sorting all of them
+    if len(scores) <= k:
+        return np.arange(len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    cut = np.partition(scores, len(scores) - k)[len(scores) - k]
+    above = np.flatnonzero(scores > cut)
+    tied = np.flatnonzero(scores == cut)
+    missing = k - len(above)
+    if missing < len(tied):
+        tied = tied[np.argpartition(positions[tied], missing - 1)[:missing]]
+    return np.concatenate([above, tied])
+
+
+name_part_scores_cache = {}
+# the SimilarityIndex of the last keys, which is kept even when the NamePartScores aren't, so it's reused for every similarity threshold
+similarity_index_cache = []
+
+
+def key_similarity_index(keys):
+    for index in similarity_index_cache:
+        if index.keys == keys:
+            return index
+    similarity_index_cache.clear()
+    similarity_index_cache.append(SimilarityIndex(keys))
+    return similarity_index_cache[0]
+
+
+def name_part_scores(df, blocks_df, vectorized=True, similarity_threshold=None):
+    # get the NamePartScores of df and blocks_df, reusing the last ones if they were made for the same blocks_df and settings
+    # and every record of df (so filtering a part of df, like parallel_filter's workers do, doesn't compare anything again)
+    key = (vectorized, similarity_threshold, tuple(blocks_df.index), tuple(blocks_df["name_parts"]))
+    scores = name_part_scores_cache.get(key)
+    if scores is None or not scores.covers(df):
+        # NOTE only the scores of the last dataframes are kept, since the matrix can be big
+        name_part_scores_cache.clear()
+        scores = NamePartScores(df, blocks_df, vectorized, similarity_threshold)
+        name_part_scores_cache.update({key: scores})
+    return scores
+
+
+def filter_with_set_union(blocks, df, blocks_df, similarity_threshold=0.65, vectorized=True, similarity_join=False):
     # given pairwise comparison blocks which map records from a dataset df to records from a dataset blocks_df, create new pairwise comparison blocks:
     # Since transliteration doesn't produce the exact equivalent names, we can't just lookup our name parts in other records,
     # so we iterate over the keys in name_parts_indexes and test for similarity instead.
-    # When similarity is above a set threshold, add all records with that key to the comparison blocks for the current record
+    # When similarity is above a set threshold, add all records with that key to the comparison blocks for the current record.
+    # With similarity_join=True, every name part is only compared with the keys that can reach the threshold (see NamePartScores and SimilarityIndex),
+    # which is much faster for high thresholds
 
-    name_parts_indexes = create_parts_dictionary(blocks_df)
+    scores = name_part_scores(df, blocks_df, vectorized, similarity_threshold if similarity_join else None)
 
     filtered_blocks = {}
-    for index, row in df.iterrows():
+    for index in df.index:
         # a comparison block is an index of a record and a set of all the indexes of records that it might match with
         print(
             f"Filtering record {index}",
             end="\r",
         )
         filtered_blocks.update({index: set()})
-        name_parts = []
-        try:
-            name_parts = json.loads(row["name_parts"]).values()
-        except json.JSONDecodeError:
+        if scores.rows[index] is None:
             print(
                 f"Skipped record {index} due to bad name parts.                                "
             )
             continue
-        for name_part in name_parts:
-            for key in name_parts_indexes:
-                if JaroWinkler().similarity(name_part, key) >= similarity_threshold:
-                    # if the name_part is close enough to the key, union the current block with the new possible matches.
-                    # NOTE possible matches are only included if they're already in the record's block! Hence the intersection with blocks[index].
-                    possible_matches = name_parts_indexes[key]
-                    filtered_blocks.update(
-                        {
-                            index: (filtered_blocks.get(index)).union(
-                                possible_matches.intersection(blocks[index])
-                            )
-                        }
-                    )
+        # NOTE possible matches are only included if they're already in the record's block, so only the records in the block are compared
+        filtered_blocks.update(
+            {index: scores.matching_records(index, scores.candidates(blocks[index]), similarity_threshold)}
+        )
     print("\n")
     return filtered_blocks
 
 
-def filter_with_part_scores(blocks, df, blocks_df, block_size=200):
+def filter_with_part_scores(blocks, df, blocks_df, block_size=200, vectorized=True, ranked=False):
     # instead of using a set union, assign a score to each record based on the most similar (or least distant) name part from some target record,
     # and then place the n records (that intersect with the input block for the target record) with the best score in the block for the target record, with n = block_size.
+    # With ranked=True, every record's whole block is returned ranked with its scores as RankedBlocks instead, which gives the filtered blocks of any block_size.
+    # Records with bad name parts are left out of the filtered blocks, but get an empty list of candidates in the RankedBlocks
 
-    name_parts_indexes = create_parts_dictionary(blocks_df)
+    scores = name_part_scores(df, blocks_df, vectorized)
 
     filtered_blocks = {}
+    ranked_blocks = ([], [], [])
 
-    for index, row in df.iterrows():
+    for index in df.index:
         # a comparison block is an index of a record and a set of all the indexes of records that it might match with
         print(
             f"Filtering record {index}",
             end="\r",
         )
-        name_parts = []
-        try:
-            name_parts = json.loads(row["name_parts"]).values()
-        except json.JSONDecodeError:
+        if scores.rows[index] is None:
             print(
                 f"Skipped record {index} due to bad name parts.                                "
             )
+            if ranked:
+                add_skipped(ranked_blocks, index)
             continue
-        # scoreboard will map records to scores which we use to find out what to include in our filtered blocks
-        scoreboard = {}
-        for name_part in name_parts:
-            for key in name_parts_indexes:
-                score = JaroWinkler().similarity(name_part, key)
-                for record in name_parts_indexes[key]:
-                    # only update the scoreboard if the new score is greater than the score that was there already
-                    scoreboard.update({record: max(scoreboard.get(record, 0), score)})
-        # make sure all records have a score in the scoreboard in order to guarantee the specified number of pairwise comparisons (if the input block is large enough to support it)
-        for record in list(blocks_df.index):
-            if scoreboard.get(record, None) == None:
-                scoreboard.update({record: 0})
-        # remove from the scoreboard any records that are not in the comparison block for the current record
-        scoreboard = {
-            record: scoreboard[record]
-            for record in scoreboard
-            if record in blocks[index]
-        }
-        # now sort the scoreboard records by score and put the n best records in the block with n = block_size
-        # NOTE if distance is used as score instead of a similarity, simply let reverse=False instead of reverse=True
-        best_records = sorted(
-            scoreboard, key=lambda record: scoreboard[record], reverse=True
-        )[:block_size]
-        filtered_blocks.update({index: set(best_records)})
+        # every record of the block gets the score of its most similar name part, and records without name parts get 0
+        candidates = scores.candidates(blocks[index])
+        record_scores = scores.best_part_scores(index, candidates)
+        if ranked:
+            add_ranked(ranked_blocks, index, candidates, record_scores, scores.tie_positions(index, candidates))
+            continue
+        best_records = scores.best_records(index, candidates, record_scores, block_size)
+        filtered_blocks.update({index: best_records})
     print("\n")
+    if ranked:
+        return RankedBlocks.from_lists(*ranked_blocks)
     return filtered_blocks
 
 
-def filter_with_normalized_scores_revised(blocks, df, blocks_df, block_size=100):
+def filter_with_normalized_scores_revised(blocks, df, blocks_df, block_size=100, vectorized=True, ranked=False):
     # a revision of filter_with_normalized_scores with the intention of getting closer to the original idea: Instead of summing up the maximum score for each name part,
     # we try to find the maximum score possible for disjoint pairs of name parts i.e. if we have "Emil Larsen" and "Emilie Larson",
     # then we only sum up the similarity of the pair "Emil" and "Emilie" and the pair "Larsen" and "Larson" (since those pairs maximize the sum of pairs' similarities),
     # and then divide by the number of pairs to normalize the score. Thus, we essentially have to solve an "Assignment Problem" for each pair of records from df and blocks_df.
+    # ranked works like in filter_with_part_scores
 
-    name_parts_indexes = create_parts_dictionary(blocks_df)
-    parts_count = create_parts_count_dictionary(name_parts_indexes)
+    scores = name_part_scores(df, blocks_df, vectorized)
 
     filtered_blocks = {}
+    ranked_blocks = ([], [], [])
 
-    for index, row in df.iterrows():
+    for index in df.index:
         # a comparison block is an index of a record and a set of all the indexes of records that it might match with
-
-        # REVIEW: this part is intended to help filter giant datasets faster. Try to remove it and see if filtering happens faster or slower
-        # name_parts_indexes = create_parts_dictionary(
-        #    blocks_df, allowed_records=blocks[index]
-        # )
-        # end of that part
-
         print(
             f"Filtering record {index}",
             end="\r",
         )
-        name_parts = []
-        try:
-            name_parts = json.loads(row["name_parts"]).values()
-        except json.JSONDecodeError:
+        if scores.rows[index] is None:
             print(
                 f"Skipped record {index} due to bad name parts.                                "
             )
+            if ranked:
+                add_skipped(ranked_blocks, index)
             continue
-        # scoreboard will map records to scores which we use to find out what to include in our filtered blocks
-        scoreboard = {}
-        # similarities will map records to an list of similarity scores which we concatenate as we find them.
-        # If len(name_parts) = n and there are m name parts in a record, then the list can be turned into a matrix of shape n x m
-        similarities = {}
-        for name_part in name_parts:
-            for key in name_parts_indexes:
-                score = JaroWinkler().similarity(name_part, key)
-                for record in name_parts_indexes[key]:
-                    # append the score to the list
-                    similarities.update(
-                        {record: similarities.get(record, list()) + [score]}
-                    )
-        # with all the similarities lists filled out, we find the best combination of name part pairs and calculate a score for each record
-        for record in similarities:
-            if len(name_parts) > 0 and parts_count[record] > 0:
-                array = np.array(similarities[record])
-                matrix = array.reshape(len(name_parts), parts_count[record])
-                row_indexes, col_indexes = linear_sum_assignment(matrix, maximize=True)
-                # a record's score is the sum of the matrix elements that maximize the Assignment Problem value divided by the number of elements chosen
-                scoreboard.update(
-                    {record: matrix[row_indexes, col_indexes].sum() / len(row_indexes)}
-                )
-            else:
-                scoreboard.update({record: 0})
-        # make sure all records have a score in the scoreboard in order to guarantee the specified number of pairwise comparisons (if the input block is large enough to support it)
-        for record in list(blocks_df.index):
-            if scoreboard.get(record, None) == None:
-                scoreboard.update({record: 0})
-        # remove from the scoreboard any records that are not in the comparison block for the current record
-        scoreboard = {
-            record: scoreboard[record]
-            for record in scoreboard
-            if record in blocks[index]
-        }
-        # now sort the scoreboard records by score and put the n best records in the block with n = block_size
-        # NOTE if distance is used as score instead of a similarity, simply let reverse=False instead of reverse=True
-        best_records = sorted(
-            scoreboard, key=lambda record: scoreboard[record], reverse=True
-        )[:block_size]
-        filtered_blocks.update({index: set(best_records)})
+        candidates = scores.candidates(blocks[index])
+        similarities = scores.similarities(index)
+        # records without name parts (and every record if this one has no name parts) get a score of 0.
+        # NOTE only the records in the block get a score, since the others can't be chosen anyway
+        record_scores = np.zeros(len(candidates))
+        if len(similarities) > 0:
+            with_parts = scores.record_parts[candidates] > 0
+            record_scores[with_parts] = scores.assignment_scores(similarities, candidates[with_parts])
+        if ranked:
+            add_ranked(ranked_blocks, index, candidates, record_scores, scores.tie_positions(index, candidates))
+            continue
+        best_records = scores.best_records(index, candidates, record_scores, block_size)
+        filtered_blocks.update({index: best_records})
     print("\n")
+    if ranked:
+        return RankedBlocks.from_lists(*ranked_blocks)
     return filtered_blocks
 
 
 def filter_with_threshold_scores(
-    blocks, df, blocks_df, block_size=300, similarity_threshold=1
+    blocks, df, blocks_df, block_size=300, similarity_threshold=1, vectorized=True, similarity_join=False, ranked=False
 ):
     # the same idea as filter_with_set_union, except we add a point to the relevant records instead of joining them with the block
     # afterwards we normalize the scores by dividing each record's score with the number of name parts in the records
     # and then place the n records with the best score in the block for the target record, with n = block_size.
-    # if the two datasets are the same, we remove any mapping from an index to the same index, since that's a trivial match
+    # if the two datasets are the same, we remove any mapping from an index to the same index, since that's a trivial match.
+    # similarity_join works like in filter_with_set_union and ranked like in filter_with_part_scores
 
-    name_parts_indexes = create_parts_dictionary(blocks_df)
-    parts_count = create_parts_count_dictionary(name_parts_indexes)
+    scores = name_part_scores(df, blocks_df, vectorized, similarity_threshold if similarity_join else None)
 
     filtered_blocks = {}
+    ranked_blocks = ([], [], [])
 
-    for index, row in df.iterrows():
+    for index in df.index:
         # a comparison block is an index of a record and a set of all the indexes of records that it might match with
         print(
             f"Filtering record {index}",
             end="\r",
         )
         filtered_blocks.update({index: set()})
-        name_parts = []
-        try:
-            name_parts = json.loads(row["name_parts"]).values()
-        except json.JSONDecodeError:
-            filtered_blocks.update({index: set()})
+        if scores.rows[index] is None:
             print(
                 f"Skipped record {index} due to bad name parts.                                "
             )
+            if ranked:
+                add_skipped(ranked_blocks, index)
             continue
-        # scoreboard will map records to scores which we use to find out what to include in our filtered blocks
-        scoreboard = {}
-        for name_part in name_parts:
-            for key in name_parts_indexes:
-                if JaroWinkler().similarity(name_part, key) >= similarity_threshold:
-                    # if the name_part is close enough to the key, add a point to all the records mapped to by that key
-                    for record in name_parts_indexes[key]:
-                        scoreboard.update({record: scoreboard.get(record, 0) + 1})
-        # make sure all records have a score in the scoreboard in order to guarantee the specified number of pairwise comparisons (if the input block is large enough to support it)
-        for record in list(blocks_df.index):
-            if scoreboard.get(record, None) == None:
-                scoreboard.update({record: 0})
-            # and remove records from the scoreboard if they have no name parts
-            if parts_count.get(record, None) == None:
-                scoreboard.pop(record, None)
-        # remove from the scoreboard any records that are not in the comparison block for the current record
-        scoreboard = {
-            record: scoreboard[record]
-            for record in scoreboard
-            if record in blocks[index]
-        }
-        # now sort the scoreboard records by normalized score and put the n best records in the block with n = block_size
-        # NOTE if distance is used as score instead of a similarity, simply let reverse=False instead of reverse=True
-        best_records = sorted(
-            scoreboard,
-            key=lambda record: (scoreboard[record] / parts_count[record]),
-            reverse=True,
-        )[:block_size]
-
-        filtered_blocks.update({index: set(best_records)})
+        # every time a name part is close enough to a name part of a record of the block, the record gets a point.
+        # Only records with name parts and in the block can be chosen
+        candidates = scores.candidates(blocks[index])
+        candidates = candidates[scores.record_parts[candidates] > 0]
+        points, first_point = scores.threshold_points(index, candidates, similarity_threshold)
+        # records with the same score are kept in the order they got their first point in, and after them come the records without points
+        # in the order of blocks_df
+        unscored_position = len(scores.rows[index]) * len(scores.key_records) + scores.index_position[candidates]
+        positions = np.where(points > 0, first_point, unscored_position)
+        normalized_scores = points / scores.record_parts[candidates]
+        if ranked:
+            add_ranked(ranked_blocks, index, candidates, normalized_scores, positions)
+            continue
+        best_records = candidates[top_k(normalized_scores, positions, block_size)]
+
+        filtered_blocks.update({index: set(best_records.tolist())})
     print("\n")
+    if ranked:
+        return RankedBlocks.from_lists(*ranked_blocks)
+    return filtered_blocks
+
+
+# what the worker processes of parallel_filter need to filter their shards of df
+parallel_filter_state = {}
+
+
+def parallel_filter(filter_function, blocks, df, blocks_df, workers=None, shard_size=1000, **kwargs):
+    # run one of the filter_with_* functions on shards of shard_size records of df in a pool of worker processes (workers defaults to the number of cores)
+    # and merge the filtered blocks (or RankedBlocks) in the order of df, so the result is the same as filter_function(blocks, df, blocks_df, **kwargs).
+    # The NamePartScores are made once in this process. The workers get them together with blocks, df and blocks_df when they start:
+    # where processes can be forked (Linux and macOS) they inherit them without copying anything (memory-mapped blocks stay memory-mapped),
+    # otherwise they're sent once to every worker, and the shards themselves are just ranges of positions in df
+    arguments = inspect.signature(filter_function).bind(blocks, df, blocks_df, **kwargs)
+    arguments.apply_defaults()
+    arguments = arguments.arguments
+    similarity_threshold = arguments["similarity_threshold"] if arguments.get("similarity_join") else None
+    name_part_scores(df, blocks_df, arguments["vectorized"], similarity_threshold)
+    state = {
+        "filter_function": filter_function,
+        "blocks": blocks,
+        "df": df,
+        "blocks_df": blocks_df,
+        "kwargs": kwargs,
+        "name_part_scores_cache": dict(name_part_scores_cache),
+    }
+    if "fork" in multiprocessing.get_all_start_methods():
+        set_parallel_filter_state(state)
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=set_parallel_filter_state, initargs=(state,))
+    shards = []
+    try:
+        with executor:
+            futures = [
+                executor.submit(filter_shard, start, min(start + shard_size, len(df)))
+                for start in range(0, len(df), shard_size)
+            ]
+            for i, future in enumerate(futures):
+                shards.append(future.result())
+                print(f"Filtered shard {i + 1}/{len(futures)}", end="\r")
+    finally:
+        parallel_filter_state.clear()
+    print("")
+    if arguments.get("ranked"):
+        return RankedBlocks.concatenate(shards)
+    filtered_blocks = {}
+    for shard in shards:
+        filtered_blocks.update(shard)
     return filtered_blocks
 
 
+def set_parallel_filter_state(state):
+    parallel_filter_state.update(state)
+    name_part_scores_cache.update(state["name_part_scores_cache"])
+
+
+def filter_shard(start, stop):
+    # filter the records of df from position start to stop in a worker process of parallel_filter
+    state = parallel_filter_state
+    return state["filter_function"](
+        state["blocks"], state["df"].iloc[start:stop], state["blocks_df"], **state["kwargs"]
+    )
+
+
 def create_match_blocks(matches):
     # given a dataset with confirmed matching name pairs, create the smallest possible blocks to contain these pairs.
     # In other words: create blocks that only contain matches (or any other kind of pair given some column names)
-    keys_column = "index_LASKI"
-    values_column = "index_roman"
-    match_blocks = {}
-    # match_blocks will be a dict where values from the "keys_column" will map to values from the "values_column"
-
-    for _, match in matches.iterrows():
-        # FIXME hardcoded column names isn't the greatest
-        match_blocks.update(
-            {
-                match[keys_column]: match_blocks.get(match[keys_column], set()).union(
-                    {match[values_column]}
-                )
-            }
-        )
+    # match_blocks will be a dict where values from the "index_LASKI" column will map to values from the "index_roman" column
+    return match_evaluator(matches).match_blocks()
+
 
-    return match_blocks
+# NOTE the functions below all use the BlockEvaluator of the matches (see blockEvaluation.py), which is only made once for the same matches.
+# Use match_evaluator(matches).evaluate(blocks) to get every metric at once
 
 
 def calculate_recall_better(blocks, matches):
-    # given blocks as a dictionary in the form generated by create_blocks(),
+    # given blocks as a dictionary in the form generated by create_blocks() (or ComparisonBlocks),
     # where record IDs from df2 map to sets of record IDs from df1,
     # and a dataset that shows the matches between df1 and df2, calculate recall.
-    total_matches = len(matches)
-    found_matches = 0
-    match_blocks = create_match_blocks(matches)
-    # match_blocks maps records from one dataset to the records from the other dataset they have a confirmed match with
-    # in the same "order" as the blocks i.e. we want to map records from the dataset we made blocks for to records from the dataset we made blocks with
-
-    for matched_record in match_blocks:
-        for actual_match in match_blocks[matched_record]:
-            print(
-                f"Looking for match ({matched_record}, {actual_match}).     ",
-                end="\r",
-            )
-            if actual_match in blocks[matched_record]:
-                found_matches += 1
-
-    recall = found_matches / total_matches
-    print(f"\nFound {found_matches}/{total_matches} matches.")
-    return recall
+    evaluation = match_evaluator(matches).evaluate(blocks)
+    print(f"Found {evaluation['found_matches']}/{evaluation['total_matches']} matches.")
+    return evaluation["recall"]
 
 
 def calculate_precision(blocks, matches):
-    # given blocks as a dictionary in the form generated by create_blocks(),
+    # given blocks as a dictionary in the form generated by create_blocks() (or ComparisonBlocks),
     # where record IDs from df2 map to sets of record IDs from df1,
     # and a dataset that shows the matches between df1 and df2, calculate precision.
-    possible_matches = 0
-    found_matches = 0
-    match_blocks = create_match_blocks(matches)
-    # match_blocks maps records from one dataset to the records from the other dataset they have a confirmed match with
-    # in the same "order" as the blocks i.e. we want to map records from the dataset we made blocks for to records from the dataset we made blocks with
-
-    for matched_record in match_blocks:
-        for actual_match in match_blocks[matched_record]:
-            print(
-                f"Looking for match ({matched_record}, {actual_match}).     ",
-                end="\r",
-            )
-            if actual_match in blocks[matched_record]:
-                found_matches += 1
-
-    for block in blocks.values():
-        possible_matches += len(block)
-
-    if possible_matches == 0:
+    evaluation = match_evaluator(matches).evaluate(blocks)
+    if evaluation["possible_matches"] == 0:
         # this prevents a division by zero in case possible_matches is zero
         return 0
-    precision = found_matches / possible_matches
-    print(f"\n{found_matches}/{possible_matches} identified matches are correct.")
-    return precision
+    print(
+        f"{evaluation['found_matches']}/{evaluation['possible_matches']} identified matches are correct."
+    )
+    return evaluation["precision"]
 
 
 def calculate_reduction_ratio(blocks, df1, df2):
     # given blocks as a dictionary in the form generated by create_blocks(),
     # where record IDs from df2 map to sets of record IDs from df1,
     # and the datasets the blocks were made from df1 and df2, calculate the reduction ratio.
-    blocked_comparisons = 0
-    for block in blocks.values():
-        blocked_comparisons += len(block)
+    blocked_comparisons = count_pairs(blocks)
     brute_force_comparisons = len(df1) * len(df2)
     reduction_ratio = 1 - (blocked_comparisons / brute_force_comparisons)
     print(f"Reduced {brute_force_comparisons} comparisons to {blocked_comparisons}")
@@ -372,30 +626,11 @@ def calculate_reduction_ratio(blocks, df1, df2):
 
 
 def find_missed_matches(blocks, matches):
-    # given blocks as a dictionary in the form generated by create_blocks(),
+    # given blocks as a dictionary in the form generated by create_blocks() (or ComparisonBlocks),
     # where record IDs from df2 map to sets of record IDs from df1,
     # and a dataset that shows the matches between df1 and df2,
     # create blocks consisting of the matches that are not present in the blocks.
-    match_blocks = create_match_blocks(matches)
-    missed_matches = {}
-    # match_blocks maps records from one dataset to the records from the other dataset they have a confirmed match with
-    # in the same "order" as the blocks i.e. we want to map records from the dataset we made blocks for to records from the dataset we made blocks with
-
-    for matched_record in match_blocks:
-        for actual_match in match_blocks[matched_record]:
-            print(
-                f"Looking for match ({matched_record}, {actual_match}).     ",
-                end="\r",
-            )
-            if actual_match not in blocks[matched_record]:
-                missed_matches.update(
-                    {
-                        matched_record: missed_matches.get(matched_record, set()).union(
-                            {actual_match}
-                        )
-                    }
-                )
-    return missed_matches
+    return match_evaluator(matches).missed_matches(blocks)
 
 
 def create_phonetic_name_parts(row, columns=[]):
@@ -419,32 +654,26 @@ if __name__ == "__main__":
 
     filtered_blocks = {}
     try:
-        with open(r"app\filtered_blocks.json") as file:
-            print("Retrieving filtered blocks...")
-            filtered_blocks = json.load(file)
-            filtered_blocks = {int(k): set(v) for k, v in filtered_blocks.items()}
+        print("Retrieving filtered blocks...")
+        filtered_blocks = load_blocks(r"app\filtered_blocks.blocks").to_dict()
     except (
         OSError
-    ):  # NOTE we only do filtering if a filtered_blocks.json file doesn't exist!
+    ):  # NOTE we only do filtering if a filtered_blocks file doesn't exist!
         try:
-            with open(r"app\blocks.json") as file:
-                # load the blocks created in the blocking phase and make the lists into sets again
-                blocks = json.load(file)
-                blocks = {int(k): set(v) for k, v in blocks.items()}
-                start_time = datetime.now()
-                filtered_blocks = filter_with_normalized_scores_revised(
-                    blocks, df2, df1, block_size=50
-                )
-                end_time = datetime.now()
-                print(f"Time taken: {(end_time-start_time).total_seconds()} seconds.")
+            # load the blocks created in the blocking phase (memory-mapped, so only the blocks we filter are read)
+            blocks = load_blocks(r"app\blocks.blocks")
+            start_time = datetime.now()
+            filtered_blocks = parallel_filter(
+                filter_with_normalized_scores_revised, blocks, df2, df1, block_size=50
+            )
+            end_time = datetime.now()
+            print(f"Time taken: {(end_time-start_time).total_seconds()} seconds.")
         except Exception as e:
             # beep with frequency 1000 for 1000 ms if something goes wrong during filtering
             winsound.Beep(1000, 1000)
             raise e
-        # when we're done filtering, write the blocks to filtered_blocks.json. We must store our sets as lists due to the format
-        filtered_blocks = {k: list(v) for k, v in filtered_blocks.items()}
-        with open(r"app\filtered_blocks.json", "w", encoding="utf-8") as file:
-            json.dump(filtered_blocks, file, ensure_ascii=False, indent=4)
+        # when we're done filtering, write the blocks to filtered_blocks.blocks
+        save_blocks(filtered_blocks, r"app\filtered_blocks.blocks")
         # beep with frequency 1500 for 1000 ms when blocking is done
         winsound.Beep(1500, 1000)
     print(
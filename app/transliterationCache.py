@@ -0,0 +1,137 @@
+import atexit
+import sqlite3
+from collections import OrderedDict
+
+
+class TransliterationCache:
+    # memoizes transliterations keyed by (scheme, source string), since the same given names and surnames show up thousands of times in our corpora.
+    # The most recently used entries are kept in memory (at most maxsize of them), and if a path is given,
+    # every transliteration is also written to an sqlite database at that path so it survives restarts.
+    # scheme is any string that identifies how the source was transliterated, like "yiddish" or "translit_me:HE_EN".
+    def __init__(self, maxsize=100000, path=None, commit_every=1000):
+        self.maxsize = maxsize
+        self.commit_every = commit_every
+        self.entries = OrderedDict()
+        self.connection = None
+        self.pending_writes = 0
+        self.reset_stats()
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        # start using (or keep using) the on-disk store at path
+        self.close()
+        # NOTE worker processes can each open the same store, so wait for the others' writes instead of failing right away
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transliterations (scheme TEXT, source TEXT, result TEXT, PRIMARY KEY (scheme, source))"
+        )
+        # NOTE writes are only committed every commit_every transliterations, so make sure the last ones are committed when we exit
+        atexit.register(self.flush)
+
+    def flush(self):
+        if self.connection is not None and self.pending_writes > 0:
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def detach(self):
+        # stop using the on-disk store without closing it. Worker processes that inherited the connection from their parent process should call this,
+        # since an sqlite connection must not be shared between processes
+        self.connection = None
+        self.pending_writes = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+    def get(self, scheme, source, transliterate):
+        # return the transliteration of source under scheme, calling transliterate(source) only if it isn't cached in memory or on disk
+        key = (scheme, source)
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+        if self.connection is not None:
+            row = self.connection.execute(
+                "SELECT result FROM transliterations WHERE scheme = ? AND source = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                result = row[0]
+                self.disk_hits += 1
+        if result is None:
+            self.misses += 1
+            result = transliterate(source)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO transliterations VALUES (?, ?, ?)",
+                    (scheme, source, result),
+                )
+                self.pending_writes += 1
+                if self.pending_writes >= self.commit_every:
+                    self.flush()
+        self.entries[key] = result
+        if len(self.entries) > self.maxsize:
+            # evict the least recently used entry
+            self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        # forget everything kept in memory. The on-disk store is left as it is
+        self.entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def take_stats(self):
+        # the hits and misses counted since the last call (which are then reset), so a worker process can send them to its parent, see add_stats
+        counts = {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses}
+        self.reset_stats()
+        return counts
+
+    def add_stats(self, counts):
+        # add the hits and misses counted by a worker process
+        self.hits += counts["hits"]
+        self.disk_hits += counts["disk_hits"]
+        self.misses += counts["misses"]
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0,
+            "size": len(self.entries),
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(
+            f"Transliteration cache: {stats["hits"]} hits, {stats["disk_hits"]} disk hits, {stats["misses"]} misses (hit rate {stats["hit_rate"]:.2%}), {stats["size"]} entries in memory"
+        )
+
+
+# the cache shared by every transliteration function. Call transliteration_cache.open(path) to also keep the transliterations on disk
+transliteration_cache = TransliterationCache()
+
+
+def start_transliteration_worker(path=None):
+    # used as the initializer of worker processes: stop using the store inherited from the parent process (see TransliterationCache.detach)
+    # and open the store at path, if given, with a connection of the worker's own
+    transliteration_cache.detach()
+    # NOTE the hits and misses inherited from the parent process were already counted there
+    transliteration_cache.reset_stats()
+    if path is not None:
+        transliteration_cache.open(path)
+
+
+def take_transliteration_stats():
+    # used by worker processes to send their hits and misses to the parent process after every chunk
+    transliteration_cache.flush()
+    return transliteration_cache.take_stats()
@@ -1,7 +1,7 @@
 # this is the total number of matches in the wikidata-set.
 # It's hardcoded for now so we don't have to find it every time, and it doesn't change, so that's ok.
-import json
 import pandas as pd
+from comparisonBlocks import load_blocks
 
 brute_force_comparisons = 11699820
 total_matches = 3466
@@ -50,9 +50,7 @@ def getWikidataDf():
 
 if __name__ == "__main__":
     df = getWikidataDf()
-    with open(r"app\blocks.json", "r") as blocks_file:
-        blocks = json.load(blocks_file)
-        blocks = {int(k): set(v) for k, v in blocks.items()}
+    blocks = load_blocks(r"app\blocks.blocks").to_dict()
     recall, precision = calculate_wikidata_recall_and_precision(df, blocks)
     f1 = 0
     if (precision + recall) != 0:
@@ -1,10 +1,26 @@
 import pytest
 import sys
 import os
+import types
+import pickle
+from functools import partial
+import numpy as np
 import pandas as pd
+from scipy.optimize import linear_sum_assignment
 sys.path.append(os.path.dirname(os.path.abspath(__file__)).replace("\\tests", ""))
 sys.path.append(os.path.dirname(os.path.abspath(__file__)).replace("/tests", ""))
 import app
+# NOTE blocking and textFiltering import the other modules from the app folder, and textFiltering imports winsound, which only exists on Windows
+sys.path.append(os.path.dirname(os.path.abspath(app.__file__)))
+sys.modules.setdefault("winsound", types.ModuleType("winsound"))
+import blocking
+import textFiltering
+from app.transliterationCache import TransliterationCache, transliteration_cache
+from app.sharding import transform_csv_sharded
+from app.comparisonBlocks import ComparisonBlocks, RankedBlocks, iter_pairs, count_pairs, save_blocks, load_blocks
+from app.namePartStore import NamePartStore, load_name_part_store
+from app.blockEvaluation import match_evaluator, f_measure
+from app.similarity import jaro_winkler, levenshtein, normalized_levenshtein, one_to_many, jaro_winkler_matrix, jaro_winkler_join, threshold_matrix, SimilarityIndex
 from app.vectordb import get_db, query_db_by_name_singular_dataset, get_db, query_db_by_name, run_filtering_multiple_dataset, create_dict_from_blocks, run_filtering_singular_dataset
 
 class Test_transliterate_yiddish():
@@ -19,6 +35,574 @@ class Test_transliterate_yiddish():
     def test_names(self):
         assert app.transliterate_yiddish("אַּבבּדול") == "abvdui"
 
+    def test_diacritics(self):
+        for i, _ in enumerate(app.Alphabet.diacritics_yiddish):
+            assert app.Alphabet.diacritics_roman[i] == app.transliterate_yiddish(app.Alphabet.diacritics_yiddish[i])
+
+    def test_many(self):
+        names = ["אַּבבּדול", "דזשזש", "וווּ"]
+        assert app.transliterate_yiddish_many(names) == [app.transliterate_yiddish(name) for name in names]
+        series = app.transliterate_yiddish_many(pd.Series(names, index=[3, 1, 2]))
+        assert list(series.index) == [3, 1, 2]
+        assert list(series) == ["abvdui", "dzhzh", "vu"]
+
+class Test_corpus_files():
+    def test_transform_in_chunks(self, tmp_path):
+        input_path = str(tmp_path / "input.csv")
+        pd.DataFrame({"id": ["007", "8"], "title": ["Emil Larsen@en", "Anna@he"]}).to_csv(input_path, index=False)
+        rows = app.transform_csv_in_chunks(input_path, str(tmp_path / "output.csv"), app.name_parts_from_title_chunk, chunk_size=1)
+        output = pd.read_csv(str(tmp_path / "output.csv"), index_col=0, dtype=str)
+        assert rows == 2
+        # the index continues across chunks and the untouched columns are written back as they were read
+        assert list(output.index) == ["0", "1"] and list(output["id"]) == ["007", "8"]
+        assert list(output["name_parts"]) == ['{"name_part_0": "Emil", "name_part_1": "Larsen"}', '{"name_part_0": "Anna"}']
+
+    def test_index_by_key(self):
+        first_indexes, key_counts = app.index_by_key(pd.Series(["a", "b", None, "a"], index=[5, 6, 7, 8]))
+        assert first_indexes.to_dict() == {"a": 5, "b": 6}
+        assert key_counts.to_dict() == {"a": 2, "b": 1}
+
+    def test_transliterated_em(self, tmp_path):
+        paths = {name: str(tmp_path / f"{name}.tsv") for name in ["em", "yiddish", "laski", "output"]}
+        # key 12 has no LASKI entry and the Zylbercweig name of key 13 is there twice, so both are dropped
+        pd.DataFrame({"key": [10, 11, 12, 13], "id": ["L1", "L2", "L9", "L3"], "Zylbercweig Name": ["אַבּ", "דזשזש", "אַבּ", "וווּ"]}).to_csv(paths["em"], sep="\t", index=False)
+        pd.DataFrame({"title": ["x", "אַבּ", "דזשזש", "וווּ", "וווּ"], "name_parts": ["first: x", "first: אַבּ", "last: דזשזש", "first: וווּ", "first: וווּ"]}).to_csv(paths["yiddish"], sep="\t", index=False)
+        pd.DataFrame({"id": ["L2", "L1", "L3"], "name_parts": ['{"a": "b"}', '{"c": "d"}', '{"e": "f"}']}).to_csv(paths["laski"], sep="\t", index=False)
+        app.write_transliterated_em(paths["output"], paths["em"], paths["yiddish"], paths["laski"])
+        em = pd.read_csv(paths["output"], sep="\t", index_col=0)
+        assert list(em["key"]) == [10, 11]
+        assert list(em["index_roman"]) == [1, 2]
+        assert list(em["index_LASKI"]) == [1, 0]
+        assert list(em["name_parts_roman"]) == [app.transliterate_name_parts("first: אַבּ"), app.transliterate_name_parts("last: דזשזש")]
+        assert list(em["name_parts_LASKI"]) == ['{"c": "d"}', '{"a": "b"}']
+
+    def test_indexed_italy_em(self, tmp_path):
+        em_path, italy_path, output_path = (str(tmp_path / name) for name in ["em.tsv", "italy.tsv", "output.tsv"])
+        pd.DataFrame({"id_1": ["b", "a", "z"], "id_2": ["c", "c", "a"]}).to_csv(em_path, sep="\t", index=False)
+        pd.DataFrame({"id": ["a", "b", "c", "a"]}).to_csv(italy_path, sep="\t", index=False)
+        app.write_indexed_italy_em(output_path, em_path, italy_path)
+        em = pd.read_csv(output_path, sep="\t", index_col=0)
+        # the match with the unknown id "z" is dropped instead of pointing at record 0, and duplicate ids use their first record
+        assert list(em["index_1"]) == [1, 0] and list(em["index_2"]) == [2, 2]
+
+class Test_transliteration_cache():
+    def test_hits_and_misses(self):
+        cache = TransliterationCache(maxsize=2)
+        for source in ["a", "b", "a", "c", "b"]:
+            assert cache.get("upper", source, str.upper) == source.upper()
+        # "b" was evicted when "c" was added, so it's computed again
+        assert cache.hits == 1
+        assert cache.misses == 4
+
+    def test_disk_store(self, tmp_path):
+        path = str(tmp_path / "cache.db")
+        cache = TransliterationCache(path=path)
+        cache.get("upper", "a", str.upper)
+        cache.close()
+        cache = TransliterationCache(path=path)
+        assert cache.get("upper", "a", lambda source: None) == "A"
+        assert cache.disk_hits == 1
+        cache.close()
+
+class Test_sharding():
+    def test_same_as_in_chunks(self, tmp_path):
+        input_path = str(tmp_path / "input.csv")
+        # NOTE the third title has a quoted line break, so the rows can't be split by lines
+        pd.DataFrame(
+            {"id": [f"Q{i}" for i in range(7)], "title": ["Emil Larsen@en", "Anna@en", "Mary\nAnn Smith@en", None, "A B C@he", "x@en", "y z@en"]}
+        ).to_csv(input_path, index=False)
+        app.transform_csv_in_chunks(input_path, str(tmp_path / "chunks.csv"), app.name_parts_from_title_chunk, chunk_size=2)
+        rows = transform_csv_sharded(input_path, str(tmp_path / "sharded.csv"), app.name_parts_from_title_chunk, workers=2, chunk_size=2)
+        assert rows == 7
+        with open(tmp_path / "chunks.csv", encoding="utf-8") as chunks, open(tmp_path / "sharded.csv", encoding="utf-8") as sharded:
+            assert sharded.read() == chunks.read()
+
+    def test_sharded_store(self, tmp_path):
+        input_path = str(tmp_path / "zylbercweig.tsv")
+        cache_path = str(tmp_path / "cache.db")
+        rows = pd.DataFrame({column: ["x"] * 4 for column in app.zylbercweig_columns})
+        rows["id"] = ["temp_1", "temp_2", "temp_3", "temp_4"]
+        rows["title"] = ["אַבּ", "דזשזש", "אַבּ", "וווּ"]
+        rows["name_parts"] = ["first: אַבּ", "first: דזשזש", "first: אַבּ", "last: וווּ"]
+        rows.to_csv(input_path, sep="\t", index=False)
+        for run in range(2):
+            transliteration_cache.close()
+            transliteration_cache.clear()
+            transliteration_cache.reset_stats()
+            app.transliterate_zylbercweig(str(tmp_path / f"{run}.csv"), input_path, chunk_size=1, workers=2, cache_path=cache_path)
+            stats = transliteration_cache.stats()
+            # every chunk's lookups are counted, and the second run finds every transliteration in the store the first one wrote
+            assert stats["hits"] + stats["disk_hits"] + stats["misses"] > 0
+            assert stats["misses"] > 0 if run == 0 else stats["misses"] == 0
+        transliteration_cache.close()
+        assert pd.read_csv(str(tmp_path / "1.csv"), sep="\t")["title"].tolist() == app.transliterate_yiddish_many(rows["title"].tolist())
+
+class Test_comparison_blocks():
+    blocks = {0: {3, 1}, 2: set(), 5: {1, 4, 3}}
+
+    def test_dict_round_trip(self):
+        csr = ComparisonBlocks.from_dict(self.blocks)
+        assert csr.to_dict() == self.blocks
+        assert csr[5] == [1, 3, 4]
+        assert 2 in csr and 1 not in csr
+        assert len(csr) == 3
+
+    def test_pairs(self):
+        csr = ComparisonBlocks.from_pairs([5, 0, 5, 0], [4, 1, 4, 3])
+        assert list(csr.pairs()) == [(0, 1), (0, 3), (5, 4)]
+        assert sorted(iter_pairs(self.blocks)) == list(iter_pairs(ComparisonBlocks.from_dict(self.blocks)))
+        assert count_pairs(self.blocks) == count_pairs(ComparisonBlocks.from_dict(self.blocks)) == 5
+
+    def test_block_file(self, tmp_path):
+        save_blocks(self.blocks, str(tmp_path / "blocks.json"))
+        # the binary file is created from the json file with the same name
+        blocks = load_blocks(str(tmp_path / "blocks.blocks"))
+        assert blocks.to_dict() == self.blocks
+        assert blocks.contains_pair(5, 4) and not blocks.contains_pair(0, 4)
+        assert load_blocks(str(tmp_path / "blocks.blocks"), mmap=False).to_dict() == self.blocks
+
+    def test_ranked_blocks(self, tmp_path):
+        ranked = RankedBlocks.from_lists([0, 2, 5], [[3, 1], [], [4, 1, 3]], [[0.9, 0.5], [], [1.0, 0.7, 0.7]])
+        assert ranked.blocks() == self.blocks
+        assert ranked.blocks(1) == {0: {3}, 2: set(), 5: {4}}
+        assert ranked.blocks(min_score=0.7) == {0: {3}, 2: set(), 5: {1, 4, 3}}
+        halves = RankedBlocks.concatenate([RankedBlocks.from_lists([0], [[3, 1]], [[0.9, 0.5]]), RankedBlocks.from_lists([2, 5], [[], [4, 1, 3]], [[], [1.0, 0.7, 0.7]])])
+        assert halves.blocks(2) == ranked.blocks(2)
+        ranked.save(str(tmp_path / "ranked.npz"))
+        assert RankedBlocks.load(str(tmp_path / "ranked.npz")).blocks(2) == {0: {3, 1}, 2: set(), 5: {4, 1}}
+
+class Test_similarity():
+    strings_0 = ["Emil", "Larsen", "", "", "dixon", "martha", "אַבּ"]
+    strings_1 = ["Emilie", "Larson", "", "x", "dicksonx", "marhta", "אבּ"]
+
+    def test_same_as_strsimpy(self):
+        from strsimpy.jaro_winkler import JaroWinkler
+        from strsimpy.levenshtein import Levenshtein
+        from strsimpy.normalized_levenshtein import NormalizedLevenshtein
+        pairs = list(zip(self.strings_0, self.strings_1))
+        assert list(jaro_winkler(self.strings_0, self.strings_1)) == pytest.approx([JaroWinkler().similarity(*pair) for pair in pairs])
+        assert list(levenshtein(self.strings_0, self.strings_1)) == [Levenshtein().distance(*pair) for pair in pairs]
+        assert list(normalized_levenshtein(self.strings_0, self.strings_1)) == pytest.approx([NormalizedLevenshtein().distance(*pair) for pair in pairs])
+
+    def test_matrix(self):
+        matrix = jaro_winkler_matrix(self.strings_0, self.strings_1)
+        assert matrix.shape == (7, 7)
+        for i, string in enumerate(self.strings_0):
+            assert list(matrix[i]) == pytest.approx(list(one_to_many(jaro_winkler, string, self.strings_1)))
+
+    def test_empty(self):
+        assert list(jaro_winkler([], [])) == [] and list(levenshtein([], [])) == []
+        assert jaro_winkler_matrix([], self.strings_1).shape == (0, 7) and jaro_winkler_matrix(self.strings_0, []).shape == (7, 0)
+
+    def test_join(self):
+        matrix = jaro_winkler_matrix(self.strings_0, self.strings_1)
+        for threshold in [0.5, 0.9, 1]:
+            assert (threshold_matrix(jaro_winkler_join, self.strings_0, self.strings_1, threshold).toarray() == matrix * (matrix >= threshold)).all()
+
+    def test_empty_join(self):
+        # a join with an empty side has no pairs
+        for strings_0, strings_1 in [([], self.strings_1), (self.strings_0, []), ([], [])]:
+            assert [len(array) for array in jaro_winkler_join(strings_0, strings_1, 0.5)] == [0, 0, 0]
+            assert threshold_matrix(jaro_winkler_join, strings_0, strings_1, 0.5).shape == (len(strings_0), len(strings_1))
+
+    def test_index(self):
+        matrix = jaro_winkler_matrix(self.strings_0, self.strings_1)
+        index = SimilarityIndex(self.strings_1)
+        for threshold in [0.5, 0.9, 1]:
+            assert (index.threshold_matrix(self.strings_0, threshold).toarray() == matrix * (matrix >= threshold)).all()
+        # only keys with the same characters can be identical, so "martha" and "marhta" are the only other candidates
+        rows, columns = index.candidates(self.strings_0, 1)
+        assert list(zip(rows.tolist(), columns.tolist())) == [(2, 2), (3, 2), (5, 5)]
+
+    def test_empty_index(self):
+        # an index without keys finds nothing, and neither does searching for no strings
+        index = SimilarityIndex([])
+        assert len(index) == 0 and [len(array) for array in index.search(self.strings_0, 0.5)] == [0, 0, 0]
+        assert index.threshold_matrix(self.strings_0, 0.5).shape == (7, 0)
+        index = SimilarityIndex(self.strings_1)
+        assert [len(array) for array in index.candidates([], 0.5)] == [0, 0]
+        assert index.threshold_matrix([], 0.5).shape == (0, 7)
+
+class Test_block_evaluation():
+    matches = pd.DataFrame({"index_LASKI": [0, 0, 5, 7], "index_roman": [1, 3, 4, 2]})
+    blocks = {0: {3, 1}, 2: set(), 5: {1, 3}}
+
+    def test_evaluate(self):
+        evaluator = match_evaluator(self.matches)
+        assert match_evaluator(self.matches) is evaluator
+        # record 7 has no block, so its match is missed as well
+        for blocks in [self.blocks, ComparisonBlocks.from_dict(self.blocks)]:
+            evaluation = evaluator.evaluate(blocks, range(10), range(10), B=2)
+            assert (evaluation["recall"], evaluation["precision"]) == (0.5, 0.5)
+            assert evaluation["f1"] == evaluation["fB"] == 0.5
+            assert evaluation["reduction_ratio"] == 1 - 4 / 100
+            assert evaluator.missed_matches(blocks) == {5: {4}, 7: {2}}
+        assert evaluator.match_blocks() == {0: {1, 3}, 5: {4}, 7: {2}}
+        assert f_measure(0.5, 1, 2) == pytest.approx(5 / 6) and f_measure(0, 1) == 0
+
+class Test_name_part_store():
+    name_parts = pd.Series(['{"first": "Emil", "last": "Larsen"}', "bad", '{"last": "Larsen", "middle": null}', None], index=[4, 5, 6, 7])
+
+    def test_records(self):
+        store = NamePartStore.from_series(self.name_parts)
+        assert store.record(4) == {"first": "Emil", "last": "Larsen"}
+        assert store.parts(6) == ["Larsen"]
+        assert store.record(5) is None and store.record(7) is None
+        # every distinct name part is only stored once
+        assert store.strings == ["Emil", "Larsen"]
+
+    def test_saved_next_to_csv(self, tmp_path):
+        path = str(tmp_path / "names.csv")
+        pd.DataFrame({"name_parts": self.name_parts}).to_csv(path, index=False)
+        df = pd.read_csv(path)
+        load_name_part_store(path, df)
+        assert os.path.exists(str(tmp_path / "names.nameparts.npz"))
+        assert load_name_part_store(path, df).record(0) == {"first": "Emil", "last": "Larsen"}
+
+def popcount_words(words):
+    return blocking.popcount(words).astype(int).tolist()
+
+class Test_blocking():
+    df1 = pd.DataFrame(
+        {
+            "title": ["emil larsen", "anna berg", "mary", "x y"],
+            "name_parts": ['{"first": "Emil", "last": "Larsen"}', '{"first": "Anna", "last": "Berg"}', '{"first": "Mary", "middle": null}', "bad"],
+            "phoneme": ["ɛmil larsən", "ana bɛrg", "mɛri", "ks"],
+        }
+    )
+    df2 = pd.DataFrame(
+        {
+            "title": ["emilie larson", "ana", "marie berg", "ks", "anna bergman"],
+            "name_parts": ['{"first": "Emilie", "last": "Larson"}', '{"first": "Ana"}', '{"first": "Marie", "last": "Berg"}', None, '{"first": "Anna", "last": "Bergman"}'],
+            "phoneme": ["ɛmili larsɔn", "ana", "mari bɛrg", "ks", "ana bɛrgman"],
+        }
+    )
+
+    def pairwise_blocks(self, labeler, df1=None, df2=None):
+        df1 = self.df1 if df1 is None else df1
+        df2 = self.df2 if df2 is None else df2
+        return blocking.create_pairwise_comparison_blocks(blocking.block_dataframe(df1, labeler), blocking.block_dataframe(df2, labeler))
+
+    def test_inverted_index(self):
+        index = blocking.InvertedIndex()
+        index.add(3, ["a", "b"])
+        # missing labels are dropped
+        index.add_many([1, 2, 0], ["b", None, "a"])
+        index.add_many(np.array([], dtype=np.int64), [])
+        assert {label: records.tolist() for label, records in index.finalize().items()} == {"a": [0, 3], "b": [1, 3]}
+        # labeling one row at a time and all rows at once gives the same blocks
+        by_row = blocking.block_dataframe(self.df2, lambda row: blocking.name_length(row))
+        by_column = blocking.block_dataframe(self.df2, blocking.name_length)
+        assert {label: records.tolist() for label, records in by_row.items()} == {label: records.tolist() for label, records in by_column.items()}
+
+    def sorted_neighbourhood(self, values_1, values_2, window):
+        # the pairs of records from df1 and df2 that are less than window positions apart when sorted by value, then dataset, then record
+        entries = sorted([(value, 0, i) for i, value in enumerate(values_1)] + [(value, 1, i) for i, value in enumerate(values_2)])
+        blocks = {record: set() for record in range(len(values_1))}
+        for i in range(len(entries)):
+            for j in range(i + 1, min(i + window, len(entries))):
+                if entries[i][1] != entries[j][1]:
+                    first, second = sorted([entries[i], entries[j]], key=lambda entry: entry[1])
+                    blocks[first[2]].add(second[2])
+        return blocks
+
+    def test_sorted_neighbourhood_blocks(self):
+        for window in [2, 3, 20]:
+            titles = self.sorted_neighbourhood(self.df1["title"], self.df2["title"], window)
+            assert blocking.sorted_neighbourhood_blocks(self.df1, self.df2, ["title"], window=window) == titles
+            phonemes = self.sorted_neighbourhood(self.df1["phoneme"] + "\x01" + self.df1["title"], self.df2["phoneme"] + "\x01" + self.df2["title"], window)
+            # the pairs of every pass are combined
+            blocks = blocking.sorted_neighbourhood_blocks(self.df1, self.df2, ["title", ["phoneme", "title"]], window=window, as_csr=True)
+            assert blocks.to_dict() == {record: titles[record] | phonemes[record] for record in titles}
+        # with the same dataframe, records aren't compared with themselves, and every pair is there both ways
+        same = blocking.sorted_neighbourhood_blocks(self.df2, None, [lambda df: df["title"].str.len()], window=2, is_same_df=True)
+        assert same == {0: {4}, 1: {2, 3}, 2: {1, 4}, 3: {1}, 4: {0, 2}}
+
+    def test_interval_join_blocks(self):
+        assert blocking.merge_intervals([(5, 7), (1, 2), (3, 3), (6, 9), (12, 13)]) == [[1, 3], [5, 9], [12, 13]]
+        # records share a range exactly when they share a label of the labeler with the same ranges
+        for intervals, labeler in [(blocking.name_length_intervals, blocking.name_length), (blocking.potential_name_length_intervals, blocking.potential_name_length)]:
+            assert blocking.interval_join_blocks(self.df1, self.df2, intervals) == self.pairwise_blocks(labeler)
+            assert blocking.interval_join_blocks(self.df2, self.df1, intervals, as_csr=True).to_dict() == self.pairwise_blocks(labeler, self.df2, self.df1)
+            same = blocking.create_pairwise_comparison_blocks(blocking.block_dataframe(self.df2, labeler), blocking.block_dataframe(self.df2, labeler), is_same_df=True)
+            assert blocking.interval_join_blocks(self.df2, None, intervals, is_same_df=True) == same
+        no_slack = blocking.interval_join_blocks(self.df1, self.df2, partial(blocking.name_length_intervals, slack=0))
+        assert no_slack == {0: set(), 1: set(), 2: set(), 3: {1}}
+        assert blocking.interval_join_blocks(self.df1, self.df2, partial(blocking.name_length_intervals, slack=2)) == {0: {0, 2, 4}, 1: {0, 2, 4}, 2: {1, 3}, 3: {1, 3}}
+
+    def test_consonant_bitsets(self, monkeypatch):
+        words = np.array([[0, 1], [2**64 - 1, 2**40 + 5]], dtype=np.uint64)
+        assert popcount_words(words) == [[0, 1], [64, 3]]
+        # the lookup table used before NumPy 2.0 counts the same bits
+        monkeypatch.delattr(np, "bitwise_count", raising=False)
+        assert popcount_words(words) == [[0, 1], [64, 3]]
+        monkeypatch.undo()
+
+        bitsets, consonants = blocking.consonant_bitsets(self.df1)
+        labels = [set(map(str, blocking.phonetic_consonant_presence(row))) - {"None"} for _, row in self.df1.iterrows()]
+        assert consonants == sorted(set().union(*labels))
+        assert [{consonant for j, consonant in enumerate(consonants) if int(bitsets[record, j // 64]) >> (j % 64) & 1} for record in range(len(self.df1))] == labels
+
+        # with min_shared=1 the blocks are the same as with phonetic_consonant_presence
+        presence = self.pairwise_blocks(blocking.phonetic_consonant_presence)
+        assert blocking.consonant_overlap_blocks(self.df1, self.df2, tile_size=2) == presence
+        same = blocking.create_pairwise_comparison_blocks(*[blocking.block_dataframe(self.df2, blocking.phonetic_consonant_presence)] * 2, is_same_df=True)
+        assert blocking.consonant_overlap_blocks(self.df2, None, is_same_df=True, tile_size=3, as_csr=True).to_dict() == same
+        labels_2 = [set(map(str, blocking.phonetic_consonant_presence(row))) - {"None"} for _, row in self.df2.iterrows()]
+        for min_shared, min_jaccard in [(2, 0), (1, 0.5), (2, 0.6)]:
+            expected = {
+                record: {
+                    other
+                    for other, consonants_2 in enumerate(labels_2)
+                    if len(consonants_1 & consonants_2) >= min_shared and len(consonants_1 & consonants_2) >= min_jaccard * len(consonants_1 | consonants_2)
+                }
+                for record, consonants_1 in enumerate(labels)
+            }
+            assert blocking.consonant_overlap_blocks(self.df1, self.df2, min_shared, min_jaccard, tile_size=2) == expected
+
+    def test_minhash_lsh(self):
+        labeler = blocking.minhash_lsh(["title"], bands=256, rows=1)
+        emil, emilie, mary = labeler.labels(["emil larsen"]), labeler.labels(["emilie larson"]), labeler.labels(["mary"])
+        assert len(emil) == 256 and emil == labeler.labels(["emil larsen"]) and labeler.labels([None]) == ["None"]
+        # with one row per band, the share of bands two records have in common is close to the Jaccard similarity of their n-grams
+        def ngrams(text):
+            return {f" {text} "[i : i + 2] for i in range(len(text) + 1)}
+        similarity = len(ngrams("emil larsen") & ngrams("emilie larson")) / len(ngrams("emil larsen") | ngrams("emilie larson"))
+        assert len(set(emil) & set(emilie)) / 256 == pytest.approx(similarity, abs=0.1)
+        assert len(set(emil) & set(mary)) / 256 < 0.1
+        # the labels only depend on the seed, so they're the same in every process
+        assert pickle.loads(pickle.dumps(labeler)).labels(["emil larsen"]) == emil
+        assert blocking.minhash_lsh(["title"], bands=256, rows=1, seed=1).labels(["emil larsen"]) != emil
+        # the name parts are compared one by one, not as json
+        name_parts = blocking.minhash_lsh(["name_parts"])
+        assert name_parts.labels(['{"first": "Emil", "last": "Larsen"}']) == name_parts.labels(['{"given": "Emil", "surname": "Larsen"}'])
+        blocks = blocking.create_pairwise_comparison_blocks(blocking.block_dataframe(self.df1, name_parts), blocking.block_dataframe(self.df2, name_parts))
+        assert 4 in blocks[1] and 3 not in blocks[3]
+
+    def test_label_columns(self):
+        # labeling a whole dataframe at once gives every row the same labels as labeling it on its own
+        labelers = [blocking.name_length, blocking.name_part_presence, blocking.potential_name_length, blocking.phonetic_consonant_presence, blocking.minhash_lsh(["phoneme", "name_parts"])]
+        for df in [self.df1, self.df2]:
+            for labeler in labelers:
+                assert [list(labels) for labels in labeler.label_column(df)] == [list(labeler(row)) for _, row in df.iterrows()]
+
+    def test_block_dataframes(self):
+        labelers = [blocking.name_length, blocking.potential_name_length, blocking.phonetic_consonant_presence]
+        separate = [self.pairwise_blocks(labeler) for labeler in labelers]
+        union = {record: set().union(*(blocks[record] for blocks in separate)) for record in range(len(self.df1))}
+        intersection = {record: set.intersection(*(blocks[record] for blocks in separate)) for record in range(len(self.df1))}
+        for workers in [1, 2]:
+            assert blocking.block_dataframes(self.df1, self.df2, labelers, workers=workers, shard_size=2) == union
+            assert blocking.block_dataframes(self.df1, self.df2, labelers, combine="intersection", workers=workers, shard_size=2) == intersection
+        same = blocking.block_dataframes(self.df2, None, labelers, is_same_df=True, workers=1, as_csr=True)
+        assert same.to_dict() == {record: set().union(*(blocks[record] for blocks in [blocking.create_pairwise_comparison_blocks(blocking.block_dataframe(self.df2, labeler), blocking.block_dataframe(self.df2, labeler), is_same_df=True) for labeler in labelers])) for record in range(len(self.df2))}
+        with pytest.raises(ValueError):
+            blocking.block_dataframes(self.df1, self.df2, labelers, combine="both", workers=1)
+
+    def test_incremental_blocks(self, tmp_path):
+        labelers = [blocking.name_length, blocking.potential_name_length]
+        union = blocking.block_dataframes(self.df1, self.df2, labelers, workers=1)
+        incremental = blocking.IncrementalBlocks(labelers)
+        incremental.add_records(self.df1.iloc[:2], dataset=1)
+        incremental.add_records(self.df2.iloc[:3], dataset=2)
+        incremental.save(str(tmp_path / "incremental.pickle"))
+        incremental = blocking.IncrementalBlocks.load(str(tmp_path / "incremental.pickle"))
+        incremental.clear_new_blocks()
+        new_pairs = set(incremental.add_records(self.df1.iloc[2:], dataset=1).pairs())
+        new_pairs |= set(incremental.add_records(self.df2.iloc[3:], dataset=2).pairs())
+        # adding the records a few at a time gives the same blocks as blocking all of them at once
+        assert incremental.blocks().to_dict() == union
+        # the new pairs are the ones with a record added after clear_new_blocks
+        assert incremental.new_blocks().to_dict() == {record: {other for other in block if record >= 2 or other >= 3} for record, block in union.items() if any(record >= 2 or other >= 3 for other in block)}
+        assert new_pairs == set(incremental.new_blocks().pairs())
+
+        same = blocking.IncrementalBlocks(labelers, is_same_df=True)
+        for start in range(0, len(self.df2), 2):
+            same.add_records(self.df2.iloc[start : start + 2])
+        assert same.blocks().to_dict() == blocking.block_dataframes(self.df2, None, labelers, is_same_df=True, workers=1)
+
+    def test_meta_blocking(self):
+        dict_1 = {"a": [0, 1], "b": [0], "c": [1], "None": [2]}
+        dict_2 = {"a": [0, 1, 2], "b": [1], "c": [2, 3]}
+        # record 0 shares two blocks with record 1 and one with records 0 and 2, record 1 two blocks with record 2
+        assert blocking.meta_blocking(dict_1, dict_2, weighting="cbs") == {0: {1}, 1: {2}, 2: set()}
+        assert blocking.meta_blocking(dict_1, dict_2, weighting="cbs", min_weight=1) == {0: {0, 1, 2}, 1: {0, 1, 2, 3}, 2: set()}
+        # the threshold is applied before top_k, so fewer than top_k pairs can be left
+        assert blocking.meta_blocking(dict_1, dict_2, weighting="cbs", min_weight=2, top_k=2) == {0: {1}, 1: {2}, 2: set()}
+        assert blocking.meta_blocking([dict_1], [dict_2], weighting="cbs", top_k=1, as_csr=True).to_dict() == {0: {1}, 1: {2}, 2: set()}
+        # every weighting keeps all the pairs of create_pairwise_comparison_blocks if no pair is too weak
+        for weighting in ["cbs", "arcs", "jaccard"]:
+            assert blocking.meta_blocking(dict_1, dict_2, weighting=weighting, min_weight=0) == blocking.create_pairwise_comparison_blocks(dict_1, dict_2)
+        # in "arcs", the small blocks "b" and "c" count more than "a"
+        assert blocking.meta_blocking(dict_1, dict_2) == {0: {1}, 1: {2, 3}, 2: set()}
+        # block "a" has 6 comparisons, so it's thrown away
+        assert blocking.meta_blocking(dict_1, dict_2, min_weight=0, max_block_comparisons=5) == {0: {1}, 1: {2, 3}, 2: set()}
+        assert blocking.meta_blocking(dict_2, dict_2, weighting="cbs", min_weight=0, is_same_df=True) == {0: {1, 2}, 1: {0, 2}, 2: {0, 1, 3}, 3: {2}}
+
+class Test_text_filtering():
+    # record 2 has bad name parts, record 4 none, and record 3 of blocks_df is missing its name parts
+    df = pd.DataFrame(
+        {"name_parts": ['{"first": "Emil", "last": "Larsen"}', '{"first": "Anna", "middle": "Maria", "last": "Berg"}', "bad", '{"first": "Mary", "middle": null}', "{}"]}
+    )
+    blocks_df = pd.DataFrame(
+        {
+            "name_parts": [
+                '{"first": "Emilie", "last": "Larson"}',
+                '{"first": "Ana"}',
+                '{"first": "Marie", "last": "Berg"}',
+                None,
+                '{"first": "Anna", "last": "Bergman"}',
+                '{"first": "Emil", "last": "Larsen"}',
+                '{"given": "Maria", "surname": "Anna"}',
+            ]
+        }
+    )
+    blocks = {0: {0, 1, 2, 3, 4, 5, 6}, 1: {0, 1, 2, 4, 6}, 2: {1}, 3: {2, 3, 6}, 4: {0}}
+
+    def parts(self, name_parts):
+        store = NamePartStore.from_series(pd.Series([name_parts]))
+        return store.parts(0)
+
+    def test_name_part_scores(self):
+        assert textFiltering.injective_maps(2, 3).tolist() == [[0, 1], [0, 2], [1, 0], [1, 2], [2, 0], [2, 1]]
+        assert textFiltering.injective_maps(3, 2).shape == (0, 3)
+        # every distinct name part is compared to every key once, and gives the same similarities as strsimpy
+        from strsimpy.jaro_winkler import JaroWinkler
+        for vectorized in [True, False]:
+            scores = textFiltering.NamePartScores(self.df, self.blocks_df, vectorized)
+            assert scores.rows[2] is None and len(scores.rows[4]) == 0
+            for index in [0, 1, 3]:
+                expected = [[JaroWinkler().similarity(part, key) for key in scores.keys] for part in self.parts(self.df["name_parts"][index])]
+                assert scores.similarities(index) == pytest.approx(np.array(expected).reshape(-1, len(scores.keys)))
+
+    def reference_scores(self, index, score):
+        # the scores of the records in the block of a record of df, comparing its name parts with strsimpy one pair at a time
+        from strsimpy.jaro_winkler import JaroWinkler
+        parts = self.parts(self.df["name_parts"][index])
+        scores = {}
+        for other in self.blocks[index]:
+            other_parts = self.parts(self.blocks_df["name_parts"][other]) or []
+            matrix = np.array([[JaroWinkler().similarity(part, other_part) for other_part in other_parts] for part in parts]).reshape(len(parts), len(other_parts))
+            scores.update({other: score(matrix)})
+        return scores
+
+    def assert_best(self, filtered, index, scores, block_size):
+        # the block_size candidates with the best scores were kept
+        kept = filtered[index]
+        assert kept <= set(scores) and len(kept) == min(block_size, len(scores))
+        assert min((scores[other] for other in kept), default=1) >= max((scores[other] for other in set(scores) - kept), default=0) - 1e-9
+
+    def test_filters(self):
+        def assignment(matrix):
+            rows, columns = linear_sum_assignment(matrix, maximize=True)
+            return matrix[rows, columns].sum() / min(matrix.shape) if matrix.size else 0
+
+        for vectorized in [True, False]:
+            for threshold in [0.8, 0.95]:
+                union = textFiltering.filter_with_set_union(self.blocks, self.df, self.blocks_df, threshold, vectorized)
+                assert union == {index: {other for other, score in self.reference_scores(index, lambda matrix: matrix.max(initial=0)).items() if score >= threshold} if index != 2 else set() for index in self.df.index}
+            for block_size in [1, 2, 3]:
+                part_scores = textFiltering.filter_with_part_scores(self.blocks, self.df, self.blocks_df, block_size, vectorized)
+                normalized = textFiltering.filter_with_normalized_scores_revised(self.blocks, self.df, self.blocks_df, block_size, vectorized)
+                threshold_scores = textFiltering.filter_with_threshold_scores(self.blocks, self.df, self.blocks_df, block_size, 0.9, vectorized)
+                # the record with bad name parts is left out, or gets an empty block
+                assert 2 not in part_scores and 2 not in normalized and threshold_scores[2] == set()
+                for index in [0, 1, 3, 4]:
+                    self.assert_best(part_scores, index, self.reference_scores(index, lambda matrix: matrix.max(initial=0)), block_size)
+                    self.assert_best(normalized, index, self.reference_scores(index, assignment), block_size)
+                    # only records with name parts get points
+                    points = self.reference_scores(index, lambda matrix: (matrix >= 0.9).sum() / matrix.shape[1] if matrix.shape[1] else None)
+                    self.assert_best(threshold_scores, index, {other: score for other, score in points.items() if score is not None}, block_size)
+            # both ways of computing the similarities give the same blocks
+            if not vectorized:
+                assert part_scores == textFiltering.filter_with_part_scores(self.blocks, self.df, self.blocks_df, block_size)
+                assert normalized == textFiltering.filter_with_normalized_scores_revised(self.blocks, self.df, self.blocks_df, block_size)
+                assert threshold_scores == textFiltering.filter_with_threshold_scores(self.blocks, self.df, self.blocks_df, block_size, 0.9)
+
+    def test_empty_name_parts(self):
+        # without any decodable name parts in df or without any keys in blocks_df, the vectorized filters give the same blocks as the others
+        empty = pd.DataFrame({"name_parts": ["{}", "bad", None]})
+        for df, blocks_df in [(empty, self.blocks_df), (self.df, empty)]:
+            blocks = {index: set(range(len(blocks_df))) for index in df.index}
+            for filter_function in [
+                textFiltering.filter_with_set_union,
+                textFiltering.filter_with_part_scores,
+                textFiltering.filter_with_normalized_scores_revised,
+                textFiltering.filter_with_threshold_scores,
+            ]:
+                assert filter_function(blocks, df, blocks_df) == filter_function(blocks, df, blocks_df, vectorized=False)
+            # the similarity join has nothing to join on either side
+            for vectorized in [True, False]:
+                assert textFiltering.filter_with_set_union(blocks, df, blocks_df, 0.8, vectorized, similarity_join=True) == textFiltering.filter_with_set_union(blocks, df, blocks_df, 0.8)
+                assert textFiltering.filter_with_threshold_scores(blocks, df, blocks_df, 2, 0.8, vectorized, similarity_join=True) == textFiltering.filter_with_threshold_scores(blocks, df, blocks_df, 2, 0.8)
+
+    def test_similarity_join(self):
+        # comparing every name part only with the keys that can reach the threshold gives the same blocks as comparing it with every key
+        for vectorized in [True, False]:
+            for threshold in [0.5, 0.8, 0.9, 1]:
+                assert textFiltering.name_part_scores(self.df, self.blocks_df, vectorized, threshold).matrix.nnz > 0
+                assert textFiltering.filter_with_set_union(self.blocks, self.df, self.blocks_df, threshold, vectorized, similarity_join=True) == textFiltering.filter_with_set_union(self.blocks, self.df, self.blocks_df, threshold)
+                for block_size in [1, 2]:
+                    joined = textFiltering.filter_with_threshold_scores(self.blocks, self.df, self.blocks_df, block_size, threshold, vectorized, similarity_join=True)
+                    assert joined == textFiltering.filter_with_threshold_scores(self.blocks, self.df, self.blocks_df, block_size, threshold)
+
+    def test_assignment_maxima(self, monkeypatch):
+        generator = np.random.default_rng(0)
+        # small matrices try every assignment, and 7 x 7 matrices (5040 assignments) are solved with linear_sum_assignment,
+        # and either way the sums are exactly the ones linear_sum_assignment gives
+        for shape in [(5, 1, 1), (5, 2, 3), (5, 3, 2), (5, 1, 4), (5, 4, 4), (3, 7, 7), (0, 2, 2), (2, 0, 3)]:
+            matrices = generator.random(shape)
+            assert textFiltering.assignment_maxima(matrices).tolist() == textFiltering.linear_sum_assignment_maxima(matrices).tolist()
+        # 0.1 + 0.2 and 0.3 + 0.0 are both the highest sum, but differ in the last bits, so the tie is solved with linear_sum_assignment
+        tied = np.array([[[0.1, 0.3], [0.0, 0.2]], [[0.5, 0.5], [0.5, 0.5]], [[0.9, 0.1], [0.1, 0.2]]])
+        solved = []
+        linear_sum_assignment_maxima = textFiltering.linear_sum_assignment_maxima
+        monkeypatch.setattr(textFiltering, "linear_sum_assignment_maxima", lambda matrices: solved.append(len(matrices)) or linear_sum_assignment_maxima(matrices))
+        assert textFiltering.assignment_maxima(tied).tolist() == linear_sum_assignment_maxima(tied).tolist()
+        assert solved == [2]
+
+    def test_parallel_filter(self):
+        for filter_function, kwargs in [
+            (textFiltering.filter_with_set_union, {"similarity_threshold": 0.8, "similarity_join": True}),
+            (textFiltering.filter_with_part_scores, {"block_size": 2}),
+            (textFiltering.filter_with_normalized_scores_revised, {"block_size": 2, "ranked": True}),
+            (textFiltering.filter_with_threshold_scores, {"block_size": 2, "similarity_threshold": 0.9}),
+            (textFiltering.filter_with_threshold_scores, {"block_size": 2, "similarity_threshold": 0.9, "ranked": True}),
+        ]:
+            serial = filter_function(self.blocks, self.df, self.blocks_df, **kwargs)
+            parallel = textFiltering.parallel_filter(filter_function, self.blocks, self.df, self.blocks_df, workers=2, shard_size=2, **kwargs)
+            if kwargs.get("ranked"):
+                assert [parallel.ranked(i)[0].tolist() for i in range(len(parallel))] == [serial.ranked(i)[0].tolist() for i in range(len(serial))]
+                parallel, serial = parallel.blocks(), serial.blocks()
+            assert parallel == serial and list(parallel) == list(serial)
+
+    def test_top_k(self):
+        generator = np.random.default_rng(0)
+        for size in [0, 1, 5, 50]:
+            # few distinct scores, so there are many ties
+            scores = generator.integers(0, 4, size).astype(np.float64)
+            positions = generator.permutation(size)
+            for k in [0, 1, 3, 10, 60]:
+                assert sorted(textFiltering.top_k(scores, positions, k).tolist()) == sorted(np.lexsort((positions, -scores))[:k].tolist())
+
+    def test_ranked(self):
+        for filter_function, kwargs in [
+            (textFiltering.filter_with_part_scores, {}),
+            (textFiltering.filter_with_normalized_scores_revised, {}),
+            (textFiltering.filter_with_threshold_scores, {"similarity_threshold": 0.9}),
+            (textFiltering.filter_with_threshold_scores, {"similarity_threshold": 0.9, "similarity_join": True}),
+        ]:
+            for vectorized in [True, False]:
+                ranked = filter_function(self.blocks, self.df, self.blocks_df, vectorized=vectorized, ranked=True, **kwargs)
+                # every record of df is there, and the one with bad name parts has no candidates
+                assert len(ranked) == len(self.df) and len(ranked.ranked(2)[0]) == 0
+                for i in range(len(ranked)):
+                    assert list(ranked.ranked(i)[1]) == sorted(ranked.ranked(i)[1], reverse=True)
+                # filtering once gives the blocks of every block size
+                for block_size in [1, 2, 3, 10]:
+                    filtered = filter_function(self.blocks, self.df, self.blocks_df, block_size=block_size, vectorized=vectorized, **kwargs)
+                    assert ranked.blocks(block_size) == {2: set()} | filtered
+
 class Test_vectordb():
     def test_get_and_query_db(self):
         collection = get_db("Zylbercweig-LASKIall-distilroberta-v1")